@@ -0,0 +1,245 @@
+"""Bounded in-memory table of Mini App answer jobs with streamed progress.
+
+Clients submit a job, then follow its tokens (e.g. over Server-Sent
+Events) or poll the final result. Reconnecting clients get the same job
+back instead of triggering a new upstream call.
+
+A job is shared by everyone who submitted the same request, so it is
+cancelled only when all submitting sessions moved on to a newer prompt,
+or when no client has followed it for a grace period.
+"""
+import threading
+import time
+
+from generation_control import CancelToken
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_ERROR = 'error'
+
+
+class AnswerJob:
+    """One generation whose text chunks can be replayed from any offset."""
+
+    def __init__(self, job_id, message, history, user_id=None, mode='full', summary=None):
+        self.job_id = job_id
+        self.message = message
+        self.history = history
+        self.user_id = user_id
+        self.mode = mode
+        self.summary = summary
+        self.status = JOB_QUEUED
+        self.chunks = []
+        self.reply = None
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self.cancel_token = CancelToken()
+        self.listeners = 0
+        self.last_seen = self.created_at
+        self._claims = set()
+        self._pinned = False
+        self._cond = threading.Condition()
+
+    @property
+    def finished(self):
+        return self.status in (JOB_DONE, JOB_ERROR)
+
+    def start(self):
+        with self._cond:
+            self.status = JOB_RUNNING
+            self._cond.notify_all()
+
+    def append(self, text):
+        """Add streamed text and wake up listeners."""
+        if not text:
+            return
+        with self._cond:
+            self.chunks.append(text)
+            self._cond.notify_all()
+
+    def finish(self, reply):
+        with self._cond:
+            self.reply = reply
+            self.status = JOB_DONE
+            self.finished_at = time.time()
+            self._cond.notify_all()
+
+    def fail(self, error):
+        with self._cond:
+            self.error = str(error)
+            self.status = JOB_ERROR
+            self.finished_at = time.time()
+            self._cond.notify_all()
+
+    def attach(self):
+        """Register a client following the job (an SSE stream or a blocking request)."""
+        with self._cond:
+            self.listeners += 1
+            self.last_seen = time.time()
+
+    def detach(self):
+        with self._cond:
+            self.listeners -= 1
+            self.last_seen = time.time()
+
+    def touch(self):
+        """Note a status poll, which keeps the job followed like a listener."""
+        with self._cond:
+            self.last_seen = time.time()
+
+    def orphaned(self, grace):
+        """True when no client has followed the job for grace seconds."""
+        with self._cond:
+            return self.listeners <= 0 and time.time() - self.last_seen > grace
+
+    def claim(self, session):
+        """Return a claim of session on this job for a GenerationRegistry.
+
+        Without a session (anonymous client) the job is pinned and never
+        cancelled as superseded; None is returned then, and for a finished
+        job, whose claims were already released.
+        """
+        with self._cond:
+            if self.finished:
+                return None
+            if session is None:
+                self._pinned = True
+                return None
+            claim = JobClaim(self, session)
+            self._claims.add(claim)
+            return claim
+
+    def claims(self):
+        with self._cond:
+            return list(self._claims)
+
+    def drop_claim(self, claim, reason):
+        """Withdraw a claim; cancel the job once nobody else wants it."""
+        with self._cond:
+            self._claims.discard(claim)
+            abandoned = not self._claims and not self._pinned and not self.finished
+        if abandoned:
+            self.cancel_token.cancel(reason)
+
+    def wait(self, timeout=None):
+        """Block until the job finishes; returns True if it did."""
+        with self._cond:
+            return self._cond.wait_for(lambda: self.finished, timeout)
+
+    def wait_chunks(self, offset, timeout):
+        """Return (chunks after offset, finished) once there is news or timeout expires."""
+        with self._cond:
+            self._cond.wait_for(lambda: len(self.chunks) > offset or self.finished, timeout)
+            return self.chunks[offset:], self.finished
+
+    def to_dict(self):
+        with self._cond:
+            data = {
+                'job_id': self.job_id,
+                'status': self.status,
+                'mode': self.mode,
+                'text': ''.join(self.chunks),
+                'events': len(self.chunks),
+            }
+            if self.reply is not None:
+                data['reply'] = self.reply
+            if self.error is not None:
+                data['error'] = self.error
+        return data
+
+
+class JobClaim:
+    """A session's interest in a shared job."""
+
+    __slots__ = ('job', 'session')
+
+    def __init__(self, job, session):
+        self.job = job
+        self.session = session
+
+    def cancel(self, reason):
+        self.job.drop_claim(self, reason)
+
+
+def resume_offset(last_event_id=None, query=''):
+    """Chunk offset a reconnecting client resumes from.
+
+    Server-Sent Events ids are chunk counts; from= in the query string
+    (for clients that cannot set Last-Event-ID) takes precedence.
+    """
+    offset = last_event_id or ''
+    for item in query.split('&'):
+        if item.startswith('from='):
+            offset = item[len('from='):]
+    return int(offset) if offset.isdigit() else 0
+
+
+def job_events(job, offset, heartbeat):
+    """Yield (event, data, event_id) for job chunks after offset until it finishes.
+
+    event is None for a heartbeat when nothing happened for heartbeat seconds.
+    """
+    while True:
+        chunks, finished = job.wait_chunks(offset, heartbeat)
+        if chunks:
+            offset += len(chunks)
+            yield 'token', {'text': ''.join(chunks)}, offset
+        if finished and not job.wait_chunks(offset, 0)[0]:
+            if job.error:
+                yield 'error', {'error': job.error}, None
+            else:
+                yield 'done', {'reply': job.reply}, offset
+            return
+        if not chunks:
+            yield None, None, None
+
+
+class AnswerJobTable:
+    """Job registry bounded by size, with finished jobs expiring after ttl seconds."""
+
+    def __init__(self, max_jobs=200, ttl=900):
+        self.max_jobs = max_jobs
+        self.ttl = ttl
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._jobs)
+
+    def get(self, job_id):
+        with self._lock:
+            self._prune()
+            return self._jobs.get(job_id)
+
+    def submit(self, job_id, message, history, user_id=None, mode='full', summary=None):
+        """Return (job, created); job is None when the table is full of running jobs."""
+        with self._lock:
+            self._prune()
+            job = self._jobs.get(job_id)
+            if job and job.status != JOB_ERROR:
+                return job, False
+            if len(self._jobs) >= self.max_jobs and not self._evict_oldest_finished():
+                return None, False
+            job = AnswerJob(job_id, message, history, user_id, mode, summary)
+            self._jobs[job_id] = job
+            return job, True
+
+    def _prune(self):
+        now = time.time()
+        expired = [
+            job_id for job_id, job in self._jobs.items()
+            if job.finished and now - job.finished_at > self.ttl
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    def _evict_oldest_finished(self):
+        finished = [job for job in self._jobs.values() if job.finished]
+        if not finished:
+            return False
+        oldest = min(finished, key=lambda job: job.finished_at)
+        del self._jobs[oldest.job_id]
+        return True
@@ -0,0 +1,140 @@
+"""Adaptive limit on concurrent upstream model calls.
+
+AIMD driven by observed latency: each finished call is compared with a
+per-kind baseline (10th percentile of recent samples). Calls slower
+than baseline * tolerance, or failed ones, shrink the limit
+multiplicatively; fast calls made while the limit was actually in use
+grow it by about one slot per limit's worth of calls. When the limit is
+reached callers wait for a bounded time or degrade instead of piling up.
+
+Total latency grows with the answer's length, so it is not compared
+directly: the signal is time to first token for streamed calls and
+milliseconds per completion token otherwise, each with its own baseline.
+"""
+import threading
+import time
+from collections import defaultdict, deque
+
+MIN_BASELINE_SAMPLES = 10
+
+
+class UpstreamOverloaded(Exception):
+    """Raised when no upstream slot frees up in time and the request is shed."""
+
+
+class Slot:
+    __slots__ = ('acquired_at', 'limit', 'inflight')
+
+    def __init__(self, limit, inflight):
+        self.acquired_at = time.time()
+        self.limit = limit
+        self.inflight = inflight
+
+
+class AdaptiveLimiter:
+    """Thread-safe AIMD concurrency limiter."""
+
+    def __init__(self, initial_limit=8, min_limit=2, max_limit=32, tolerance=2.0, backoff=0.75,
+                 sample_window=100, decrease_cooldown=1.0):
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.tolerance = tolerance
+        self.backoff = backoff
+        self.decrease_cooldown = decrease_cooldown
+        self.inflight = 0
+        self._samples = defaultdict(lambda: deque(maxlen=sample_window))
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+        self.acquired = 0
+        self.throttled = 0
+        self.rejected = 0
+        self.increases = 0
+        self.decreases = 0
+
+    def acquire(self, timeout=0.0, record_rejection=True):
+        """Take a slot, waiting up to timeout seconds; None when none freed up."""
+        deadline = time.time() + timeout
+        with self._cond:
+            waited = False
+            while self.inflight >= int(self.limit):
+                remaining = deadline - time.time()
+                if not waited:
+                    self.throttled += 1
+                    waited = True
+                if remaining <= 0:
+                    if record_rejection:
+                        self.rejected += 1
+                    return None
+                self._cond.wait(remaining)
+            self.inflight += 1
+            self.acquired += 1
+            return Slot(int(self.limit), self.inflight)
+
+    def pressure(self):
+        """Share of the current limit in use (can exceed 1 right after a decrease)."""
+        with self._cond:
+            return self.inflight / max(int(self.limit), 1)
+
+    def _baseline(self, kind):
+        samples = self._samples[kind]
+        if len(samples) < MIN_BASELINE_SAMPLES:
+            return None
+        return sorted(samples)[len(samples) // 10]
+
+    @staticmethod
+    def latency_signal(kind, latency_ms, first_token_ms=None, completion_tokens=None):
+        """Return (baseline kind, value) comparable across answer lengths, or (kind, None)."""
+        if first_token_ms is not None:
+            return f'{kind}:ttft', first_token_ms
+        if latency_ms is not None and completion_tokens:
+            return f'{kind}:per_token', latency_ms / completion_tokens
+        return kind, None
+
+    def release(self, slot, latency_ms=None, error=False, kind='default', first_token_ms=None,
+                completion_tokens=None, capped=False):
+        """Return a slot; latency_ms=None (e.g. a cancelled call) gives no signal.
+
+        capped marks calls whose max_tokens was lowered or reached: they are
+        judged against the baseline but never become part of it.
+        """
+        with self._cond:
+            self.inflight -= 1
+            self._cond.notify()
+            if latency_ms is None and not error:
+                return
+
+            kind, latency_ms = self.latency_signal(kind, latency_ms, first_token_ms, completion_tokens)
+            if latency_ms is None and not error:
+                return
+            baseline = self._baseline(kind)
+            now = time.time()
+            if error or baseline is not None and latency_ms > baseline * self.tolerance:
+                # One decrease per cooldown, so a burst of slow replies
+                # from the same congestion counts once.
+                if now - self._last_decrease >= self.decrease_cooldown:
+                    self.limit = max(float(self.min_limit), self.limit * self.backoff)
+                    self._last_decrease = now
+                    self.decreases += 1
+            elif slot.inflight * 2 >= slot.limit:
+                # Grow only when demand actually used the limit.
+                new_limit = min(float(self.max_limit), self.limit + 1 / self.limit)
+                if int(new_limit) > int(self.limit):
+                    self.increases += 1
+                self.limit = new_limit
+            if not error and not capped:
+                self._samples[kind].append(latency_ms)
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {
+                'limit': int(self.limit),
+                'inflight': self.inflight,
+                'acquired': self.acquired,
+                'throttled': self.throttled,
+                'rejected': self.rejected,
+                'increases': self.increases,
+                'decreases': self.decreases,
+                'baseline_ms': {kind: self._baseline(kind) for kind in self._samples},
+            }
@@ -0,0 +1,99 @@
+"""Cancellation of superseded and abandoned in-flight generations.
+
+Each session (a user in a Telegram chat, a Mini App user) keeps at most
+one active generation: registering a new one cancels the older ones
+unless the session opted out. Cancellation is cooperative: the streaming
+callback checks its token and raises GenerationCancelled, which closes
+the upstream stream and frees the concurrency slot.
+"""
+import threading
+from collections import defaultdict
+
+CANCEL_SUPERSEDED = 'superseded'
+CANCEL_DISCONNECTED = 'disconnected'
+
+
+class GenerationCancelled(Exception):
+    """Raised from a streaming callback once its generation was cancelled."""
+
+    def __init__(self, reason=None):
+        super().__init__(reason or 'cancelled')
+        self.reason = reason or 'cancelled'
+
+
+class CancelToken:
+    """Thread-safe flag a running generation checks between tokens."""
+
+    def __init__(self):
+        self.reason = None
+        self._lock = threading.Lock()
+        self._event = threading.Event()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def cancel(self, reason='cancelled'):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self.reason = reason
+            self._event.set()
+
+    def check(self):
+        """Raise GenerationCancelled if the token was cancelled."""
+        if self._event.is_set():
+            raise GenerationCancelled(self.reason)
+
+
+class GenerationRegistry:
+    """Active generations per session and counters of cancelled work.
+
+    Registered items only need a cancel(reason) method, so a shared job
+    can register one claim per session.
+    """
+
+    def __init__(self):
+        self._active = defaultdict(list)
+        self._lock = threading.Lock()
+        self.cancelled = defaultdict(int)
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+    def start(self, session, token, supersede=True):
+        """Register token under session; supersede cancels the session's older ones.
+
+        Returns the number of generations cancelled.
+        """
+        with self._lock:
+            superseded = self._active.pop(session, []) if supersede else []
+            self._active[session].append(token)
+        for old in superseded:
+            old.cancel(CANCEL_SUPERSEDED)
+        return len(superseded)
+
+    def finish(self, session, token):
+        with self._lock:
+            tokens = self._active.get(session)
+            if tokens and token in tokens:
+                tokens.remove(token)
+                if not tokens:
+                    del self._active[session]
+
+    def record_cancelled(self, reason, usage=None):
+        """Count a cancelled generation and the tokens it had already spent."""
+        usage = usage or {}
+        with self._lock:
+            self.cancelled[reason] += 1
+            self.prompt_tokens += usage.get('prompt_tokens', 0)
+            self.completion_tokens += usage.get('completion_tokens', 0)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'active': sum(len(tokens) for tokens in self._active.values()),
+                'sessions': len(self._active),
+                'cancelled': dict(self.cancelled),
+                'prompt_tokens': self.prompt_tokens,
+                'completion_tokens': self.completion_tokens,
+            }
@@ -0,0 +1,298 @@
+"""Memory-mapped index of precomputed analyses for Telegram inline mode.
+
+Inline queries must be answered within Telegram's deadline, so they are
+served from a binary index built offline from inline_works.jsonl (one
+{"title", "author", "text", "aliases"} object per line). The index is
+opened with mmap, so worker processes share the same pages and pay
+almost no private RAM for it.
+
+Usage:
+    python inline_index.py build [--source inline_works.jsonl] [--index inline_index.bin]
+    python inline_index.py generate [--source inline_works.jsonl]   # fill missing texts via the model
+    python inline_index.py search QUERY [--index inline_index.bin] [--limit 5]
+"""
+import argparse
+import json
+import mmap
+import os
+import re
+import struct
+import time
+import zlib
+from collections import defaultdict
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parent
+DEFAULT_SOURCE_PATH = BASE_DIR / 'inline_works.jsonl'
+DEFAULT_INDEX_PATH = BASE_DIR / 'inline_index.bin'
+
+MAGIC = b'PKIX'
+INDEX_VERSION = 1
+
+# magic, version, doc count, key count, trigram count,
+# offsets of docs, keys, trigrams, postings and strings sections
+HEADER_FORMAT = struct.Struct('<4sHxxIIIIIIII')
+# title, author and text as (offset, length) into strings, trigram count
+DOC_FORMAT = struct.Struct('<IIIIIII')
+# key (offset, length) into strings, doc id
+KEY_FORMAT = struct.Struct('<IHH')
+# trigram hash, first posting, posting count
+TRIGRAM_FORMAT = struct.Struct('<III')
+POSTING_FORMAT = struct.Struct('<H')
+
+MIN_TRIGRAM_SCORE = 0.35
+
+_TOKEN_RE = re.compile(r'[0-9a-zа-я]+')
+
+
+def normalize(text):
+    """Lowercase words of text with ё folded to е."""
+    return _TOKEN_RE.findall(str(text).lower().replace('ё', 'е'))
+
+
+def trigrams(words):
+    """Hashed character trigrams of space-joined words."""
+    padded = f" {' '.join(words)} "
+    return {zlib.crc32(padded[i:i + 3].encode('utf-8')) for i in range(len(padded) - 2)}
+
+
+def load_source(path):
+    with open(path, 'r', encoding='utf-8') as source_file:
+        return [json.loads(line) for line in source_file if line.strip()]
+
+
+def build_index(works, path):
+    """Write works into a binary index file at path."""
+    strings = bytearray()
+
+    def add_string(value):
+        data = str(value).encode('utf-8')
+        offset = len(strings)
+        strings.extend(data)
+        return offset, len(data)
+
+    docs = []
+    keys = set()
+    postings = defaultdict(list)
+    for doc_id, work in enumerate(works):
+        words = normalize(f"{work['title']} {work['author']}")
+        grams = trigrams(words)
+        for alias in work.get('aliases', ()):
+            alias_words = normalize(alias)
+            words += alias_words
+            grams |= trigrams(alias_words)
+        for word in words:
+            if len(word) >= 2:
+                keys.add((word, doc_id))
+        for gram in grams:
+            postings[gram].append(doc_id)
+        docs.append(DOC_FORMAT.pack(
+            *add_string(work['title']),
+            *add_string(work['author']),
+            *add_string(work['text']),
+            len(grams),
+        ))
+
+    key_rows = []
+    for word, doc_id in sorted(keys, key=lambda item: (item[0].encode('utf-8'), item[1])):
+        key_rows.append(KEY_FORMAT.pack(*add_string(word), doc_id))
+
+    trigram_rows = []
+    posting_rows = []
+    for gram in sorted(postings):
+        trigram_rows.append(TRIGRAM_FORMAT.pack(gram, len(posting_rows), len(postings[gram])))
+        posting_rows.extend(POSTING_FORMAT.pack(doc_id) for doc_id in postings[gram])
+
+    docs_offset = HEADER_FORMAT.size
+    keys_offset = docs_offset + DOC_FORMAT.size * len(docs)
+    trigrams_offset = keys_offset + KEY_FORMAT.size * len(key_rows)
+    postings_offset = trigrams_offset + TRIGRAM_FORMAT.size * len(trigram_rows)
+    strings_offset = postings_offset + POSTING_FORMAT.size * len(posting_rows)
+    header = HEADER_FORMAT.pack(
+        MAGIC, INDEX_VERSION, len(docs), len(key_rows), len(trigram_rows),
+        docs_offset, keys_offset, trigrams_offset, postings_offset, strings_offset,
+    )
+
+    path = Path(path)
+    tmp_path = path.with_suffix('.tmp')
+    with open(tmp_path, 'wb') as index_file:
+        index_file.write(header)
+        for rows in (docs, key_rows, trigram_rows, posting_rows):
+            index_file.write(b''.join(rows))
+        index_file.write(strings)
+    os.replace(tmp_path, path)
+    return len(docs)
+
+
+class InlineIndex:
+    """Read-only view of an index file; lookups read the mmap directly."""
+
+    def __init__(self, path):
+        self.path = str(path)
+        with open(self.path, 'rb') as index_file:
+            self._map = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, self.doc_count, self.key_count, self.trigram_count,
+         self._docs, self._keys, self._trigrams, self._postings, self._strings) = \
+            HEADER_FORMAT.unpack_from(self._map, 0)
+        if magic != MAGIC or version != INDEX_VERSION:
+            self._map.close()
+            raise ValueError(f'{self.path} is not a version {INDEX_VERSION} inline index')
+
+    def __len__(self):
+        return self.doc_count
+
+    def close(self):
+        self._map.close()
+
+    def _string(self, offset, length):
+        start = self._strings + offset
+        return self._map[start:start + length]
+
+    def _key(self, position):
+        offset, length, doc_id = KEY_FORMAT.unpack_from(self._map, self._keys + position * KEY_FORMAT.size)
+        return self._string(offset, length), doc_id
+
+    def _prefix_docs(self, prefix):
+        """Doc ids with a title/author word starting with prefix (binary search)."""
+        low, high = 0, self.key_count
+        while low < high:
+            middle = (low + high) // 2
+            if self._key(middle)[0] < prefix:
+                low = middle + 1
+            else:
+                high = middle
+        found = set()
+        while low < self.key_count:
+            key, doc_id = self._key(low)
+            if not key.startswith(prefix):
+                break
+            found.add(doc_id)
+            low += 1
+        return found
+
+    def _trigram_postings(self, gram):
+        low, high = 0, self.trigram_count
+        while low < high:
+            middle = (low + high) // 2
+            value, first, count = TRIGRAM_FORMAT.unpack_from(
+                self._map, self._trigrams + middle * TRIGRAM_FORMAT.size
+            )
+            if value == gram:
+                start = self._postings + first * POSTING_FORMAT.size
+                return [row[0] for row in POSTING_FORMAT.iter_unpack(
+                    self._map[start:start + count * POSTING_FORMAT.size]
+                )]
+            if value < gram:
+                low = middle + 1
+            else:
+                high = middle
+        return []
+
+    def document(self, doc_id):
+        """Return {'id', 'title', 'author', 'text'} of a document."""
+        fields = DOC_FORMAT.unpack_from(self._map, self._docs + doc_id * DOC_FORMAT.size)
+        return {
+            'id': doc_id,
+            'title': self._string(fields[0], fields[1]).decode('utf-8'),
+            'author': self._string(fields[2], fields[3]).decode('utf-8'),
+            'text': self._string(fields[4], fields[5]).decode('utf-8'),
+        }
+
+    def _trigram_count(self, doc_id):
+        return DOC_FORMAT.unpack_from(self._map, self._docs + doc_id * DOC_FORMAT.size)[6]
+
+    def search(self, query, limit=5):
+        """Return best matching documents for query, best first.
+
+        Every query word counts as a prefix of some title/author word;
+        trigram overlap ranks the rest and tolerates typos.
+        """
+        words = normalize(query)
+        if not words:
+            return []
+
+        scores = defaultdict(float)
+        for word in words:
+            if len(word) < 2:
+                continue
+            for doc_id in self._prefix_docs(word.encode('utf-8')):
+                scores[doc_id] += 1.0
+
+        query_grams = trigrams(words)
+        overlap = defaultdict(int)
+        for gram in query_grams:
+            for doc_id in self._trigram_postings(gram):
+                overlap[doc_id] += 1
+        for doc_id, shared in overlap.items():
+            # Dice coefficient between query and document trigram sets.
+            similarity = 2 * shared / (len(query_grams) + self._trigram_count(doc_id))
+            if similarity >= MIN_TRIGRAM_SCORE or doc_id in scores:
+                scores[doc_id] += similarity
+
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:limit]
+        return [dict(self.document(doc_id), score=score) for doc_id, score in ranked]
+
+
+def command_build(args):
+    works = load_source(args.source)
+    started = time.perf_counter()
+    count = build_index(works, args.index)
+    size = os.path.getsize(args.index)
+    elapsed = (time.perf_counter() - started) * 1000
+    print(f'[LOG] Indexed {count} works into {args.index} ({size / 1024:.1f} KiB, {elapsed:.1f}ms)')
+
+
+def command_generate(args):
+    """Ask the model for summary analyses of works that have no text yet."""
+    # Imported lazily: main needs data.env with the bot and model tokens.
+    import main
+
+    works = load_source(args.source)
+    missing = [work for work in works if not work.get('text')]
+    print(f'[LOG] Generating {len(missing)} of {len(works)} analyses')
+    for work in missing:
+        prompt = f"{work['title']}, {work['author']}"
+        work['text'] = main.get_answer(prompt, mode='summary').strip()
+        print(f'[LOG] Generated: {prompt} ({len(work["text"])} chars)')
+
+    with open(args.source, 'w', encoding='utf-8') as source_file:
+        for work in works:
+            source_file.write(json.dumps(work, ensure_ascii=False) + '\n')
+    print('[LOG] Run "python inline_index.py build" to rebuild the index')
+
+
+def command_search(args):
+    index = InlineIndex(args.index)
+    started = time.perf_counter()
+    results = index.search(args.query, limit=args.limit)
+    elapsed = (time.perf_counter() - started) * 1000
+    for result in results:
+        print(f"  {result['score']:.2f}  {result['title']} — {result['author']}")
+    print(f'[LOG] {len(results)} result(s) in {elapsed:.2f}ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline tools for the Pushkin AI inline index.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build_parser = subparsers.add_parser('build', help='build the binary index from the source file')
+    build_parser.add_argument('--source', default=str(DEFAULT_SOURCE_PATH))
+    build_parser.add_argument('--index', default=str(DEFAULT_INDEX_PATH))
+    build_parser.set_defaults(handler=command_build)
+
+    generate_parser = subparsers.add_parser('generate', help='fill missing analyses using the model')
+    generate_parser.add_argument('--source', default=str(DEFAULT_SOURCE_PATH))
+    generate_parser.set_defaults(handler=command_generate)
+
+    search_parser = subparsers.add_parser('search', help='query the index')
+    search_parser.add_argument('query')
+    search_parser.add_argument('--index', default=str(DEFAULT_INDEX_PATH))
+    search_parser.add_argument('--limit', type=int, default=5)
+    search_parser.set_defaults(handler=command_search)
+
+    args = parser.parse_args()
+    args.handler(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -21,8 +21,28 @@ from io import BytesIO
 import json
 import mimetypes
 import threading
+import select
+import socket
+import queue
+from collections import deque
 from pathlib import Path
 from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import hashlib
+import base64
+from offtopic_filter import OfftopicClassifier, looks_like_refusal
+from request_journal import RequestJournal, JOB_DONE
+import profiler
+from answer_jobs import AnswerJobTable, job_events, resume_offset
+from semantic_cache import SemanticCache
+from usage_ledger import UsageLedger, summarize as summarize_usage
+from inline_index import InlineIndex
+from traffic_capture import TrafficRecorder
+from prefetcher import Prefetcher, PrefetchCancelled, parse_tiers
+from concurrency_limiter import AdaptiveLimiter, UpstreamOverloaded
+from telegram_auth import verify_init_data
+from generation_control import (
+    CANCEL_DISCONNECTED, CancelToken, GenerationCancelled, GenerationRegistry
+)
 
 # Загружаем переменные окружения из файла .env
 load_dotenv('data.env')
@@ -30,6 +50,10 @@ load_dotenv('data.env')
 # Получаем токены из переменных окружения
 TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
 HUGGINGFACE_TOKEN = os.getenv('HUGGINGFACE_TOKEN')
+MODEL_BASE_URL = os.getenv('MODEL_BASE_URL', 'https://router.huggingface.co/v1').strip()
+MODEL_NAME = os.getenv('MODEL_NAME', 'deepseek-ai/DeepSeek-V3.2-Exp:novita').strip()
+# e.g. http://127.0.0.1:9001/bot{0}/{1} to talk to a local fake during replay
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL', '').strip()
 # ID администратора (укажите свой Telegram ID)
 ADMIN_ID = os.getenv('ADMIN_ID') 
 MINI_APP_URL = os.getenv('MINI_APP_URL', '').strip()
@@ -38,9 +62,13 @@ MINI_APP_PORT = int(os.getenv('PORT', os.getenv('MINI_APP_PORT', '8080')))
 MINI_APP_ENABLED = os.getenv('MINI_APP_ENABLED', '1') == '1'
 MINI_APP_AUTO_TUNNEL = os.getenv('MINI_APP_AUTO_TUNNEL', '1') == '1'
 MINI_APP_TUNNEL_TIMEOUT = int(os.getenv('MINI_APP_TUNNEL_TIMEOUT', '25'))
+MINI_APP_TUNNEL_HEALTH_INTERVAL = int(os.getenv('MINI_APP_TUNNEL_HEALTH_INTERVAL', '60'))
 BASE_DIR = Path(__file__).resolve().parent
 RUNTIME_MINI_APP_URL = MINI_APP_URL
+RUNTIME_MINI_APP_URL_LOCK = threading.Lock()
 MINI_APP_TUNNEL_PROCESS = None
+MINI_APP_TUNNEL_STOP = threading.Event()
+TUNNEL_URL_PATTERN = re.compile(r'https://[a-z0-9-]+\.trycloudflare\.com', re.IGNORECASE)
 INSTANCE_LOCK_HANDLE = None
 LITERATURE_SYSTEM_PROMPT = (
     "You are a literature analysis assistant. Answer only literature-related requests: "
@@ -49,24 +77,216 @@ LITERATURE_SYSTEM_PROMPT = (
     "If the request is unrelated to literature, politely refuse and redirect to literature topics. "
     "When a user provides a work and an author, give a structured and detailed analysis in Russian."
 )
+LITERATURE_SUMMARY_INSTRUCTION = (
+    "Give only a short structured summary in Russian: 5-7 bullet points covering the genre, "
+    "main theme and problems, key characters, central conflict and author intent, "
+    "under 180 words. The user can request the full analysis afterwards."
+)
+EXPAND_REQUEST_TEXT = (
+    "Подробнее: дай полный развернутый литературный анализ по этому запросу, "
+    "раскрыв каждый пункт краткого обзора."
+)
+TIERED_ANSWERS_ENABLED = os.getenv('TIERED_ANSWERS_ENABLED', '1') == '1'
+SUMMARY_MAX_TOKENS = int(os.getenv('SUMMARY_MAX_TOKENS', '600'))
+FULL_MAX_TOKENS = int(os.getenv('FULL_MAX_TOKENS', '3500'))
+OFFTOPIC_FILTER_ENABLED = os.getenv('OFFTOPIC_FILTER_ENABLED', '1') == '1'
+OFFTOPIC_SHADOW_MODE = os.getenv('OFFTOPIC_SHADOW_MODE', '0') == '1'
+OFFTOPIC_THRESHOLD = float(os.getenv('OFFTOPIC_THRESHOLD', '0.97'))
+OFFTOPIC_MODEL_PATH = BASE_DIR / os.getenv('OFFTOPIC_MODEL_PATH', 'offtopic_model.json')
+OFFTOPIC_SHADOW_LOG = BASE_DIR / os.getenv('OFFTOPIC_SHADOW_LOG', 'offtopic_shadow.jsonl')
+OFFTOPIC_REFUSAL_TEXT = (
+    "Я занимаюсь только разбором литературных произведений. "
+    "Отправьте название произведения и автора или задайте вопрос по литературе.\n\n"
+    "Пример: 'Война и мир, Лев Толстой'"
+)
+OFFTOPIC_CLASSIFIER = None
+OFFTOPIC_LOG_LOCK = threading.Lock()
+REQUEST_JOURNAL_ENABLED = os.getenv('REQUEST_JOURNAL_ENABLED', '1') == '1'
+REQUEST_JOURNAL_PATH = BASE_DIR / os.getenv('REQUEST_JOURNAL_PATH', 'pushkin_journal.db')
+REQUEST_JOURNAL_RETENTION = int(os.getenv('REQUEST_JOURNAL_RETENTION_HOURS', '72')) * 3600
+REQUEST_JOURNAL_RESUME_MAX_AGE = int(os.getenv('REQUEST_JOURNAL_RESUME_MAX_AGE', '3600'))
+MINI_APP_DEDUP_WINDOW = int(os.getenv('MINI_APP_DEDUP_WINDOW', '900'))
+REQUEST_JOURNAL = None
+MINI_APP_JOB_LIMIT = int(os.getenv('MINI_APP_JOB_LIMIT', '200'))
+MINI_APP_JOB_TTL = int(os.getenv('MINI_APP_JOB_TTL', '900'))
+MINI_APP_JOBS = AnswerJobTable(max_jobs=MINI_APP_JOB_LIMIT, ttl=MINI_APP_JOB_TTL)
+SSE_HEARTBEAT_SECONDS = 15
+SEMANTIC_CACHE_ENABLED = os.getenv('SEMANTIC_CACHE_ENABLED', '1') == '1'
+SEMANTIC_CACHE = SemanticCache(
+    threshold=float(os.getenv('SEMANTIC_CACHE_THRESHOLD', '0.75')),
+    max_entries=int(os.getenv('SEMANTIC_CACHE_MAX_ENTRIES', '2000')),
+    max_bytes=int(os.getenv('SEMANTIC_CACHE_MAX_MB', '64')) * 1024 * 1024,
+    ttl=int(os.getenv('SEMANTIC_CACHE_TTL_HOURS', '168')) * 3600,
+) if SEMANTIC_CACHE_ENABLED else None
+USAGE_LEDGER_ENABLED = os.getenv('USAGE_LEDGER_ENABLED', '1') == '1'
+USAGE_LEDGER_DIR = BASE_DIR / os.getenv('USAGE_LEDGER_DIR', 'usage')
+USAGE_ROLLUP_INTERVAL = int(os.getenv('USAGE_ROLLUP_INTERVAL', '600'))
+USAGE_RAW_RETENTION_DAYS = int(os.getenv('USAGE_RAW_RETENTION_DAYS', '30'))
+USAGE_LEDGER = None
+PROFILE_MAX_SECONDS = int(os.getenv('PROFILE_MAX_SECONDS', '120'))
+PROFILE_LOCK = threading.Lock()
+INLINE_MODE_ENABLED = os.getenv('INLINE_MODE_ENABLED', '1') == '1'
+INLINE_INDEX_PATH = BASE_DIR / os.getenv('INLINE_INDEX_PATH', 'inline_index.bin')
+INLINE_RESULTS_LIMIT = int(os.getenv('INLINE_RESULTS_LIMIT', '5'))
+INLINE_CACHE_TIME = int(os.getenv('INLINE_CACHE_TIME', '3600'))
+INLINE_INDEX = None
+BOT_USERNAME = None
+TRAFFIC_CAPTURE_PATH = os.getenv('TRAFFIC_CAPTURE_PATH', '').strip()
+TRAFFIC_CAPTURE_SALT = os.getenv('TRAFFIC_CAPTURE_SALT', '').strip()
+TRAFFIC_CAPTURE = None
+PREFETCH_ENABLED = os.getenv('PREFETCH_ENABLED', '0') == '1'
+# "min requests per day:aspects to prefetch", e.g. 2:2,5:4
+PREFETCH_TIERS = parse_tiers(os.getenv('PREFETCH_TIERS', '2:2,5:4'))
+PREFETCH_MAX_PER_HOUR = int(os.getenv('PREFETCH_MAX_PER_HOUR', '30'))
+PREFETCH_IDLE_SECONDS = float(os.getenv('PREFETCH_IDLE_SECONDS', '5'))
+PREFETCH_MAX_FOREGROUND = int(os.getenv('PREFETCH_MAX_FOREGROUND', '0'))
+PREFETCHER = None
+FOREGROUND_UPSTREAM_CALLS = 0
+FOREGROUND_UPSTREAM_LOCK = threading.Lock()
+UPSTREAM_LIMITER_ENABLED = os.getenv('UPSTREAM_LIMITER_ENABLED', '1') == '1'
+UPSTREAM_LIMITER = AdaptiveLimiter(
+    initial_limit=int(os.getenv('UPSTREAM_LIMIT_INITIAL', '8')),
+    min_limit=int(os.getenv('UPSTREAM_LIMIT_MIN', '2')),
+    max_limit=int(os.getenv('UPSTREAM_LIMIT_MAX', '32')),
+    tolerance=float(os.getenv('UPSTREAM_LATENCY_TOLERANCE', '2.0')),
+) if UPSTREAM_LIMITER_ENABLED else None
+# Longest a request waits for a slot before it is shed.
+UPSTREAM_QUEUE_TIMEOUT = float(os.getenv('UPSTREAM_QUEUE_TIMEOUT', '10'))
+# Share of the limit in use from which full answers get fewer tokens.
+UPSTREAM_DEGRADE_AT = float(os.getenv('UPSTREAM_DEGRADE_AT', '0.75'))
+DEGRADED_FULL_MAX_TOKENS = int(os.getenv('DEGRADED_FULL_MAX_TOKENS', '1500'))
+UPSTREAM_OVERLOAD_TEXT = (
+    "⏳ Сейчас слишком много запросов к модели. "
+    "Пожалуйста, попробуйте позже — через минуту-другую."
+)
+MINI_APP_OVERLOAD_ERROR = 'Server is busy, please try again later'
+# A new prompt cancels the user's analysis still in progress; /parallel opts a chat out.
+CANCEL_SUPERSEDED_ENABLED = os.getenv('CANCEL_SUPERSEDED_ENABLED', '1') == '1'
+# Seconds a Mini App job keeps generating with no client following it.
+MINI_APP_ORPHAN_GRACE = float(os.getenv('MINI_APP_ORPHAN_GRACE', '30'))
+# Oldest Mini App initData accepted as proof of the user's identity.
+MINI_APP_INIT_DATA_MAX_AGE = int(os.getenv('MINI_APP_INIT_DATA_MAX_AGE', str(24 * 3600)))
+MINI_APP_CANCELLED_ERROR = 'Request cancelled'
+GENERATIONS = GenerationRegistry()
+# Telegram prompts and expansions run on at most this many worker
+# threads; extra ones wait in TELEGRAM_TASKS.
+TELEGRAM_PROMPT_WORKERS = int(os.getenv('TELEGRAM_PROMPT_WORKERS', '32'))
+TELEGRAM_TASKS = queue.Queue()
+TELEGRAM_WORKER_THREADS = []
+TELEGRAM_IDLE_WORKERS = 0
+TELEGRAM_WORKERS_LOCK = threading.Lock()
+PARALLEL_CHATS = {}
+PARALLEL_CHATS_LOCK = threading.Lock()
+
+if TELEGRAM_API_URL:
+    telebot.apihelper.API_URL = TELEGRAM_API_URL
+
+
+class JournaledTeleBot(telebot.TeleBot):
+    """TeleBot that skips already journaled updates and persists the polling offset."""
+
+    def get_updates(self, offset=None, limit=None, timeout=20, allowed_updates=None, long_polling_timeout=20):
+        json_updates = telebot.apihelper.get_updates(
+            self.token, offset=offset, limit=limit, timeout=timeout, allowed_updates=allowed_updates,
+            long_polling_timeout=long_polling_timeout)
+        if TRAFFIC_CAPTURE:
+            for json_update in json_updates:
+                TRAFFIC_CAPTURE.record_update(json_update)
+        return [telebot.types.Update.de_json(json_update) for json_update in json_updates]
+
+    def process_new_updates(self, updates):
+        if not REQUEST_JOURNAL:
+            return super().process_new_updates(updates)
+
+        fresh_updates = []
+        for update in updates:
+            if REQUEST_JOURNAL.accept_update(update.update_id, telegram_job_for_update(update)):
+                fresh_updates.append(update)
+            else:
+                print(f"[LOG] Skipping duplicate update {update.update_id}")
+                self.last_update_id = max(self.last_update_id, update.update_id)
+
+        if fresh_updates:
+            super().process_new_updates(fresh_updates)
+        if updates:
+            REQUEST_JOURNAL.set_last_update_id(max(update.update_id for update in updates))
+
 
 # Рнициализируем бота
-bot = telebot.TeleBot(TELEGRAM_TOKEN, threaded=False)
+bot = JournaledTeleBot(TELEGRAM_TOKEN, threaded=False)
 
 def is_admin(user_id):
     """Проверяет, является ли пользователь администратором"""
     return str(user_id) == ADMIN_ID
 
-def start_cloudflare_tunnel(local_port):
-    """Start free Cloudflare tunnel and return (process, public_url)."""
+def find_cloudflared():
+    """Return path to cloudflared binary or None."""
     cloudflared_path = shutil.which('cloudflared') or shutil.which('cloudflared.exe')
     if not cloudflared_path:
         local_binary = BASE_DIR / 'cloudflared.exe'
         if local_binary.exists():
             cloudflared_path = str(local_binary)
+    return cloudflared_path
+
+
+def publish_mini_app_url(url):
+    """Atomically switch the public Mini App URL and refresh the chat menu button."""
+    global RUNTIME_MINI_APP_URL
+    with RUNTIME_MINI_APP_URL_LOCK:
+        if url == RUNTIME_MINI_APP_URL:
+            return
+        RUNTIME_MINI_APP_URL = url
+        if not url:
+            print('[WARNING] Mini App URL withdrawn until the tunnel is back')
+            return
+        print(f"[LOG] Auto tunnel URL: {url}")
+        try:
+            bot.set_chat_menu_button(
+                menu_button=telebot.types.MenuButtonWebApp(
+                    'web_app',
+                    'Pushkin AI',
+                    telebot.types.WebAppInfo(url=url)
+                )
+            )
+            print('[LOG] Chat menu button updated with new Mini App URL')
+        except Exception as e:
+            print(f"[WARNING] Failed to update chat menu button: {e}")
+
+
+def drain_tunnel_output(process, url_found, recent_lines):
+    """Read cloudflared output until EOF so the pipe never fills up."""
+    try:
+        for line in process.stdout:
+            line = line.strip()
+            if not line:
+                continue
+            recent_lines.append(line)
+            if url_found.is_set():
+                continue
+            match = TUNNEL_URL_PATTERN.search(line)
+            if match:
+                url_found.set()
+                publish_mini_app_url(match.group(0))
+    except Exception as e:
+        print(f"[WARNING] Stopped reading cloudflared output: {e}")
+
+
+def tunnel_is_healthy(url):
+    """Check that the public tunnel still reaches the local Mini App server."""
+    try:
+        response = requests.get(f'{url}/health', timeout=10)
+        return response.status_code == 200
+    except Exception:
+        return False
+
+
+def supervise_cloudflare_tunnel(local_port):
+    """Keep a trycloudflare tunnel alive, restarting it when it dies or stalls."""
+    global MINI_APP_TUNNEL_PROCESS
+    cloudflared_path = find_cloudflared()
     if not cloudflared_path:
         print('[WARNING] cloudflared is not installed. Mini App auto-tunnel is unavailable.')
-        return None, None
+        return
 
     command = [
         cloudflared_path,
@@ -75,57 +295,84 @@ def start_cloudflare_tunnel(local_port):
         f'http://127.0.0.1:{local_port}',
         '--no-autoupdate'
     ]
+    restart_delay = 5
 
-    try:
-        process = subprocess.Popen(
-            command,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            text=True,
-            encoding='utf-8',
-            errors='replace'
-        )
-    except Exception as e:
-        print(f'[ERROR] Failed to start cloudflared: {e}')
-        return None, None
-
-    pattern = re.compile(r'https://[a-z0-9-]+\.trycloudflare\.com', re.IGNORECASE)
-    deadline = time.time() + max(MINI_APP_TUNNEL_TIMEOUT, 5)
-    recent_lines = []
-
-    while time.time() < deadline:
-        if process.poll() is not None:
-            break
-
-        line = process.stdout.readline()
-        if not line:
-            time.sleep(0.1)
+    while not MINI_APP_TUNNEL_STOP.is_set():
+        try:
+            process = subprocess.Popen(
+                command,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                text=True,
+                encoding='utf-8',
+                errors='replace'
+            )
+        except Exception as e:
+            print(f'[ERROR] Failed to start cloudflared: {e}')
+            MINI_APP_TUNNEL_STOP.wait(restart_delay)
+            restart_delay = min(restart_delay * 2, 300)
             continue
 
-        line = line.strip()
-        if line and len(recent_lines) < 6:
-            recent_lines.append(line)
-
-        match = pattern.search(line)
-        if match:
-            return process, match.group(0)
+        MINI_APP_TUNNEL_PROCESS = process
+        url_found = threading.Event()
+        recent_lines = deque(maxlen=6)
+        threading.Thread(
+            target=drain_tunnel_output,
+            args=(process, url_found, recent_lines),
+            name='cloudflared-output',
+            daemon=True
+        ).start()
+
+        if not url_found.wait(max(MINI_APP_TUNNEL_TIMEOUT, 5)) and process.poll() is None:
+            print('[WARNING] Could not get trycloudflare URL in time, restarting tunnel.')
+            process.terminate()
+
+        failed_checks = 0
+        while process.poll() is None and not MINI_APP_TUNNEL_STOP.is_set():
+            try:
+                process.wait(timeout=MINI_APP_TUNNEL_HEALTH_INTERVAL)
+                break
+            except subprocess.TimeoutExpired:
+                pass
+            url = RUNTIME_MINI_APP_URL
+            if not url_found.is_set() or tunnel_is_healthy(url):
+                failed_checks = 0
+                continue
+            failed_checks += 1
+            print(f'[WARNING] Tunnel health check failed ({failed_checks}/3): {url}')
+            if failed_checks >= 3:
+                process.terminate()
 
-    try:
-        process.terminate()
-    except Exception:
-        pass
+        if MINI_APP_TUNNEL_STOP.is_set():
+            break
 
-    if recent_lines:
-        print('[WARNING] cloudflared output before timeout:')
+        if url_found.is_set():
+            restart_delay = 5
+        publish_mini_app_url(MINI_APP_URL)
+        print(f'[WARNING] cloudflared exited with code {process.poll()}, restarting in {restart_delay}s')
         for logged_line in recent_lines:
             print(f'  {logged_line}')
-    print('[WARNING] Could not get trycloudflare URL in time.')
-    return None, None
+        MINI_APP_TUNNEL_STOP.wait(restart_delay)
+        restart_delay = min(restart_delay * 2, 300)
+
+
+def start_cloudflare_tunnel(local_port):
+    """Start tunnel supervisor in background; the URL is published when it arrives."""
+    MINI_APP_TUNNEL_STOP.clear()
+    supervisor = threading.Thread(
+        target=supervise_cloudflare_tunnel,
+        args=(local_port,),
+        name='cloudflared-supervisor',
+        daemon=True
+    )
+    supervisor.start()
+    return supervisor
 
 
 def stop_mini_app_tunnel():
     """Gracefully stop cloudflared process if it is running."""
     global MINI_APP_TUNNEL_PROCESS
+    MINI_APP_TUNNEL_STOP.set()
     if not MINI_APP_TUNNEL_PROCESS:
         return
 
@@ -444,9 +691,22 @@ class MiniAppRequestHandler(BaseHTTPRequestHandler):
             return
 
         if path == '/health':
-            self._send_json(200, {'status': 'ok'})
+            payload = {'status': 'ok'}
+            if UPSTREAM_LIMITER:
+                stats = UPSTREAM_LIMITER.stats()
+                payload['upstream'] = {key: stats[key] for key in ('limit', 'inflight', 'throttled', 'rejected')}
+            self._send_json(200, payload)
             return
 
+        if path.startswith('/api/jobs/'):
+            parts = path[len('/api/jobs/'):].split('/')
+            if len(parts) == 1 and parts[0]:
+                self._send_job_status(parts[0])
+                return
+            if len(parts) == 2 and parts[0] and parts[1] == 'events':
+                self._stream_job_events(parts[0])
+                return
+
         allowed_ext = {'.css', '.js', '.png', '.jpg', '.jpeg', '.svg', '.webp', '.ico'}
         requested = (BASE_DIR / path.lstrip('/')).resolve()
 
@@ -456,35 +716,143 @@ class MiniAppRequestHandler(BaseHTTPRequestHandler):
 
         self.send_error(404, 'Not Found')
 
+    def _read_chat_payload(self):
+        """Parse and validate chat request body; returns (message, history) or None after replying."""
+        content_length = int(self.headers.get('Content-Length', '0'))
+        if content_length <= 0 or content_length > 100000:
+            self._send_json(400, {'error': 'Invalid request size'})
+            return None
+
+        raw = self.rfile.read(content_length)
+        payload = json.loads(raw.decode('utf-8'))
+        message = str(payload.get('message', '')).strip()
+        history = payload.get('history', [])
+        if not isinstance(history, list):
+            history = []
+
+        if len(message) < 3:
+            self._send_json(400, {'error': 'Please enter a longer prompt'})
+            return None
+
+        # The user id the client reports is only trusted for usage
+        # accounting; cancelling a user's older jobs needs initData signed
+        # by Telegram for this bot.
+        verified_user = verify_init_data(payload.get('init_data'), TELEGRAM_TOKEN, max_age=MINI_APP_INIT_DATA_MAX_AGE)
+        if verified_user:
+            user_id = verified_user['id']
+        else:
+            user_id = payload.get('user_id')
+            user_id = int(user_id) if isinstance(user_id, int) or str(user_id).isdigit() else None
+
+        # 'summary' asks for the short first tier; 'full' with the summary
+        # attached expands it into the complete analysis.
+        mode = 'summary' if payload.get('mode') == 'summary' and TIERED_ANSWERS_ENABLED else 'full'
+        summary = str(payload.get('summary') or '').strip()[:4000] or None
+        return message, history, user_id, bool(verified_user), mode, summary
+
     def do_POST(self):
-        if self.path.split('?', 1)[0] != '/api/chat':
+        path = self.path.split('?', 1)[0]
+        if path not in ('/api/chat', '/api/jobs'):
             self.send_error(404, 'Not Found')
             return
 
         try:
-            content_length = int(self.headers.get('Content-Length', '0'))
-            if content_length <= 0 or content_length > 100000:
-                self._send_json(400, {'error': 'Invalid request size'})
+            parsed = self._read_chat_payload()
+            if parsed is None:
+                return
+            message, history, user_id, verified, mode, summary = parsed
+            if TRAFFIC_CAPTURE:
+                TRAFFIC_CAPTURE.record_http(path, {
+                    'message': message, 'history': history, 'user_id': user_id, 'mode': mode, 'summary': summary,
+                })
+
+            job = submit_miniapp_job(message, history, user_id=user_id, mode=mode, summary=summary, verified=verified)
+            if job is None:
+                self._send_json(503, {'error': MINI_APP_OVERLOAD_ERROR})
                 return
 
-            raw = self.rfile.read(content_length)
-            payload = json.loads(raw.decode('utf-8'))
-            message = str(payload.get('message', '')).strip()
-            history = payload.get('history', [])
-            if not isinstance(history, list):
-                history = []
-
-            if len(message) < 3:
-                self._send_json(400, {'error': 'Please enter a longer prompt'})
+            if path == '/api/jobs':
+                self._send_json(202, {'job_id': job.job_id, 'status': job.status, 'mode': job.mode})
                 return
 
-            reply = get_answer(message, history=history)
-            self._send_json(200, {'reply': reply})
+            job.attach()
+            try:
+                while not job.wait(1.0):
+                    if self._client_disconnected():
+                        print(f"[LOG] Mini App client disconnected from job {job.job_id}")
+                        return
+            finally:
+                job.detach()
+            if job.error:
+                status = {MINI_APP_OVERLOAD_ERROR: 503, MINI_APP_CANCELLED_ERROR: 409}.get(job.error, 500)
+                self._send_json(status, {'error': job.error})
+                return
+            self._send_json(200, {'reply': job.reply})
 
         except Exception as e:
             print(f"[ERROR] Mini App API error: {e}")
             self._send_json(500, {'error': 'Server error while processing request'})
 
+    def _client_disconnected(self):
+        """True once the client closed the connection of a request still in progress."""
+        try:
+            readable, _, _ = select.select([self.connection], [], [], 0)
+            return bool(readable) and not self.connection.recv(1, socket.MSG_PEEK)
+        except (OSError, ValueError):
+            return True
+
+    def _send_job_status(self, job_id):
+        job = MINI_APP_JOBS.get(job_id)
+        if job:
+            job.touch()
+            self._send_json(200, job.to_dict())
+            return
+
+        journaled = REQUEST_JOURNAL.get_job(job_id) if REQUEST_JOURNAL else None
+        if journaled and journaled['origin'] == 'miniapp' and journaled['state'] == JOB_DONE:
+            self._send_json(200, {'job_id': job_id, 'status': 'done', 'reply': journaled['result']})
+            return
+        self._send_json(404, {'error': 'Job not found'})
+
+    def _write_event(self, event, data, event_id=None):
+        chunk = ''
+        if event_id is not None:
+            chunk += f'id: {event_id}\n'
+        chunk += f'event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n'
+        self.wfile.write(chunk.encode('utf-8'))
+        self.wfile.flush()
+
+    def _stream_job_events(self, job_id):
+        """Stream job tokens as Server-Sent Events, resuming after Last-Event-ID."""
+        job = MINI_APP_JOBS.get(job_id)
+        if not job:
+            self._send_job_status(job_id)
+            return
+
+        query = self.path.split('?', 1)[1] if '?' in self.path else ''
+        offset = resume_offset(self.headers.get('Last-Event-ID'), query)
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream; charset=utf-8')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('X-Accel-Buffering', 'no')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+
+        job.attach()
+        try:
+            self.wfile.write(b'retry: 2000\n\n')
+            for event, data, event_id in job_events(job, offset, SSE_HEARTBEAT_SECONDS):
+                if event is None:
+                    self.wfile.write(b': ping\n\n')
+                    self.wfile.flush()
+                    continue
+                self._write_event(event, data, event_id=event_id)
+        except (BrokenPipeError, ConnectionResetError):
+            print(f"[LOG] SSE client disconnected from job {job_id}")
+        finally:
+            job.detach()
+
 
 def start_mini_app_server():
     """Run the embedded Mini App HTTP server in a background thread."""
@@ -505,7 +873,92 @@ def start_mini_app_server():
 def start_handler(message):
     """Handler for /start and /help commands."""
     print(f"[LOG] /start from user {message.from_user.id}")
-    send_start_message_with_mini_app(message.chat.id)
+    parts = str(message.text or '').split(maxsplit=1)
+    prompt = prompt_from_start_parameter(parts[1]) if len(parts) > 1 else None
+    if not prompt:
+        send_start_message_with_mini_app(message.chat.id)
+        return
+
+    # Deep link from inline mode: answer the work right away.
+    print(f"[LOG] Deep link from user {message.from_user.id}: {prompt[:50]}...")
+    job_id = None
+    if REQUEST_JOURNAL:
+        job_id = telegram_job_id(message)
+        REQUEST_JOURNAL.create_job(job_id, 'telegram', prompt, message.chat.id, message.from_user.id)
+    start_telegram_prompt(message.chat.id, message.from_user.id, prompt, job_id=job_id)
+
+
+def inline_start_parameter(query):
+    """Encode a free-text query as a /start payload (A-Z, a-z, 0-9, _ and -, at most 64 chars)."""
+    # cp1251 keeps Cyrillic at one byte per letter, so ~45 letters fit.
+    data = query.strip().encode('cp1251', errors='ignore')[:45]
+    return 'q_' + base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+
+def prompt_from_start_parameter(parameter):
+    """Turn a /start payload from inline mode back into a prompt, or None."""
+    try:
+        if parameter.startswith('w_') and INLINE_INDEX:
+            work = INLINE_INDEX.document(int(parameter[2:]))
+            return f"{work['title']}, {work['author']}"
+        if parameter.startswith('q_'):
+            data = parameter[2:]
+            return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4)).decode('cp1251').strip() or None
+    except Exception as e:
+        print(f"[WARNING] Bad /start payload {parameter!r}: {e}")
+    return None
+
+
+def build_inline_result(work):
+    """Inline article with a precomputed analysis as plain text."""
+    header = f"{work['title']} — {work['author']}"
+    text = f"{header}\n\n{work['text']}"
+    if len(text) > 4096:
+        text = text[:4095] + '…'
+    description = work['text'].split('\n', 1)[0].lstrip('• ')
+
+    markup = None
+    if BOT_USERNAME:
+        markup = telebot.types.InlineKeyboardMarkup()
+        markup.add(telebot.types.InlineKeyboardButton(
+            text="Открыть полный анализ",
+            url=f"https://t.me/{BOT_USERNAME}?start=w_{work['id']}"
+        ))
+    return telebot.types.InlineQueryResultArticle(
+        id=str(work['id']),
+        title=header,
+        description=description[:200],
+        input_message_content=telebot.types.InputTextMessageContent(text),
+        reply_markup=markup
+    )
+
+
+@bot.inline_handler(func=lambda query: True)
+def inline_query_handler(query):
+    """Answer inline queries from the precomputed index only; never calls the model."""
+    text = str(query.query or '').strip()
+    results = []
+    if INLINE_INDEX:
+        if text:
+            works = INLINE_INDEX.search(text, limit=INLINE_RESULTS_LIMIT)
+        else:
+            works = [INLINE_INDEX.document(doc_id) for doc_id in range(min(len(INLINE_INDEX), INLINE_RESULTS_LIMIT))]
+        results = [build_inline_result(work) for work in works]
+
+    # Works missing from the index open a full analysis in the bot chat.
+    button = telebot.types.InlineQueryResultsButton(
+        text="Открыть полный анализ" if text else "Открыть Pushkin AI",
+        start_parameter=inline_start_parameter(text) if text else 'inline'
+    )
+    try:
+        bot.answer_inline_query(
+            query.id,
+            results,
+            cache_time=INLINE_CACHE_TIME,
+            button=button
+        )
+    except Exception as e:
+        print(f"[ERROR] Failed to answer inline query: {e}")
 
 @bot.message_handler(commands=["reset"])
 def reset_handler(message):
@@ -662,6 +1115,24 @@ def about_handler(message):
     
     bot.send_message(message.chat.id, about_text, parse_mode='HTML')
 
+@bot.message_handler(commands=["parallel"])
+def parallel_handler(message):
+    """Переключает отмену незавершенного анализа при новом запросе в этом чате"""
+    chat_id = message.chat.id
+    if not CANCEL_SUPERSEDED_ENABLED:
+        bot.send_message(chat_id, "Все запросы уже выполняются параллельно.")
+        return
+
+    allowed = not chat_allows_parallel(chat_id)
+    set_chat_parallel(chat_id, allowed)
+    if allowed:
+        text = ("✅ Параллельные запросы включены: новое сообщение не отменяет анализ, "
+                "который еще готовится.\n\nВыключить: /parallel")
+    else:
+        text = ("✅ Параллельные запросы выключены: новое сообщение отменяет незавершенный анализ, "
+                "и вы получите ответ только на последний запрос.\n\nВключить: /parallel")
+    bot.send_message(chat_id, text)
+
 @bot.message_handler(commands=["admin"])
 def admin_handler(message):
     """Показывает информацию об административных командах"""
@@ -679,6 +1150,9 @@ def admin_handler(message):
 <b>Доступные команды:</b>
 • /reset - Сбросить и перезапустить бота
 • /status - Показать статус системы
+• /stats &lt;часы&gt; - Токены, задержки и топ пользователей
+• /profile &lt;сек&gt; - Профиль потоков: горячие пути и заблокированные (wall-clock)
+• /memprofile &lt;сек&gt; - Разница снимков памяти (tracemalloc)
 • /logs - Показать последние логи
 
 <b>Рнформация Рѕ системе:</b>
@@ -688,6 +1162,65 @@ def admin_handler(message):
     
     bot.send_message(message.chat.id, admin_text, parse_mode='HTML')
 
+def format_cache_status():
+    """Semantic cache summary line for /status."""
+    if SEMANTIC_CACHE is None:
+        return "\n<b>Кэш ответов:</b> выключен\n"
+    stats = SEMANTIC_CACHE.stats()
+    return (
+        f"\n<b>Кэш ответов:</b>\n"
+        f"• Записей: {stats['entries']} ({stats['bytes'] / 1024 / 1024:.1f} MB)\n"
+        f"• Попадания: {stats['hits']} из {stats['hits'] + stats['misses']} ({stats['hit_rate'] * 100:.1f}%)\n"
+        f"• Вытеснено: {stats['evictions']}\n"
+    ) + format_prefetch_status()
+
+
+def format_limiter_status():
+    """Upstream concurrency limiter summary for /status."""
+    if UPSTREAM_LIMITER is None:
+        return "\n<b>Лимит запросов к модели:</b> выключен\n"
+    stats = UPSTREAM_LIMITER.stats()
+    baselines = ', '.join(
+        f"{kind}: {value:.0f} мс/токен" if kind.endswith(':per_token') else f"{kind}: {value / 1000:.1f} сек."
+        for kind, value in sorted(stats['baseline_ms'].items()) if value
+    ) or '—'
+    return (
+        f"\n<b>Лимит запросов к модели:</b>\n"
+        f"• Лимит: {stats['limit']}, выполняется: {stats['inflight']}\n"
+        f"• Ожидали слот: {stats['throttled']}, отклонено: {stats['rejected']}\n"
+        f"• Рост/снижение лимита: {stats['increases']}/{stats['decreases']}\n"
+        f"• Базовая задержка: {baselines}\n"
+    )
+
+
+def format_generation_status():
+    """Superseded and abandoned generations for /status: what cancelling saved."""
+    stats = GENERATIONS.stats()
+    reasons = ', '.join(f"{reason}: {count}" for reason, count in sorted(stats['cancelled'].items())) or '—'
+    return (
+        f"\n<b>Отмена устаревших запросов:</b> {'включена' if CANCEL_SUPERSEDED_ENABLED else 'выключена'}\n"
+        f"• Выполняется: {stats['active']} (сессий: {stats['sessions']})\n"
+        f"• Отменено: {sum(stats['cancelled'].values())} ({reasons})\n"
+        f"• Токенов до отмены: {stats['prompt_tokens']} prompt / {stats['completion_tokens']} completion\n"
+    )
+
+
+def format_prefetch_status():
+    """Prefetcher summary for /status: spend versus hits on prefetched answers."""
+    if PREFETCHER is None:
+        return ""
+    stats = PREFETCHER.stats()
+    saved = stats['latency_saved_ms'] / stats['hits'] / 1000 if stats['hits'] else 0
+    return (
+        f"\n<b>Предзагрузка:</b>\n"
+        f"• Готово: {stats['prefetched']}, в очереди: {stats['queued']}, "
+        f"отменено: {stats['cancelled']}, ошибок: {stats['failed']}\n"
+        f"• Использовано: {stats['used_entries']} из {stats['prefetched']} ({stats['hit_rate'] * 100:.1f}%), "
+        f"попаданий: {stats['hits']}\n"
+        f"• Токенов: {stats['tokens']} ({stats['tokens_per_hit']:.0f} на попадание)\n"
+        f"• Сэкономлено ожидания: {saved:.1f} сек. на попадание\n"
+    )
+
 @bot.message_handler(commands=["status"])
 def status_handler(message):
     """Показывает статус системы"""
@@ -721,7 +1254,7 @@ def status_handler(message):
 <b>Процессы:</b>
 • Бот: ✅ запущен
 • Подключение к API: ✅ активно
-"""
+{format_cache_status()}{format_limiter_status()}{format_generation_status()}"""
         
         bot.send_message(message.chat.id, status_text, parse_mode='HTML')
         
@@ -741,27 +1274,315 @@ def status_handler(message):
             parse_mode='HTML'
         )
 
+def format_usage_stats(hours):
+    """Render usage ledger summary for /stats."""
+    since = time.time() - hours * 3600
+    summary = summarize_usage(USAGE_LEDGER.read(since))
+    latency = summary['latency_ms']
+    statuses = ', '.join(f"{name}: {count}" for name, count in sorted(summary['by_status'].items())) or '—'
+    origins = ', '.join(f"{name}: {count}" for name, count in sorted(summary['by_origin'].items())) or '—'
+
+    lines = [
+        f"<b>📈 Использование за {hours:g} ч.</b>",
+        "",
+        f"<i>Запросы:</i> {summary['requests']} (к модели: {summary['upstream_calls']})",
+        f"<i>Источник:</i> {origins}",
+        f"<i>Статус кэша:</i> {statuses}",
+        f"<i>Токены:</i> {summary['prompt_tokens']} prompt / {summary['completion_tokens']} completion",
+        f"<i>Ответ модели, токены:</i> p50 {summary['completion_tokens_p50']}, p99 {summary['completion_tokens_p99']}",
+        f"<i>Задержка модели:</i> p50 {latency[50] / 1000:.1f}s, p90 {latency[90] / 1000:.1f}s, p99 {latency[99] / 1000:.1f}s",
+    ]
+
+    if summary['prompt_tokens_by_history']:
+        lines += ["", "<b>Prompt-токены по длине истории:</b>"]
+        for bucket, average in summary['prompt_tokens_by_history'].items():
+            lines.append(f"• {bucket} сообщ.: {average:.0f}")
+
+    if summary['top_users']:
+        lines += ["", "<b>Топ пользователей:</b>"]
+        for user_id, (requests_count, tokens) in summary['top_users']:
+            label = user_id if user_id else 'Mini App (аноним)'
+            lines.append(f"• <code>{label}</code>: {tokens} ток., {requests_count} запр.")
+
+    if summary['tokens_per_hour']:
+        lines += ["", "<b>Токены по часам (UTC):</b>"]
+        for hour_ts, tokens in summary['tokens_per_hour'][-24:]:
+            lines.append(f"• {time.strftime('%m-%d %H:00', time.gmtime(hour_ts))}: {tokens}")
+
+    if hours > 24:
+        daily = {}
+        for hour_ts, totals in USAGE_LEDGER.read_rollups(since):
+            day = time.strftime('%Y-%m-%d', time.gmtime(hour_ts))
+            daily[day] = daily.get(day, 0) + totals.get('prompt_tokens', 0) + totals.get('completion_tokens', 0)
+        if daily:
+            lines += ["", "<b>Токены по дням (сводки):</b>"]
+            for day, tokens in sorted(daily.items()):
+                lines.append(f"• {day}: {tokens}")
+
+    return '\n'.join(lines)
+
+
+@bot.message_handler(commands=["stats"])
+def stats_handler(message):
+    """Статистика использования токенов (только для администратора)"""
+    user_id = message.from_user.id
+
+    if not is_admin(user_id):
+        bot.send_message(message.chat.id, "⛔ У вас нет прав для просмотра статистики.")
+        return
+
+    if not USAGE_LEDGER:
+        bot.send_message(message.chat.id, "Учет использования выключен (USAGE_LEDGER_ENABLED=0).")
+        return
+
+    parts = str(message.text or '').split()
+    try:
+        hours = float(parts[1]) if len(parts) > 1 else 24
+    except ValueError:
+        hours = 24
+    hours = min(max(hours, 1), 24 * 90)
+
+    try:
+        bot.send_message(message.chat.id, format_usage_stats(hours)[:4000], parse_mode='HTML')
+    except Exception as e:
+        bot.send_message(
+            message.chat.id,
+            f"<b>❌ Ошибка при получении статистики:</b>\n\n<code>{str(e)[:200]}</code>",
+            parse_mode='HTML'
+        )
+
+
+def parse_profile_seconds(message, default):
+    """Read optional duration argument of profiling commands."""
+    parts = str(message.text or '').split()
+    try:
+        seconds = float(parts[1]) if len(parts) > 1 else default
+    except ValueError:
+        seconds = default
+    return min(max(seconds, 1), PROFILE_MAX_SECONDS)
+
+
+def run_profile_command(message, title, file_prefix, collect):
+    """Run profiler in background thread and send the report as a document."""
+    chat_id = message.chat.id
+    user_id = message.from_user.id
+
+    if not is_admin(user_id):
+        print(f"[SECURITY] Неавторизованная попытка профилирования от пользователя {user_id}")
+        bot.send_message(chat_id, "⛔ У вас нет прав для выполнения этой команды.")
+        return
+
+    if not PROFILE_LOCK.acquire(blocking=False):
+        bot.send_message(chat_id, "⏳ Профилирование уже выполняется, дождитесь результата.")
+        return
+
+    seconds = parse_profile_seconds(message, 10)
+    bot.send_message(chat_id, f"🔬 <i>{title}: {seconds:.0f} сек...</i>", parse_mode='HTML')
+    print(f"[ADMIN] {title} на {seconds:.0f} сек. запрошен пользователем {user_id}")
+
+    def worker():
+        try:
+            report = collect(seconds)
+            document = BytesIO(report.encode('utf-8'))
+            file_name = f"{file_prefix}-{time.strftime('%Y%m%d-%H%M%S')}.txt"
+            bot.send_document(chat_id, document, visible_file_name=file_name, caption=title)
+        except Exception as e:
+            print(f"[ERROR] Ошибка профилирования: {e}")
+            try:
+                bot.send_message(chat_id, f"<b>❌ Ошибка профилирования:</b>\n\n<code>{str(e)[:200]}</code>", parse_mode='HTML')
+            except Exception:
+                pass
+        finally:
+            PROFILE_LOCK.release()
+
+    threading.Thread(target=worker, name='admin-profiler', daemon=True).start()
+
+
+@bot.message_handler(commands=["profile"])
+def profile_handler(message):
+    """Профиль потоков (работающих и заблокированных) за заданное число секунд (только для администратора)"""
+    run_profile_command(message, 'Профиль потоков (wall-clock)', 'wall-profile', profiler.sample_stacks)
+
+
+@bot.message_handler(commands=["memprofile"])
+def memprofile_handler(message):
+    """Разница снимков tracemalloc за заданное число секунд (только для администратора)"""
+    run_profile_command(message, 'Профиль памяти', 'mem-profile', profiler.tracemalloc_diff)
+
 @bot.message_handler(func=lambda message: True)
 def text_handler(message):
     """Обработчик всех текстовых сообщений"""
-    try:
-        user_id = message.from_user.id
-        chat_id = message.chat.id
-        prompt = str(message.text)
-        
-        print(f"[LOG] Получен запрос от пользователя {user_id}: {prompt[:50]}...")
-        
-        if len(prompt) < 5:
+    user_id = message.from_user.id
+    chat_id = message.chat.id
+    prompt = str(message.text)
+    job_id = telegram_job_id(message)
+
+    print(f"[LOG] Получен запрос от пользователя {user_id}: {prompt[:50]}...")
+
+    if len(prompt) < 5:
+        try:
             bot.send_message(
                 chat_id, 
                 "Пожалуйста, укажите полное название произведения и автора для анализа.\n\n" +
                 "<i>Пример:</i> 'Война и мир, Лев Толстой'",
                 parse_mode='HTML'
             )
-            return
-        
+        finally:
+            if REQUEST_JOURNAL:
+                REQUEST_JOURNAL.mark_done(job_id)
+        return
+
+    start_telegram_prompt(chat_id, user_id, prompt, job_id=job_id)
+
+
+def telegram_session(chat_id, user_id):
+    """Generation session of a user in a chat; group members don't cancel each other."""
+    return f'tg:{chat_id}:{user_id}'
+
+
+def chat_allows_parallel(chat_id):
+    """True when a new prompt in the chat leaves earlier analyses running (/parallel)."""
+    if not CANCEL_SUPERSEDED_ENABLED:
+        return True
+    with PARALLEL_CHATS_LOCK:
+        if chat_id in PARALLEL_CHATS:
+            return PARALLEL_CHATS[chat_id]
+    allowed = bool(REQUEST_JOURNAL and REQUEST_JOURNAL.get_meta(f'parallel:{chat_id}') == '1')
+    with PARALLEL_CHATS_LOCK:
+        return PARALLEL_CHATS.setdefault(chat_id, allowed)
+
+
+def set_chat_parallel(chat_id, allowed):
+    """Persist the /parallel choice of a chat."""
+    with PARALLEL_CHATS_LOCK:
+        PARALLEL_CHATS[chat_id] = allowed
+    if REQUEST_JOURNAL:
+        REQUEST_JOURNAL.set_meta(f'parallel:{chat_id}', '1' if allowed else '0')
+
+
+def begin_chat_generation(chat_id, user_id, supersede=True):
+    """Register a new generation of the user, cancelling their older ones unless the chat opted out."""
+    cancel = CancelToken()
+    superseded = GENERATIONS.start(
+        telegram_session(chat_id, user_id),
+        cancel,
+        supersede=supersede and not chat_allows_parallel(chat_id)
+    )
+    if superseded:
+        print(f"[LOG] New request in chat {chat_id} cancelled {superseded} analysis(es) in progress")
+    return cancel
+
+
+def start_telegram_prompt(chat_id, user_id, prompt, job_id=None):
+    """Answer a prompt on a worker thread so that a newer prompt can cancel it.
+
+    The generation is registered here, in the polling thread, so prompts
+    supersede each other in message order.
+    """
+    cancel = begin_chat_generation(chat_id, user_id)
+    submit_telegram_task(process_telegram_prompt, chat_id, user_id, prompt, job_id=job_id, cancel=cancel)
+
+
+def submit_telegram_task(target, *args, **kwargs):
+    """Queue target for the Telegram worker threads, starting one if all are busy."""
+    TELEGRAM_TASKS.put((target, args, kwargs))
+    with TELEGRAM_WORKERS_LOCK:
+        busy = TELEGRAM_TASKS.qsize() > TELEGRAM_IDLE_WORKERS
+        if busy and len(TELEGRAM_WORKER_THREADS) < TELEGRAM_PROMPT_WORKERS:
+            # Daemon threads, like before: a restart must not wait for
+            # answers the journal resumes anyway.
+            thread = threading.Thread(
+                target=telegram_worker,
+                name=f'tg-worker-{len(TELEGRAM_WORKER_THREADS) + 1}',
+                daemon=True
+            )
+            TELEGRAM_WORKER_THREADS.append(thread)
+            thread.start()
+
+
+def telegram_worker():
+    global TELEGRAM_IDLE_WORKERS
+    while True:
+        with TELEGRAM_WORKERS_LOCK:
+            TELEGRAM_IDLE_WORKERS += 1
+        target, args, kwargs = TELEGRAM_TASKS.get()
+        with TELEGRAM_WORKERS_LOCK:
+            TELEGRAM_IDLE_WORKERS -= 1
+        try:
+            target(*args, **kwargs)
+        except Exception as e:
+            print(f"[ERROR] Telegram task failed: {e}")
+
+
+def process_telegram_prompt(chat_id, user_id, prompt, job_id=None, cancel=None):
+    """Generate analysis for a Telegram prompt and deliver it to the chat."""
+    if cancel is None:
+        # Resumed jobs must not cancel prompts sent after the restart.
+        cancel = begin_chat_generation(chat_id, user_id, supersede=False)
+    if REQUEST_JOURNAL and job_id:
+        REQUEST_JOURNAL.mark_running(job_id)
+
+    # The "Подробнее" button finds the prompt and summary in the journal.
+    mode = 'summary' if TIERED_ANSWERS_ENABLED and REQUEST_JOURNAL and job_id else 'full'
+    try:
+        # Superseded while waiting for a worker.
+        cancel.check()
+        response = deliver_telegram_answer(
+            chat_id,
+            user_id,
+            lambda: answer_prompt(
+                prompt,
+                origin='telegram',
+                user_id=user_id,
+                mode=mode,
+                session=f'tg:{chat_id}',
+                cancel=cancel
+            ),
+            expand_job_id=job_id if mode == 'summary' else None,
+            cancel=cancel
+        )
+        if REQUEST_JOURNAL and job_id:
+            REQUEST_JOURNAL.mark_done(job_id, response)
+    except GenerationCancelled as e:
+        if REQUEST_JOURNAL and job_id:
+            REQUEST_JOURNAL.mark_failed(job_id, f'cancelled: {e.reason}')
+    except Exception as e:
+        if REQUEST_JOURNAL and job_id:
+            REQUEST_JOURNAL.mark_failed(job_id, e)
+    finally:
+        GENERATIONS.finish(telegram_session(chat_id, user_id), cancel)
+
+
+def split_formatted_answer(formatted_response):
+    """Split formatted answer into Telegram-sized parts on paragraph boundaries."""
+    if len(formatted_response) <= 4000:
+        return [formatted_response]
+
+    parts = []
+    current_part = ""
+
+    for paragraph in formatted_response.split('\n\n'):
+        if len(current_part) + len(paragraph) + 2 < 4000:
+            current_part += paragraph + '\n\n'
+        else:
+            parts.append(current_part)
+            current_part = paragraph + '\n\n'
+
+    if current_part:
+        parts.append(current_part)
+    return parts
+
+
+def deliver_telegram_answer(chat_id, user_id, generate, expand_job_id=None,
+                            status_text="🔄 <i>Анализирую произведение...</i>", cancel=None):
+    """Show progress, run generate() and send its formatted result to the chat.
+
+    Returns the raw response; errors are reported to the user and re-raised.
+    A cancelled generation only removes the status message.
+    """
+    try:
         # Отправляем сообщение о начале обработки
-        status_msg = bot.send_message(chat_id, "🔄 <i>Анализирую произведение...</i>", parse_mode='HTML')
+        status_msg = bot.send_message(chat_id, status_text, parse_mode='HTML')
         status_message_id = status_msg.message_id
         
         # Показываем индикатор печати каждые 5 секунд
@@ -774,73 +1595,53 @@ def text_handler(message):
                     break
         
         # Запускаем индикатор печати в отдельном потоке
-        import threading
         typing_thread = threading.Thread(target=show_typing_indicator)
         typing_thread.daemon = True
         typing_thread.start()
         
         try:
             # Получаем ответ от нейросети
-            response = get_answer(prompt)
+            response = generate()
             
             # Останавливаем индикатор печати
             show_typing_indicator.stop = True
             typing_thread.join(timeout=1)
+
+            # Ответ устарел, пока генерировался: пользователь уже ждет новый
+            if cancel is not None:
+                cancel.check()
             
             # Форматируем ответ
             formatted_response = format_ai_response(response)
+            parts = split_formatted_answer(formatted_response)
             
-            # Проверяем длину ответа
-            if len(formatted_response) > 4000:
-                # Разбиваем на части
-                parts = []
-                current_part = ""
-                
-                for paragraph in formatted_response.split('\n\n'):
-                    if len(current_part) + len(paragraph) + 2 < 4000:
-                        current_part += paragraph + '\n\n'
-                    else:
-                        parts.append(current_part)
-                        current_part = paragraph + '\n\n'
-                
-                if current_part:
-                    parts.append(current_part)
-                
-                # Удаляем статусное сообщение
-                try:
-                    bot.delete_message(chat_id, status_message_id)
-                except:
-                    pass
-                
-                # Отправляем первую часть
-                first_part = parts[0]
-                if len(first_part) > 4000:
-                    first_part = first_part[:4000]
-                
-                sent_msg = bot.send_message(chat_id, first_part, parse_mode='HTML')
-                last_message_id = sent_msg.message_id
-                
-                # Отправляем остальные части как отдельные сообщения
-                for i, part in enumerate(parts[1:], 1):
-                    if len(part) > 4000:
-                        part = part[:4000]
-                    
-                    # Добавляем номер части
-                    part_with_number = f"<b>Часть {i+1}</b>\n\n{part}"
-                    sent_msg = bot.send_message(chat_id, part_with_number, parse_mode='HTML')
-                    last_message_id = sent_msg.message_id
-                    
-            else:
-                # Удаляем статусное сообщение
-                try:
-                    bot.delete_message(chat_id, status_message_id)
-                except:
-                    pass
+            # Удаляем статусное сообщение
+            try:
+                bot.delete_message(chat_id, status_message_id)
+            except:
+                pass
+
+            # Кнопка "Подробнее" под последней частью краткого ответа
+            reply_markup = None
+            if expand_job_id and response != OFFTOPIC_REFUSAL_TEXT and not looks_like_refusal(response):
+                reply_markup = build_expand_markup(expand_job_id)
+            
+            for i, part in enumerate(parts):
+                if len(part) > 4000:
+                    part = part[:4000]
                 
-                # Отправляем форматированный ответ
-                bot.send_message(chat_id, formatted_response, parse_mode='HTML')
+                # Добавляем номер части
+                if i > 0:
+                    part = f"<b>Часть {i+1}</b>\n\n{part}"
+                bot.send_message(
+                    chat_id,
+                    part,
+                    parse_mode='HTML',
+                    reply_markup=reply_markup if i == len(parts) - 1 else None
+                )
             
             print(f'[LOG] Ответ успешно отправлен пользователю {user_id}, длина: {len(response)} символов')
+            return response
             
         except Exception as e:
             # Останавливаем индикатор печати
@@ -852,11 +1653,24 @@ def text_handler(message):
             except:
                 pass
             
+            if isinstance(e, GenerationCancelled):
+                raise
+            if isinstance(e, UpstreamOverloaded):
+                bot.send_message(chat_id, UPSTREAM_OVERLOAD_TEXT)
+                raise
+
             error_msg = f"Произошла ошибка при анализе произведения:\n\n<code>{str(e)[:200]}</code>"
-            bot.send_message(chat_id, error_msg, parse_mode='HTML')
             print(f"[ERROR] Ошибка при обработке запроса: {e}")
+            # Помечаем ошибку, чтобы внешний обработчик не отправил второе сообщение
+            e.reported_to_user = True
+            bot.send_message(chat_id, error_msg, parse_mode='HTML')
+            raise
             
+    except (UpstreamOverloaded, GenerationCancelled):
+        raise
     except Exception as e:
+        if getattr(e, 'reported_to_user', False):
+            raise
         print(f"[ERROR] Критическая ошибка в обработчике: {e}")
         try:
             bot.send_message(
@@ -865,10 +1679,274 @@ def text_handler(message):
             )
         except:
             pass
+        raise
+
+
+def build_expand_markup(job_id):
+    """Inline "Подробнее" button that expands a summary into the full analysis."""
+    markup = telebot.types.InlineKeyboardMarkup()
+    markup.add(telebot.types.InlineKeyboardButton(text="Подробнее", callback_data=f"more:{job_id}"))
+    return markup
+
+
+@bot.callback_query_handler(func=lambda call: str(call.data or '').startswith('more:'))
+def expand_callback_handler(call):
+    """Генерирует полный анализ по кнопке "Подробнее" под кратким ответом"""
+    job_id = call.data[len('more:'):]
+    chat_id = call.message.chat.id
+    user_id = call.from_user.id
+    job = REQUEST_JOURNAL.get_job(job_id) if REQUEST_JOURNAL else None
+
+    if not job or job['state'] != JOB_DONE or not job['result']:
+        bot.answer_callback_query(call.id, "Запрос устарел, отправьте его еще раз.")
+        return
+
+    bot.answer_callback_query(call.id)
+    try:
+        bot.edit_message_reply_markup(chat_id, call.message.message_id, reply_markup=None)
+    except Exception:
+        pass
+
+    print(f"[LOG] Запрошен полный анализ пользователем {user_id}: {job['prompt'][:50]}...")
+    content, history = build_expansion_request(job['prompt'], job['history'], job['result'])
+    cancel = begin_chat_generation(chat_id, user_id)
+
+    def expand():
+        try:
+            cancel.check()
+            deliver_telegram_answer(
+                chat_id,
+                user_id,
+                lambda: answer_prompt(
+                    content,
+                    history=history,
+                    origin='telegram',
+                    user_id=user_id,
+                    mode='full',
+                    cache_prompt=job['prompt'] if not job['history'] else None,
+                    cancel=cancel,
+                    expansion=True
+                ),
+                status_text="🔄 <i>Готовлю подробный анализ...</i>",
+                cancel=cancel
+            )
+        except (UpstreamOverloaded, GenerationCancelled):
+            # Give the button back so the user can retry later.
+            try:
+                bot.edit_message_reply_markup(chat_id, call.message.message_id, reply_markup=build_expand_markup(job_id))
+            except Exception:
+                pass
+        except Exception:
+            pass
+        finally:
+            GENERATIONS.finish(telegram_session(chat_id, user_id), cancel)
+
+    submit_telegram_task(expand)
+
+
+def telegram_job_id(message):
+    """Journal job id of a Telegram message."""
+    return f"tg:{message.chat.id}:{message.message_id}"
 
-def build_literature_messages(content, history=None):
+
+def telegram_job_for_update(update):
+    """Describe the answer job an update creates, or None for commands and non-text updates."""
+    message = update.message
+    if not message or not message.text or message.text.startswith('/'):
+        return None
+    return {
+        'job_id': telegram_job_id(message),
+        'origin': 'telegram',
+        'chat_id': message.chat.id,
+        'user_id': message.from_user.id if message.from_user else None,
+        'prompt': message.text,
+    }
+
+
+def miniapp_job_id(message, history, mode='full', expand=False):
+    """Stable job id so a re-sent Mini App request maps to the same job."""
+    key = json.dumps(
+        {'message': message, 'history': history, 'mode': mode, 'expand': expand},
+        ensure_ascii=False,
+        sort_keys=True
+    )
+    return 'app:' + hashlib.sha256(key.encode('utf-8')).hexdigest()[:32]
+
+
+def submit_miniapp_job(message, history, user_id=None, mode='full', summary=None, verified=False):
+    """Return the Mini App job for this request, starting it only if it is new.
+
+    Only a verified user_id supersedes the user's older jobs. Returns None
+    when the job table is full of running jobs.
+    """
+    job_id = miniapp_job_id(message, history, mode=mode, expand=bool(summary))
+    job, created = MINI_APP_JOBS.submit(job_id, message, history, user_id=user_id, mode=mode, summary=summary)
+    session_user_id = user_id if verified else None
+    if not job or not created:
+        if job:
+            print(f"[LOG] Mini App request joined existing job: {job_id}")
+            claim_miniapp_job(job, session_user_id)
+        return job
+
+    if REQUEST_JOURNAL:
+        journaled = REQUEST_JOURNAL.get_job(job_id)
+        if (journaled and journaled['state'] == JOB_DONE
+                and time.time() - journaled['updated_at'] < MINI_APP_DEDUP_WINDOW):
+            print(f"[LOG] Mini App request served from journal: {job_id}")
+            record_usage(user_id, 'miniapp', 'journal', message, history)
+            job.append(journaled['result'])
+            job.finish(journaled['result'])
+            return job
+
+    # Claimed only once the job will run: run_miniapp_job finishes the claims.
+    claim_miniapp_job(job, session_user_id)
+    threading.Thread(target=run_miniapp_job, args=(job,), name=f'job-{job_id[:12]}', daemon=True).start()
+    return job
+
+
+def claim_miniapp_job(job, user_id):
+    """Make job the user's current Mini App generation, cancelling the one it supersedes.
+
+    Anonymous or unverified requests and users who opted out with /parallel
+    pin the job instead, so it only stops once nobody follows it.
+    """
+    if user_id is None or chat_allows_parallel(user_id):
+        job.claim(None)
+        return
+    session = f'app:{user_id}'
+    claim = job.claim(session)
+    if claim is None:
+        return
+    superseded = GENERATIONS.start(session, claim)
+    if superseded:
+        print(f"[LOG] New Mini App request of user {user_id} superseded {superseded} job(s)")
+
+
+def run_miniapp_job(job):
+    """Generate the answer for a Mini App job, streaming tokens into it."""
+    job.start()
+    if REQUEST_JOURNAL:
+        REQUEST_JOURNAL.create_job(
+            job.job_id,
+            'miniapp',
+            job.message,
+            user_id=job.user_id,
+            history=job.history,
+            mode=job.mode,
+            summary=job.summary
+        )
+        REQUEST_JOURNAL.mark_running(job.job_id)
+
+    def on_token(text):
+        # Closed tabs stop the generation, reconnects within the grace period don't.
+        if job.orphaned(MINI_APP_ORPHAN_GRACE):
+            job.cancel_token.cancel(CANCEL_DISCONNECTED)
+        job.append(text)
+
+    try:
+        content, history, cache_prompt = job.message, job.history, None
+        if job.summary:
+            content, history = build_expansion_request(job.message, job.history, job.summary)
+            cache_prompt = job.message if not job.history else None
+        reply = answer_prompt(
+            content,
+            history=history,
+            origin='miniapp',
+            on_token=on_token,
+            user_id=job.user_id,
+            mode=job.mode,
+            cache_prompt=cache_prompt,
+            cancel=job.cancel_token,
+            expansion=bool(job.summary)
+        )
+        if REQUEST_JOURNAL:
+            REQUEST_JOURNAL.mark_done(job.job_id, reply)
+        job.finish(reply)
+    except GenerationCancelled as e:
+        if REQUEST_JOURNAL:
+            REQUEST_JOURNAL.mark_failed(job.job_id, f'cancelled: {e.reason}')
+        job.fail(MINI_APP_CANCELLED_ERROR)
+    except UpstreamOverloaded as e:
+        if REQUEST_JOURNAL:
+            REQUEST_JOURNAL.mark_failed(job.job_id, e)
+        job.fail(MINI_APP_OVERLOAD_ERROR)
+    except Exception as e:
+        print(f"[ERROR] Mini App job {job.job_id} failed: {e}")
+        if REQUEST_JOURNAL:
+            REQUEST_JOURNAL.mark_failed(job.job_id, e)
+        job.fail('Server error while processing request')
+    finally:
+        for claim in job.claims():
+            GENERATIONS.finish(claim.session, claim)
+
+
+def open_request_journal():
+    """Open the journal and restore the persisted getUpdates offset."""
+    global REQUEST_JOURNAL
+    if not REQUEST_JOURNAL_ENABLED:
+        return None
+    try:
+        REQUEST_JOURNAL = RequestJournal(REQUEST_JOURNAL_PATH)
+        REQUEST_JOURNAL.prune(REQUEST_JOURNAL_RETENTION)
+        bot.last_update_id = REQUEST_JOURNAL.get_last_update_id()
+        print(f"[LOG] Request journal opened, last update_id: {bot.last_update_id}")
+    except Exception as e:
+        print(f"[ERROR] Failed to open request journal: {e}")
+        REQUEST_JOURNAL = None
+    return REQUEST_JOURNAL
+
+
+def resume_unfinished_jobs():
+    """Finish jobs interrupted by the previous process in a background thread."""
+    if not REQUEST_JOURNAL:
+        return
+
+    jobs = REQUEST_JOURNAL.unfinished_jobs()
+    if not jobs:
+        return
+    print(f"[LOG] Resuming {len(jobs)} unfinished job(s) from journal")
+
+    # Register Mini App jobs before the HTTP server starts so reconnecting
+    # clients follow the resumed run instead of starting another one.
+    miniapp_jobs = {}
+    for job in jobs:
+        if job['origin'] == 'miniapp':
+            answer_job, _ = MINI_APP_JOBS.submit(
+                job['job_id'],
+                job['prompt'],
+                job['history'] or [],
+                user_id=job['user_id'],
+                mode=job['mode'] or 'full',
+                summary=job['summary']
+            )
+            if answer_job:
+                miniapp_jobs[job['job_id']] = answer_job
+
+    def worker():
+        for job in jobs:
+            job_id = job['job_id']
+            if time.time() - job['created_at'] > REQUEST_JOURNAL_RESUME_MAX_AGE:
+                REQUEST_JOURNAL.mark_failed(job_id, 'expired before resume')
+                if job_id in miniapp_jobs:
+                    miniapp_jobs[job_id].fail('Request expired, please send it again')
+                continue
+            try:
+                if job_id in miniapp_jobs:
+                    run_miniapp_job(miniapp_jobs[job_id])
+                elif job['origin'] == 'telegram':
+                    process_telegram_prompt(job['chat_id'], job['user_id'], job['prompt'], job_id=job_id)
+            except Exception as e:
+                print(f"[ERROR] Failed to resume job {job_id}: {e}")
+
+    threading.Thread(target=worker, daemon=True).start()
+
+
+def build_literature_messages(content, history=None, mode='full'):
     """Build chat messages for model call with strict literature scope."""
-    messages = [{"role": "system", "content": LITERATURE_SYSTEM_PROMPT}]
+    system_prompt = LITERATURE_SYSTEM_PROMPT
+    if mode == 'summary':
+        system_prompt = f"{LITERATURE_SYSTEM_PROMPT} {LITERATURE_SUMMARY_INSTRUCTION}"
+    messages = [{"role": "system", "content": system_prompt}]
     if isinstance(history, list):
         for item in history[-10:]:
             if not isinstance(item, dict):
@@ -885,36 +1963,472 @@ def build_literature_messages(content, history=None):
     return messages
 
 
-def get_answer(content, history=None):
-    """Get model response for Telegram chat and Mini App."""
+def build_expansion_request(prompt, history, summary):
+    """Continue the summary's conversation with a request for the full analysis."""
+    expanded_history = list(history or []) + [
+        {"role": "user", "content": prompt},
+        {"role": "assistant", "content": summary},
+    ]
+    return EXPAND_REQUEST_TEXT, expanded_history
+
+
+def load_offtopic_classifier():
+    """Load bundled off-topic model once; returns None when disabled or unavailable."""
+    global OFFTOPIC_CLASSIFIER, OFFTOPIC_FILTER_ENABLED
+    if not OFFTOPIC_FILTER_ENABLED:
+        return None
+    if OFFTOPIC_CLASSIFIER is None:
+        try:
+            OFFTOPIC_CLASSIFIER = OfftopicClassifier.load(OFFTOPIC_MODEL_PATH)
+            mode = 'shadow' if OFFTOPIC_SHADOW_MODE else 'enforce'
+            print(f"[LOG] Off-topic filter loaded ({mode}, threshold {OFFTOPIC_THRESHOLD})")
+        except Exception as e:
+            print(f"[WARNING] Off-topic filter disabled: {e}")
+            OFFTOPIC_FILTER_ENABLED = False
+            return None
+    return OFFTOPIC_CLASSIFIER
+
+
+def log_offtopic_shadow(origin, prompt, probability, reply):
+    """Append shadow-mode decision for later false-reject analysis."""
+    record = {
+        'ts': round(time.time(), 3),
+        'origin': origin,
+        'probability': round(probability, 4),
+        'would_reject': probability >= OFFTOPIC_THRESHOLD,
+        'model_refused': looks_like_refusal(reply),
+        'prompt': prompt[:500],
+    }
+    try:
+        with OFFTOPIC_LOG_LOCK:
+            with open(OFFTOPIC_SHADOW_LOG, 'a', encoding='utf-8') as log_file:
+                log_file.write(json.dumps(record, ensure_ascii=False) + '\n')
+    except Exception as e:
+        print(f"[ERROR] Failed to write off-topic shadow log: {e}")
+
+
+def record_usage(user_id, origin, cache_status, content, history, usage=None, started=None):
+    """Write one request to the usage ledger (no-op when disabled)."""
+    if not USAGE_LEDGER:
+        return
+    usage = usage or {}
+    try:
+        USAGE_LEDGER.record(
+            user_id=user_id,
+            origin=origin,
+            cache_status=cache_status,
+            prompt_tokens=usage.get('prompt_tokens', 0),
+            completion_tokens=usage.get('completion_tokens', 0),
+            latency_ms=(time.time() - started) * 1000 if started else 0,
+            history_len=len(history or []),
+            prompt_chars=len(content),
+        )
+    except Exception as e:
+        print(f"[ERROR] Failed to write usage record: {e}")
+
+
+def answer_prompt(content, history=None, origin='telegram', on_token=None, user_id=None,
+                  mode='full', cache_prompt=None, cache_namespace=None, session=None, cancel=None,
+                  expansion=False):
+    """Answer user prompt, refusing clearly off-topic ones locally.
+
+    mode is 'summary' for the short first-tier answer or 'full' for the
+    complete analysis. cache_prompt overrides the cache key, e.g. for an
+    expansion whose history only repeats the original prompt; expansion
+    marks a "Подробнее" request, which is never answered with the summary
+    the user already has. session
+    identifies the conversation (e.g. a Telegram chat) for follow-ups.
+    A model call made with a cancel token is streamed and raises
+    GenerationCancelled once the token is cancelled.
+    """
+    started = time.time()
+    probability = None
+    classifier = load_offtopic_classifier()
+    # Follow-ups inside a conversation are often short and ambiguous, so
+    # only standalone prompts are filtered.
+    if classifier and not history:
+        probability = classifier.predict_proba(content)
+        if probability >= OFFTOPIC_THRESHOLD and not OFFTOPIC_SHADOW_MODE:
+            print(f"[LOG] Off-topic prompt refused locally ({origin}, p={probability:.3f})")
+            record_usage(user_id, origin, 'refused', content, history, started=started)
+            if on_token:
+                on_token(OFFTOPIC_REFUSAL_TEXT)
+            return OFFTOPIC_REFUSAL_TEXT
+
+    # Generic follow-ups about a known work ("А главные герои?") are cached
+    # per aspect under the prefetcher's question for that work.
+    followup = None
+    if PREFETCHER and cache_prompt is None:
+        followup = PREFETCHER.resolve_followup(content, history, session=session, mode=mode)
+        if followup:
+            cache_prompt, cache_namespace = followup
+
+    # Only standalone prompts are cached: with history the same words can
+    # ask for something different.
+    if cache_prompt is None and not history:
+        cache_prompt = content
+    cache_namespace = cache_namespace or mode
+    use_cache = SEMANTIC_CACHE is not None and cache_prompt is not None
+    if PREFETCHER and not history and not followup:
+        PREFETCHER.note_work(content, session=session)
+    if use_cache:
+        cached = SEMANTIC_CACHE.lookup(cache_prompt, namespace=cache_namespace)
+        if cached:
+            reply, similarity, entry = cached
+            print(f"[LOG] Semantic cache hit ({origin}, {cache_namespace}, sim={similarity:.3f}): {entry.prompt[:50]}")
+            cache_status = 'semantic'
+            if entry.meta.get('prefetch'):
+                cache_status = 'prefetched'
+                PREFETCHER.record_hit(entry)
+            record_usage(user_id, origin, cache_status, content, history, started=started)
+            if on_token:
+                on_token(reply)
+            return reply
+
+    slot = None
+    max_tokens = None
+    if UPSTREAM_LIMITER:
+        slot = UPSTREAM_LIMITER.acquire(record_rejection=False)
+        if slot is None:
+            # Saturated: prefer an instant older answer over queueing.
+            degraded = find_degraded_answer(cache_prompt, cache_namespace, allow_summary=not expansion)
+            if degraded:
+                reply, namespace = degraded
+                print(f"[LOG] Upstream saturated, served cached {namespace} answer ({origin})")
+                record_usage(user_id, origin, 'degraded', content, history, started=started)
+                if on_token:
+                    on_token(reply)
+                return reply
+            slot = UPSTREAM_LIMITER.acquire(UPSTREAM_QUEUE_TIMEOUT)
+            if slot is None:
+                print(f"[WARNING] Upstream saturated, request shed ({origin}), limit {UPSTREAM_LIMITER.stats()['limit']}")
+                record_usage(user_id, origin, 'shed', content, history, started=started)
+                raise UpstreamOverloaded('upstream concurrency limit reached')
+        if mode == 'full' and UPSTREAM_LIMITER.pressure() >= UPSTREAM_DEGRADE_AT:
+            max_tokens = DEGRADED_FULL_MAX_TOKENS
+
+    usage = {}
+    def checked_token(text):
+        if on_token:
+            on_token(text)
+        cancel.check()
+
+    stream_token = checked_token if cancel is not None else on_token
+
+    change_foreground_upstream(1)
+    upstream_started = time.time()
+    latency_ms = None
+    failed = False
+    try:
+        # Superseded while waiting for a slot: give it back unused.
+        if cancel is not None:
+            cancel.check()
+        reply = get_answer(content, history=history, on_token=stream_token, usage=usage, mode=mode, max_tokens=max_tokens)
+        latency_ms = (time.time() - upstream_started) * 1000
+    except GenerationCancelled as e:
+        print(f"[LOG] Generation cancelled ({origin}, {e.reason}) after {usage.get('completion_tokens', 0)} tokens")
+        GENERATIONS.record_cancelled(e.reason, usage)
+        record_usage(user_id, origin, 'cancelled', content, history, usage=usage, started=started)
+        raise
+    except Exception:
+        failed = True
+        raise
+    finally:
+        change_foreground_upstream(-1)
+        if slot:
+            # A cancelled call says nothing about upstream latency.
+            release_upstream_slot(slot, latency_ms, failed, mode, usage, capped=max_tokens is not None)
+    record_usage(user_id, origin, 'upstream', content, history, usage=usage, started=started)
+    if probability is not None and OFFTOPIC_SHADOW_MODE:
+        log_offtopic_shadow(origin, content, probability, reply)
+    if use_cache and reply and not looks_like_refusal(reply):
+        SEMANTIC_CACHE.add(cache_prompt, reply, namespace=cache_namespace)
+    return reply
+
+
+def release_upstream_slot(slot, latency_ms, failed, mode, usage, capped=False):
+    """Give a slot back with a latency signal that does not depend on answer length."""
+    UPSTREAM_LIMITER.release(
+        slot,
+        latency_ms,
+        error=failed,
+        kind=mode,
+        first_token_ms=usage.get('first_token_ms'),
+        completion_tokens=usage.get('completion_tokens'),
+        capped=capped or usage.get('finish_reason') == 'length',
+    )
+
+
+def find_degraded_answer(cache_prompt, cache_namespace, allow_summary=True):
+    """Cached answer acceptable while upstream is saturated: (reply, namespace) or None.
+
+    Tries expired entries of the same namespace, then, if allow_summary,
+    the short summary of the same prompt in place of a full analysis.
+    """
+    if SEMANTIC_CACHE is None or cache_prompt is None:
+        return None
+    namespaces = [cache_namespace]
+    if cache_namespace == 'full' and allow_summary:
+        namespaces.append('summary')
+    for namespace in namespaces:
+        found = SEMANTIC_CACHE.lookup(cache_prompt, namespace=namespace, allow_stale=True)
+        if found:
+            return found[0], namespace
+    return None
+
+
+def change_foreground_upstream(delta):
+    """Track user-facing model calls in flight; the prefetcher yields to them."""
+    global FOREGROUND_UPSTREAM_CALLS
+    with FOREGROUND_UPSTREAM_LOCK:
+        FOREGROUND_UPSTREAM_CALLS += delta
+
+
+def generate_prefetch(prompt, mode, cancelled):
+    """Prefetcher callback: stream a follow-up and abort once users need upstream."""
+    slot = None
+    if UPSTREAM_LIMITER:
+        # Prefetch never queues for a slot and leaves headroom for users.
+        if UPSTREAM_LIMITER.pressure() >= UPSTREAM_DEGRADE_AT:
+            raise PrefetchCancelled()
+        slot = UPSTREAM_LIMITER.acquire(record_rejection=False)
+        if slot is None:
+            raise PrefetchCancelled()
+    started = time.time()
+    usage = {}
+
+    def on_token(_):
+        if cancelled():
+            raise PrefetchCancelled()
+
+    latency_ms = None
+    failed = False
+    try:
+        reply = get_answer(prompt, on_token=on_token, usage=usage, mode=mode)
+        latency_ms = (time.time() - started) * 1000
+    except PrefetchCancelled as e:
+        # Tokens streamed before the abort are still billed.
+        e.usage = usage
+        record_usage(None, 'prefetch', 'cancelled', prompt, None, usage=usage, started=started)
+        raise
+    except Exception:
+        failed = True
+        raise
+    finally:
+        if slot:
+            release_upstream_slot(slot, latency_ms, failed, mode, usage)
+    record_usage(None, 'prefetch', 'upstream', prompt, None, usage=usage, started=started)
+    return reply, usage
+
+
+def estimate_tokens(text):
+    """Rough token count for Russian text when upstream omits usage."""
+    return max(1, len(text) // 3)
+
+
+def get_answer(content, history=None, on_token=None, usage=None, mode='full', max_tokens=None):
+    """Get model response for Telegram chat and Mini App.
+
+    When on_token is given the completion is streamed and every text delta
+    is passed to it as soon as it arrives. When usage is a dict it receives
+    prompt_tokens and completion_tokens of the call, finish_reason and, for
+    streamed calls, first_token_ms. mode='summary' asks for
+    a short overview within SUMMARY_MAX_TOKENS; max_tokens lowers the cap.
+    """
     client = OpenAI(
-        base_url="https://router.huggingface.co/v1",
+        base_url=MODEL_BASE_URL,
         api_key=HUGGINGFACE_TOKEN
     )
-    completion = client.chat.completions.create(
-        model="deepseek-ai/DeepSeek-V3.2-Exp:novita",
-        messages=build_literature_messages(content, history=history),
-        max_tokens=3500,
-        temperature=0.7,
+    messages = build_literature_messages(content, history=history, mode=mode)
+    mode_max_tokens = SUMMARY_MAX_TOKENS if mode == 'summary' else FULL_MAX_TOKENS
+    max_tokens = min(max_tokens, mode_max_tokens) if max_tokens else mode_max_tokens
+    if usage is None:
+        usage = {}
+    started = time.time()
+    first_token_at = None
+    parts = []
+
+    try:
+        if on_token is None:
+            completion = client.chat.completions.create(
+                model=MODEL_NAME,
+                messages=messages,
+                max_tokens=max_tokens,
+                temperature=0.7,
+            )
+            reply = completion.choices[0].message.content
+            usage['finish_reason'] = completion.choices[0].finish_reason
+            if completion.usage:
+                usage['prompt_tokens'] = completion.usage.prompt_tokens
+                usage['completion_tokens'] = completion.usage.completion_tokens
+            else:
+                usage['prompt_tokens'] = sum(estimate_tokens(message['content']) for message in messages)
+                usage['completion_tokens'] = estimate_tokens(reply or '')
+        else:
+            stream = client.chat.completions.create(
+                model=MODEL_NAME,
+                messages=messages,
+                max_tokens=max_tokens,
+                temperature=0.7,
+                stream=True,
+                stream_options={"include_usage": True},
+            )
+            try:
+                for chunk in stream:
+                    if getattr(chunk, 'usage', None):
+                        usage['prompt_tokens'] = chunk.usage.prompt_tokens
+                        usage['completion_tokens'] = chunk.usage.completion_tokens
+                    if not chunk.choices:
+                        continue
+                    if chunk.choices[0].finish_reason:
+                        usage['finish_reason'] = chunk.choices[0].finish_reason
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        if first_token_at is None:
+                            first_token_at = time.time()
+                            usage['first_token_ms'] = (first_token_at - started) * 1000
+                        parts.append(delta)
+                        on_token(delta)
+            finally:
+                # Closing the response stops upstream generation when on_token aborts.
+                stream.close()
+            reply = ''.join(parts)
+            if 'completion_tokens' not in usage:
+                usage['prompt_tokens'] = sum(estimate_tokens(message['content']) for message in messages)
+                usage['completion_tokens'] = estimate_tokens(reply)
+    except Exception as e:
+        if parts and 'completion_tokens' not in usage:
+            # An aborted stream never gets its usage chunk; count what was generated.
+            usage['prompt_tokens'] = sum(estimate_tokens(message['content']) for message in messages)
+            usage['completion_tokens'] = estimate_tokens(''.join(parts))
+        capture_upstream(mode, on_token is not None, started, first_token_at, usage, error=e)
+        raise
+
+    capture_upstream(mode, on_token is not None, started, first_token_at, usage)
+    return reply
+
+
+def capture_upstream(mode, streamed, started, first_token_at, usage, error=None):
+    """Add the latency profile of one model call to the traffic capture."""
+    if not TRAFFIC_CAPTURE:
+        return
+    TRAFFIC_CAPTURE.record_upstream(
+        mode,
+        streamed,
+        (time.time() - started) * 1000,
+        first_token_ms=(first_token_at - started) * 1000 if first_token_at else None,
+        prompt_tokens=usage.get('prompt_tokens', 0),
+        completion_tokens=usage.get('completion_tokens', 0),
+        error=error,
     )
-    return completion.choices[0].message.content
+
+
+def open_usage_ledger():
+    """Open the usage ledger and start periodic rollups."""
+    global USAGE_LEDGER
+    if not USAGE_LEDGER_ENABLED:
+        return None
+    try:
+        USAGE_LEDGER = UsageLedger(USAGE_LEDGER_DIR)
+    except Exception as e:
+        print(f"[ERROR] Failed to open usage ledger: {e}")
+        return None
+
+    def rollup_worker():
+        while True:
+            time.sleep(USAGE_ROLLUP_INTERVAL)
+            try:
+                USAGE_LEDGER.rollup_current()
+                USAGE_LEDGER.compact(USAGE_RAW_RETENTION_DAYS)
+            except Exception as e:
+                print(f"[ERROR] Usage rollup failed: {e}")
+
+    threading.Thread(target=rollup_worker, name='usage-rollup', daemon=True).start()
+    print(f"[LOG] Usage ledger: {USAGE_LEDGER_DIR}")
+    return USAGE_LEDGER
+
+
+def open_inline_index():
+    """Memory-map the inline analysis index built by inline_index.py."""
+    global INLINE_INDEX, BOT_USERNAME
+    if not INLINE_MODE_ENABLED:
+        return None
+    if not INLINE_INDEX_PATH.exists():
+        print(f"[WARNING] Inline index not found: {INLINE_INDEX_PATH} (run: python inline_index.py build)")
+        return None
+    try:
+        INLINE_INDEX = InlineIndex(INLINE_INDEX_PATH)
+    except Exception as e:
+        print(f"[ERROR] Failed to open inline index: {e}")
+        return None
+
+    try:
+        BOT_USERNAME = bot.get_me().username
+    except Exception as e:
+        print(f"[WARNING] Could not get bot username for inline deep links: {e}")
+    print(f"[LOG] Inline index: {len(INLINE_INDEX)} works from {INLINE_INDEX_PATH}")
+    return INLINE_INDEX
+
+
+def start_prefetcher():
+    """Start background prefetch of follow-ups for popular works (needs the semantic cache)."""
+    global PREFETCHER
+    if not PREFETCH_ENABLED:
+        return None
+    if SEMANTIC_CACHE is None:
+        print("[WARNING] Prefetch needs SEMANTIC_CACHE_ENABLED=1; prefetch is off")
+        return None
+    PREFETCHER = Prefetcher(
+        generate_prefetch,
+        SEMANTIC_CACHE,
+        lambda: FOREGROUND_UPSTREAM_CALLS,
+        mode='summary' if TIERED_ANSWERS_ENABLED else 'full',
+        tiers=PREFETCH_TIERS,
+        max_per_hour=PREFETCH_MAX_PER_HOUR,
+        max_foreground=PREFETCH_MAX_FOREGROUND,
+        idle_seconds=PREFETCH_IDLE_SECONDS,
+    )
+    PREFETCHER.start()
+    print(f"[LOG] Prefetch enabled: tiers {PREFETCH_TIERS}, up to {PREFETCH_MAX_PER_HOUR}/hour")
+    return PREFETCHER
+
+
+def open_traffic_capture():
+    """Start recording anonymized traffic when TRAFFIC_CAPTURE_PATH is set."""
+    global TRAFFIC_CAPTURE
+    if not TRAFFIC_CAPTURE_PATH:
+        return None
+    try:
+        TRAFFIC_CAPTURE = TrafficRecorder(BASE_DIR / TRAFFIC_CAPTURE_PATH, salt=TRAFFIC_CAPTURE_SALT or None)
+    except Exception as e:
+        print(f"[ERROR] Failed to open traffic capture: {e}")
+        return None
+    atexit.register(TRAFFIC_CAPTURE.close)
+    print(f"[LOG] Capturing traffic to {TRAFFIC_CAPTURE.path}")
+    if not TRAFFIC_CAPTURE_SALT:
+        print("[WARNING] TRAFFIC_CAPTURE_SALT is not set: hashed ids change after every restart")
+    return TRAFFIC_CAPTURE
 
 if __name__ == "__main__":
     if not acquire_instance_lock():
         print("[ERROR] Another bot instance is already running. Stop it before starting a new one.")
         sys.exit(1)
 
+    load_offtopic_classifier()
+    open_request_journal()
+    open_usage_ledger()
+    open_inline_index()
+    open_traffic_capture()
+    start_prefetcher()
+    resume_unfinished_jobs()
+
     mini_app_server = None
     if MINI_APP_ENABLED:
         try:
             mini_app_server = start_mini_app_server()
             if not RUNTIME_MINI_APP_URL and MINI_APP_AUTO_TUNNEL:
-                MINI_APP_TUNNEL_PROCESS, tunnel_url = start_cloudflare_tunnel(MINI_APP_PORT)
-                if tunnel_url:
-                    RUNTIME_MINI_APP_URL = tunnel_url
-                    print(f"[LOG] Auto tunnel URL: {RUNTIME_MINI_APP_URL}")
-                else:
-                    print('[WARNING] Auto tunnel failed. Mini App button may be unavailable.')
+                # Tunnel discovery runs in background; polling starts right away.
+                start_cloudflare_tunnel(MINI_APP_PORT)
         except Exception as e:
             print(f"[ERROR] Failed to start Mini App server: {e}")
 
@@ -937,6 +2451,7 @@ if __name__ == "__main__":
     print(f"  • /admin - панель администратора")
     print(f"  • /reset - сброс и перезапуск")
     print(f"  • /status - статус системы")
+    print(f"  • /profile, /memprofile - профилирование")
 
     try:
         bot.remove_webhook()
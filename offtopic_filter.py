@@ -0,0 +1,307 @@
+"""Local off-topic pre-filter for Pushkin AI prompts.
+
+Character n-gram naive Bayes that runs on CPU in microseconds and rejects
+clearly non-literature prompts before they reach the upstream model.
+
+Usage:
+    python offtopic_filter.py train [--data offtopic_dataset.jsonl] [--model offtopic_model.json]
+    python offtopic_filter.py eval [--data offtopic_dataset.jsonl] [--model offtopic_model.json] [--folds 5]
+    python offtopic_filter.py shadow-report [--log offtopic_shadow.jsonl] [--threshold 0.97]
+"""
+import argparse
+import json
+import math
+import random
+import re
+from collections import Counter
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parent
+DEFAULT_DATA_PATH = BASE_DIR / 'offtopic_dataset.jsonl'
+DEFAULT_MODEL_PATH = BASE_DIR / 'offtopic_model.json'
+DEFAULT_SHADOW_LOG = BASE_DIR / 'offtopic_shadow.jsonl'
+
+LABEL_LITERATURE = 'literature'
+LABEL_OFFTOPIC = 'offtopic'
+MODEL_VERSION = 1
+
+# Phrases the upstream model uses when it refuses a non-literature request.
+REFUSAL_MARKERS = (
+    'только литератур',
+    'не связан с литератур',
+    'не относится к литератур',
+    'вопросам литературы',
+    'only literature',
+    'not related to literature',
+)
+
+_SPACES_RE = re.compile(r'\s+')
+_NON_WORD_RE = re.compile(r'[^0-9a-zа-я+#\s]')
+
+
+def normalize_text(text):
+    """Lowercase prompt and collapse punctuation and whitespace."""
+    text = str(text).lower().replace('ё', 'е')
+    text = _NON_WORD_RE.sub(' ', text)
+    return _SPACES_RE.sub(' ', text).strip()
+
+
+def extract_ngrams(text, min_n=2, max_n=4):
+    """Return character n-grams of the normalized prompt, padded at word edges."""
+    padded = f' {normalize_text(text)} '
+    grams = []
+    for n in range(min_n, max_n + 1):
+        for i in range(len(padded) - n + 1):
+            gram = padded[i:i + n]
+            if gram.strip():
+                grams.append(gram)
+    return grams
+
+
+def load_dataset(path):
+    """Read labelled prompts from a JSONL file, skipping unlabelled rows."""
+    samples = []
+    with open(path, 'r', encoding='utf-8') as data_file:
+        for line in data_file:
+            line = line.strip()
+            if not line:
+                continue
+            row = json.loads(line)
+            label = row.get('label')
+            if label not in (LABEL_LITERATURE, LABEL_OFFTOPIC):
+                continue
+            text = str(row.get('text') or row.get('prompt') or '').strip()
+            if text:
+                samples.append((text, label))
+    return samples
+
+
+class OfftopicClassifier:
+    """Multinomial naive Bayes stored as per-n-gram log-likelihood ratios."""
+
+    def __init__(self, weights, prior, unseen_weight, min_n=2, max_n=4):
+        self.weights = weights
+        self.prior = prior
+        self.unseen_weight = unseen_weight
+        self.min_n = min_n
+        self.max_n = max_n
+
+    @classmethod
+    def train(cls, samples, alpha=0.5, min_n=2, max_n=4):
+        """Fit the classifier from (text, label) pairs."""
+        counts = {LABEL_LITERATURE: Counter(), LABEL_OFFTOPIC: Counter()}
+        docs = Counter()
+        for text, label in samples:
+            counts[label].update(extract_ngrams(text, min_n, max_n))
+            docs[label] += 1
+
+        if not docs[LABEL_LITERATURE] or not docs[LABEL_OFFTOPIC]:
+            raise ValueError('Training data must contain both literature and offtopic samples')
+
+        vocabulary = set(counts[LABEL_LITERATURE]) | set(counts[LABEL_OFFTOPIC])
+        vocab_size = len(vocabulary) + 1
+        lit_total = sum(counts[LABEL_LITERATURE].values()) + alpha * vocab_size
+        off_total = sum(counts[LABEL_OFFTOPIC].values()) + alpha * vocab_size
+
+        weights = {}
+        for gram in vocabulary:
+            off_p = (counts[LABEL_OFFTOPIC][gram] + alpha) / off_total
+            lit_p = (counts[LABEL_LITERATURE][gram] + alpha) / lit_total
+            weights[gram] = round(math.log(off_p / lit_p), 4)
+
+        prior = math.log(docs[LABEL_OFFTOPIC] / docs[LABEL_LITERATURE])
+        unseen_weight = math.log((alpha / off_total) / (alpha / lit_total))
+        return cls(weights, prior, unseen_weight, min_n, max_n)
+
+    @classmethod
+    def load(cls, path):
+        """Load a model saved by save()."""
+        with open(path, 'r', encoding='utf-8') as model_file:
+            data = json.load(model_file)
+        if data.get('version') != MODEL_VERSION:
+            raise ValueError(f"Unsupported off-topic model version: {data.get('version')}")
+        return cls(
+            data['weights'],
+            data['prior'],
+            data['unseen_weight'],
+            data.get('min_n', 2),
+            data.get('max_n', 4)
+        )
+
+    def save(self, path):
+        """Write the model as compact JSON."""
+        data = {
+            'version': MODEL_VERSION,
+            'min_n': self.min_n,
+            'max_n': self.max_n,
+            'prior': self.prior,
+            'unseen_weight': self.unseen_weight,
+            'weights': self.weights,
+        }
+        with open(path, 'w', encoding='utf-8') as model_file:
+            json.dump(data, model_file, ensure_ascii=False, separators=(',', ':'), sort_keys=True)
+
+    def predict_proba(self, text):
+        """Return the probability that text is off-topic."""
+        grams = extract_ngrams(text, self.min_n, self.max_n)
+        if not grams:
+            return 0.0
+
+        score = 0.0
+        for gram in grams:
+            score += self.weights.get(gram, self.unseen_weight)
+        # Naive Bayes overcounts overlapping n-grams; scale the evidence so
+        # long prompts do not saturate the probability.
+        score = self.prior + score / math.sqrt(len(grams))
+        if score >= 0:
+            return 1.0 / (1.0 + math.exp(-min(score, 60.0)))
+        exp_score = math.exp(max(score, -60.0))
+        return exp_score / (1.0 + exp_score)
+
+
+def looks_like_refusal(reply):
+    """Heuristically detect the model's canned off-topic refusal."""
+    head = str(reply or '')[:400].lower()
+    return any(marker in head for marker in REFUSAL_MARKERS)
+
+
+def evaluate(classifier, samples, thresholds):
+    """Return rejection metrics for the given thresholds."""
+    return threshold_metrics([(classifier.predict_proba(text), label) for text, label in samples], thresholds)
+
+
+def threshold_metrics(scored, thresholds):
+    """Rejection metrics of (probability, label) pairs at each threshold.
+
+    false_accept_rate is the share of off-topic prompts let through.
+    """
+    total_lit = sum(1 for _, label in scored if label == LABEL_LITERATURE)
+    total_off = sum(1 for _, label in scored if label == LABEL_OFFTOPIC)
+    rows = []
+    for threshold in thresholds:
+        false_rejects = sum(1 for p, label in scored if label == LABEL_LITERATURE and p >= threshold)
+        true_rejects = sum(1 for p, label in scored if label == LABEL_OFFTOPIC and p >= threshold)
+        rows.append({
+            'threshold': threshold,
+            'false_reject_rate': false_rejects / total_lit if total_lit else 0.0,
+            'offtopic_caught': true_rejects / total_off if total_off else 0.0,
+            'false_accept_rate': (total_off - true_rejects) / total_off if total_off else 0.0,
+            'false_rejects': false_rejects,
+        })
+    return rows
+
+
+def cross_validate(samples, folds, thresholds, alpha, seed=13):
+    """Run k-fold evaluation; returns (metrics per threshold, held-out predictions).
+
+    Held-out predictions are (probability, text, label) of every sample
+    scored by the model trained without its fold.
+    """
+    shuffled = list(samples)
+    random.Random(seed).shuffle(shuffled)
+    held_out = []
+    for fold in range(folds):
+        test = shuffled[fold::folds]
+        train = [sample for i, sample in enumerate(shuffled) if i % folds != fold]
+        classifier = OfftopicClassifier.train(train, alpha=alpha)
+        held_out.extend((classifier.predict_proba(text), text, label) for text, label in test)
+    rows = threshold_metrics([(p, label) for p, _, label in held_out], thresholds)
+    return rows, held_out
+
+
+def print_metrics(rows):
+    print(f"{'threshold':>10} {'false rejects':>14} {'false accepts':>14} {'off-topic caught':>17}")
+    for row in rows:
+        print(
+            f"{row['threshold']:>10.3f} "
+            f"{row['false_reject_rate'] * 100:>13.1f}% "
+            f"{row['false_accept_rate'] * 100:>13.1f}% "
+            f"{row['offtopic_caught'] * 100:>16.1f}%"
+        )
+
+
+def command_train(args):
+    samples = load_dataset(args.data)
+    classifier = OfftopicClassifier.train(samples, alpha=args.alpha)
+    classifier.save(args.model)
+    print(f'[LOG] Trained on {len(samples)} samples, {len(classifier.weights)} n-grams -> {args.model}')
+
+
+def command_eval(args):
+    samples = load_dataset(args.data)
+    thresholds = [float(value) for value in args.thresholds.split(',')]
+
+    if args.folds > 1:
+        rows, held_out = cross_validate(samples, args.folds, thresholds, args.alpha)
+        print(f'[LOG] {args.folds}-fold cross-validation on {len(samples)} samples')
+        print_metrics(rows)
+        worst = sorted(
+            ((p, text) for p, text, label in held_out if label == LABEL_LITERATURE),
+            reverse=True
+        )[:5]
+        print('Most off-topic looking literature prompts:')
+        for p, text in worst:
+            print(f'  {p:.3f}  {text}')
+        return
+
+    classifier = OfftopicClassifier.load(args.model)
+    print(f'[LOG] Evaluating {args.model} on {len(samples)} samples')
+    print_metrics(evaluate(classifier, samples, thresholds))
+
+
+def command_shadow_report(args):
+    """Summarize shadow-mode decisions against the model's actual replies."""
+    would_reject = 0
+    answered = 0
+    total = 0
+    false_rejects = []
+    with open(args.log, 'r', encoding='utf-8') as log_file:
+        for line in log_file:
+            line = line.strip()
+            if not line:
+                continue
+            row = json.loads(line)
+            total += 1
+            if row.get('probability', 0.0) < args.threshold:
+                continue
+            would_reject += 1
+            if row.get('model_refused') is False:
+                answered += 1
+                false_rejects.append(row.get('prompt', ''))
+
+    print(f'[LOG] Shadow decisions: {total}, would reject at {args.threshold}: {would_reject}')
+    if would_reject:
+        print(f'[LOG] Model answered {answered} of them (estimated false rejects: {answered / would_reject * 100:.1f}%)')
+    for prompt in false_rejects[:20]:
+        print(f'  {prompt}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Train and evaluate the Pushkin AI off-topic pre-filter.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    train_parser = subparsers.add_parser('train', help='train a model from labelled JSONL')
+    train_parser.add_argument('--data', default=str(DEFAULT_DATA_PATH))
+    train_parser.add_argument('--model', default=str(DEFAULT_MODEL_PATH))
+    train_parser.add_argument('--alpha', type=float, default=0.5)
+    train_parser.set_defaults(handler=command_train)
+
+    eval_parser = subparsers.add_parser('eval', help='report false rejects per threshold')
+    eval_parser.add_argument('--data', default=str(DEFAULT_DATA_PATH))
+    eval_parser.add_argument('--model', default=str(DEFAULT_MODEL_PATH))
+    eval_parser.add_argument('--alpha', type=float, default=0.5)
+    eval_parser.add_argument('--folds', type=int, default=0, help='k-fold cross-validation instead of a saved model')
+    eval_parser.add_argument('--thresholds', default='0.5,0.8,0.9,0.95,0.97,0.99')
+    eval_parser.set_defaults(handler=command_eval)
+
+    shadow_parser = subparsers.add_parser('shadow-report', help='summarize shadow-mode log')
+    shadow_parser.add_argument('--log', default=str(DEFAULT_SHADOW_LOG))
+    shadow_parser.add_argument('--threshold', type=float, default=0.97)
+    shadow_parser.set_defaults(handler=command_shadow_report)
+
+    args = parser.parse_args()
+    args.handler(args)
+
+
+if __name__ == '__main__':
+    main()
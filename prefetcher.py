@@ -0,0 +1,345 @@
+"""Speculative prefetch of likely follow-up analyses into the semantic cache.
+
+After a work is asked about, the next questions are predictable: its
+characters, themes, composition and the author's intent. For works that
+are popular enough, one low-priority worker generates those follow-ups
+while no foreground upstream call is running and aborts the stream as
+soon as one starts.
+
+Follow-up answers are cached under the question that was asked
+("<work>. <aspect request>") in a per-aspect namespace ('<mode>:<aspect>'),
+so "Гроза" never matches "Гроза — герои". A user's message is mapped onto
+that question only when it asks nothing beyond the work and the aspect:
+"Главные герои Грозы" does, "Образ Катерины в Грозе" does not.
+"""
+import heapq
+import threading
+import time
+from collections import deque
+
+from semantic_cache import covers, prompt_terms
+
+# Ordered by how often they follow a first analysis; popularity tiers
+# prefetch a prefix of this list.
+ASPECTS = ('characters', 'themes', 'composition', 'intent')
+
+ASPECT_REQUESTS = {
+    'characters': 'Главные герои и система образов.',
+    'themes': 'Основные темы, проблематика и идея.',
+    'composition': 'Композиция, сюжет и конфликт.',
+    'intent': 'Авторский замысел и позиция автора.',
+}
+
+# Word prefixes that mark a prompt as asking about one aspect.
+ASPECT_KEYWORDS = {
+    'characters': ('геро', 'персонаж', 'образ', 'характер'),
+    'themes': ('тема', 'темы', 'тему', 'темат', 'проблем', 'идея', 'идеи', 'идею'),
+    'composition': ('композиц', 'сюжет', 'фабул', 'конфликт', 'структур'),
+    'intent': ('замысел', 'замысл', 'авторск', 'позици', 'смысл'),
+}
+
+# Request wording that may accompany an aspect keyword in a generic follow-up.
+FOLLOWUP_FILLER = ('главн', 'основ', 'каки', 'како', 'кто', 'чем', 'его', 'ее', 'их', 'эт', 'данн')
+
+MAX_ATTEMPTS = 3
+
+
+class PrefetchCancelled(Exception):
+    """Raised from a streaming callback to abort a prefetch when foreground load rises.
+
+    usage holds the tokens spent before the abort, when known.
+    """
+
+    def __init__(self, usage=None):
+        super().__init__('prefetch cancelled')
+        self.usage = usage or {}
+
+
+def detect_aspect(text):
+    """Return the follow-up aspect a prompt asks about, or None."""
+    words = str(text).lower().replace('ё', 'е').split()
+    for aspect in ASPECTS:
+        prefixes = ASPECT_KEYWORDS[aspect]
+        if any(word.strip('.,!?;:«»"()').startswith(prefixes) for word in words):
+            return aspect
+    return None
+
+
+def aspect_question(work, aspect):
+    """The question whose answer is cached for an aspect of a work."""
+    return f'{work}. {ASPECT_REQUESTS[aspect]}'
+
+
+def _aspect_term(term, aspect):
+    if term in prompt_terms(ASPECT_REQUESTS[aspect]):
+        return True
+    # Stems are truncated, so "пробл" stands for the keyword "проблем".
+    return any(term.startswith(prefix) or (len(term) >= 4 and prefix.startswith(term))
+               for prefix in ASPECT_KEYWORDS[aspect] + FOLLOWUP_FILLER)
+
+
+def subject_terms(content, aspect):
+    """Stems of content that are not wording of the aspect request."""
+    return [term for term in prompt_terms(content) if not _aspect_term(term, aspect)]
+
+
+def work_key(prompt):
+    """Order-insensitive key of a work prompt for popularity counting."""
+    return ' '.join(sorted(set(prompt_terms(prompt))))
+
+
+def parse_tiers(value):
+    """Parse "2:2,5:4" into [(min requests, aspect count), ...] sorted by popularity."""
+    tiers = []
+    for item in str(value).split(','):
+        if ':' in item:
+            popularity, count = item.split(':', 1)
+            tiers.append((int(popularity), min(int(count), len(ASPECTS))))
+    return sorted(tiers)
+
+
+class Prefetcher:
+    """Queue and run follow-up prefetches when upstream is idle.
+
+    generate(prompt, mode, cancelled) must return (reply, usage) and should
+    raise PrefetchCancelled once cancelled() turns true. load() returns the
+    number of foreground upstream calls in flight.
+    """
+
+    def __init__(self, generate, cache, load, mode='summary', tiers=((2, 2), (5, 4)), max_per_hour=30,
+                 max_foreground=0, idle_seconds=5, popularity_window=24 * 3600, session_ttl=3600,
+                 max_queue=500, max_works=10000):
+        self.generate = generate
+        self.cache = cache
+        self.load = load
+        self.mode = mode
+        self.tiers = sorted(tiers)
+        self.max_per_hour = max_per_hour
+        self.max_foreground = max_foreground
+        self.idle_seconds = idle_seconds
+        self.popularity_window = popularity_window
+        self.session_ttl = session_ttl
+        self.max_queue = max_queue
+        self.max_works = max_works
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._queue = []
+        self._queued = set()
+        self._sequence = 0
+        self._requests = {}
+        self._sessions = {}
+        self._started = deque()
+        self._thread = None
+        self.prefetched = 0
+        self.cancelled = 0
+        self.failed = 0
+        self.skipped_cached = 0
+        self.tokens = 0
+        self.hits = 0
+        self.latency_saved_ms = 0
+        self._used_entries = set()
+
+    def namespace(self, aspect, mode=None):
+        return f'{mode or self.mode}:{aspect}'
+
+    def resolve_followup(self, content, history=None, session=None, mode=None):
+        """Return (cache prompt, namespace) when content is a generic follow-up about a known work.
+
+        With history the work is the first user message of the
+        conversation; without it, the last work of the session, which the
+        message must then name because upstream only sees the message.
+        Messages asking about anything else (a character, another work)
+        return None and are cached as ordinary prompts.
+        """
+        aspect = detect_aspect(content)
+        if not aspect:
+            return None
+
+        subject = subject_terms(content, aspect)
+        if history:
+            work = next((str(item.get('content', '')) for item in history
+                         if isinstance(item, dict) and item.get('role') == 'user'), '')
+        elif subject:
+            work = self._session_work(session)
+        else:
+            return None
+        # Anything beyond the work's own words ("Татьяны", "Грозы" in an
+        # Onegin conversation) makes it a different question.
+        if not work or detect_aspect(work) or not covers(subject, prompt_terms(work)):
+            return None
+        return aspect_question(work, aspect), self.namespace(aspect, mode)
+
+    def _session_work(self, session):
+        if session is None:
+            return None
+        with self._cond:
+            entry = self._sessions.get(session)
+        if not entry or time.time() - entry[1] > self.session_ttl:
+            return None
+        return entry[0]
+
+    def note_work(self, prompt, session=None):
+        """Count a standalone work request and queue follow-ups its popularity earns."""
+        if detect_aspect(prompt):
+            return
+        key = work_key(prompt)
+        if not key:
+            return
+
+        now = time.time()
+        with self._cond:
+            if session is not None:
+                self._sessions[session] = (prompt, now)
+                if len(self._sessions) > 10000:
+                    self._prune_sessions(now)
+            if key not in self._requests and len(self._requests) >= self.max_works:
+                self._prune_requests(now)
+            times = self._requests.setdefault(key, deque())
+            times.append(now)
+            while times and now - times[0] > self.popularity_window:
+                times.popleft()
+            popularity = len(times)
+
+            count = 0
+            for min_requests, aspect_count in self.tiers:
+                if popularity >= min_requests:
+                    count = aspect_count
+            for aspect in ASPECTS[:count]:
+                task_key = (key, aspect)
+                if task_key in self._queued:
+                    continue
+                self._queued.add(task_key)
+                self._sequence += 1
+                heapq.heappush(self._queue, (-popularity, self._sequence, key, prompt, aspect, 0))
+            if len(self._queue) > self.max_queue:
+                self._trim_queue()
+            self._cond.notify_all()
+
+    def _prune_sessions(self, now):
+        for session, (_, seen_at) in list(self._sessions.items()):
+            if now - seen_at > self.session_ttl:
+                del self._sessions[session]
+
+    def _prune_requests(self, now):
+        """Forget works not asked within the popularity window, then the least recent ones."""
+        for key, times in list(self._requests.items()):
+            if not times or now - times[-1] > self.popularity_window:
+                del self._requests[key]
+        excess = len(self._requests) - self.max_works + 1
+        if excess > 0:
+            for key in heapq.nsmallest(excess, self._requests, key=lambda item: self._requests[item][-1]):
+                del self._requests[key]
+
+    def _trim_queue(self):
+        """Keep the max_queue most popular tasks."""
+        kept = heapq.nsmallest(self.max_queue, self._queue)
+        for task in set(self._queue) - set(kept):
+            self._queued.discard((task[2], task[4]))
+        self._queue = kept
+        heapq.heapify(self._queue)
+
+    def record_hit(self, entry):
+        """Count a cache hit on a prefetched entry."""
+        with self._cond:
+            self.hits += 1
+            self._used_entries.add(entry.entry_id)
+            self.latency_saved_ms += entry.meta.get('latency_ms', 0)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='prefetcher', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        with self._cond:
+            self._cond.notify_all()
+
+    def _busy(self):
+        return self.load() > self.max_foreground
+
+    def _wait_idle(self):
+        """Block until foreground load stays low for idle_seconds and the hourly budget allows a call."""
+        idle_since = None
+        while not self._stop.is_set():
+            now = time.time()
+            while self._started and now - self._started[0] > 3600:
+                self._started.popleft()
+            if self._busy() or len(self._started) >= self.max_per_hour:
+                idle_since = None
+            elif idle_since is None:
+                idle_since = now
+            elif now - idle_since >= self.idle_seconds:
+                return True
+            self._stop.wait(0.5)
+        return False
+
+    def _run(self):
+        while not self._stop.is_set():
+            with self._cond:
+                while not self._queue and not self._stop.is_set():
+                    self._cond.wait()
+                if self._stop.is_set():
+                    return
+                task = heapq.heappop(self._queue)
+            priority, _, key, prompt, aspect, attempts = task
+            namespace = self.namespace(aspect)
+            question = aspect_question(prompt, aspect)
+
+            if self.cache.contains(question, namespace):
+                with self._cond:
+                    self.skipped_cached += 1
+                    self._queued.discard((key, aspect))
+                continue
+            if not self._wait_idle():
+                return
+
+            self._started.append(time.time())
+            started = time.time()
+            try:
+                reply, usage = self.generate(question, self.mode, self._busy)
+            except PrefetchCancelled as e:
+                tokens = e.usage.get('prompt_tokens', 0) + e.usage.get('completion_tokens', 0)
+                print(f'[LOG] Prefetch cancelled by foreground load: {prompt[:40]} ({aspect}, {tokens} tokens spent)')
+                with self._cond:
+                    self.cancelled += 1
+                    self.tokens += tokens
+                    if attempts + 1 < MAX_ATTEMPTS:
+                        self._sequence += 1
+                        heapq.heappush(self._queue, (priority, self._sequence, key, prompt, aspect, attempts + 1))
+                    else:
+                        self._queued.discard((key, aspect))
+                continue
+            except Exception as e:
+                print(f'[ERROR] Prefetch failed for {prompt[:40]} ({aspect}): {e}')
+                with self._cond:
+                    self.failed += 1
+                    self._queued.discard((key, aspect))
+                continue
+
+            latency_ms = (time.time() - started) * 1000
+            tokens = usage.get('prompt_tokens', 0) + usage.get('completion_tokens', 0)
+            if reply:
+                self.cache.add(question, reply, namespace=namespace,
+                               meta={'prefetch': True, 'latency_ms': latency_ms, 'tokens': tokens})
+            with self._cond:
+                self.prefetched += 1
+                self.tokens += tokens
+                self._queued.discard((key, aspect))
+            print(f'[LOG] Prefetched {aspect} for {prompt[:40]} ({latency_ms:.0f}ms, {tokens} tokens)')
+
+    def stats(self):
+        with self._cond:
+            used = len(self._used_entries)
+            return {
+                'queued': len(self._queue),
+                'prefetched': self.prefetched,
+                'cancelled': self.cancelled,
+                'failed': self.failed,
+                'skipped_cached': self.skipped_cached,
+                'tokens': self.tokens,
+                'hits': self.hits,
+                'used_entries': used,
+                'hit_rate': used / self.prefetched if self.prefetched else 0.0,
+                'tokens_per_hit': self.tokens / self.hits if self.hits else 0.0,
+                'latency_saved_ms': self.latency_saved_ms,
+            }
@@ -0,0 +1,199 @@
+"""On-demand sampling profiler and tracemalloc diffs for the running bot.
+
+Both functions block the calling thread for the requested duration and
+return a plain-text report, so run them off the polling thread.
+
+The sampler reads wall-clock stacks: a thread blocked in a C call still
+shows its last Python frame. Samples whose leaf is a known blocking call
+(condition and queue waits, select, socket reads) are reported in their
+own section, grouped by stack with the peak number of threads stuck
+there at once, and kept out of the CPU hot-path ranking. Threads blocked
+directly in Lock.acquire or time.sleep cannot be told apart this way and
+rank as running.
+"""
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+MAX_STACK_DEPTH = 40
+
+# Leaf frames (file, function) that only wait for a lock, a timer or I/O.
+BLOCKED_LEAVES = {
+    ('threading.py', 'wait'),
+    ('threading.py', '_wait_for_tstate_lock'),
+    ('selectors.py', 'select'),
+    ('socket.py', 'readinto'),
+    ('socket.py', 'accept'),
+    ('ssl.py', 'read'),
+    ('ssl.py', 'recv_into'),
+    ('ssl.py', 'do_handshake'),
+    ('subprocess.py', '_try_wait'),
+    ('connection.py', 'create_connection'),
+}
+
+
+def _is_blocked(frame):
+    code = frame.f_code
+    return (os.path.basename(code.co_filename), code.co_name) in BLOCKED_LEAVES
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}"
+
+
+def _function_label(frame):
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+def sample_stacks(duration, interval=0.005):
+    """Sample stacks of all threads for duration seconds and return a text report."""
+    own_ident = threading.get_ident()
+    stack_counts = Counter()
+    self_counts = Counter()
+    total_counts = Counter()
+    thread_counts = Counter()
+    blocked_counts = Counter()
+    blocked_threads = {}
+    blocked_peak = Counter()
+    blocked_thread_counts = Counter()
+    samples = 0
+    started = time.perf_counter()
+    deadline = started + duration
+
+    while time.perf_counter() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        blocked_now = Counter()
+        for ident, frame in sys._current_frames().items():
+            if ident == own_ident:
+                continue
+            blocked = _is_blocked(frame)
+            thread_name = names.get(ident, f'thread-{ident}')
+            labels = []
+            functions = set()
+            while frame is not None and len(labels) < MAX_STACK_DEPTH:
+                labels.append(_frame_label(frame))
+                functions.add(_function_label(frame))
+                frame = frame.f_back
+            if not labels:
+                continue
+            labels.reverse()
+            stack = tuple(labels)
+            if blocked:
+                # Grouped by stack across threads: many threads on one
+                # stack is a pile-up behind the same lock or queue.
+                blocked_counts[stack] += 1
+                blocked_now[stack] += 1
+                blocked_threads.setdefault(stack, set()).add(thread_name)
+                blocked_thread_counts[thread_name] += 1
+                continue
+            stack_counts[(thread_name, stack)] += 1
+            self_counts[labels[-1].rsplit(':', 1)[0]] += 1
+            total_counts.update(functions)
+            thread_counts[thread_name] += 1
+        for stack, count in blocked_now.items():
+            blocked_peak[stack] = max(blocked_peak[stack], count)
+        samples += 1
+        time.sleep(interval)
+
+    elapsed = time.perf_counter() - started
+    stack_total = sum(stack_counts.values()) or 1
+    blocked_total = sum(blocked_counts.values())
+    lines = [
+        'Pushkin AI wall-clock profile',
+        f'Duration: {elapsed:.1f}s, samples: {samples}, interval: {interval * 1000:.0f}ms',
+        f'Running thread samples: {sum(stack_counts.values())}, blocked (wait/select/recv): {blocked_total}',
+        '',
+        'Samples per running thread:',
+    ]
+    for thread_name, count in thread_counts.most_common():
+        lines.append(f'  {count:>7}  {thread_name}')
+
+    lines += ['', 'Top functions (self):']
+    for label, count in self_counts.most_common(25):
+        lines.append(f'  {count / stack_total * 100:6.1f}%  {label}')
+
+    lines += ['', 'Top functions (inclusive):']
+    for label, count in total_counts.most_common(25):
+        lines.append(f'  {count / stack_total * 100:6.1f}%  {label}')
+
+    lines += ['', 'Top stacks:']
+    for (thread_name, stack), count in stack_counts.most_common(15):
+        lines.append(f'--- {count / stack_total * 100:.1f}% ({count} samples) [{thread_name}]')
+        for label in stack[-12:]:
+            lines.append(f'    {label}')
+
+    lines += ['', 'Samples per blocked thread:']
+    for thread_name, count in blocked_thread_counts.most_common():
+        lines.append(f'  {count:>7}  {thread_name}')
+
+    lines += ['', 'Blocked stacks (peak threads waiting at once):']
+    for stack, count in blocked_counts.most_common(15):
+        threads = blocked_threads[stack]
+        lines.append(
+            f'--- {count / (blocked_total or 1) * 100:.1f}% ({count} samples), '
+            f'peak {blocked_peak[stack]} thread(s), {len(threads)} distinct: {", ".join(sorted(threads)[:5])}'
+        )
+        for label in stack[-12:]:
+            lines.append(f'    {label}')
+
+    lines += ['', 'Collapsed stacks (flamegraph.pl / speedscope input):']
+    for (thread_name, stack), count in stack_counts.most_common():
+        lines.append(f"{thread_name};{';'.join(stack)} {count}")
+    for stack, count in blocked_counts.most_common():
+        lines.append(f"blocked;{';'.join(stack)} {count}")
+
+    return '\n'.join(lines) + '\n'
+
+
+def tracemalloc_diff(duration, limit=25, frames=5):
+    """Diff two tracemalloc snapshots taken duration seconds apart."""
+    started_here = not tracemalloc.is_tracing()
+    if started_here:
+        tracemalloc.start(frames)
+
+    try:
+        before = tracemalloc.take_snapshot()
+        time.sleep(duration)
+        after = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        if started_here:
+            tracemalloc.stop()
+
+    filters = [
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    ]
+    before = before.filter_traces(filters)
+    after = after.filter_traces(filters)
+
+    lines = [
+        'Pushkin AI memory profile',
+        f'Interval: {duration:.1f}s, traced now: {current / 1024:.1f} KiB, peak: {peak / 1024:.1f} KiB',
+    ]
+    if started_here:
+        lines.append('Note: tracing started with this command; allocations made earlier are not attributed.')
+
+    lines += ['', f'Top {limit} allocation sites by growth:']
+    for stat in after.compare_to(before, 'lineno')[:limit]:
+        lines.append(
+            f'  {stat.size_diff / 1024:+10.1f} KiB  {stat.count_diff:+8} blocks  '
+            f'(now {stat.size / 1024:.1f} KiB)  {stat.traceback}'
+        )
+
+    lines += ['', f'Top {limit} allocation sites by size:']
+    for stat in after.statistics('lineno')[:limit]:
+        lines.append(f'  {stat.size / 1024:10.1f} KiB  {stat.count:8} blocks  {stat.traceback}')
+
+    lines += ['', 'Largest growth with traceback:']
+    for stat in after.compare_to(before, 'traceback')[:5]:
+        lines.append(f'--- {stat.size_diff / 1024:+.1f} KiB')
+        for line in stat.traceback.format():
+            lines.append(f'    {line}')
+
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,208 @@
+"""Durable SQLite journal of accepted updates and answer jobs.
+
+Keeps the last processed Telegram update_id and every prompt that still
+needs an answer, so restarts (/reset, crashes, 409 exits) neither drop
+work nor bill the same prompt upstream twice.
+"""
+import json
+import sqlite3
+import threading
+import time
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+UNFINISHED_STATES = (JOB_QUEUED, JOB_RUNNING)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS updates (
+    update_id INTEGER PRIMARY KEY,
+    received_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    origin TEXT NOT NULL,
+    chat_id INTEGER,
+    user_id INTEGER,
+    prompt TEXT NOT NULL,
+    history TEXT,
+    mode TEXT,
+    summary TEXT,
+    state TEXT NOT NULL,
+    result TEXT,
+    error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_state_idx ON jobs (state);
+"""
+
+# Columns added after the first release, for journals created before them.
+JOB_COLUMNS_ADDED = (('mode', 'TEXT'), ('summary', 'TEXT'))
+
+
+class RequestJournal:
+    """Thread-safe write-ahead journal backed by one SQLite connection."""
+
+    def __init__(self, path):
+        self.path = str(path)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=10)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.executescript(SCHEMA)
+            columns = {row['name'] for row in self._conn.execute('PRAGMA table_info(jobs)')}
+            for name, column_type in JOB_COLUMNS_ADDED:
+                if name not in columns:
+                    self._conn.execute(f'ALTER TABLE jobs ADD COLUMN {name} {column_type}')
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def get_last_update_id(self):
+        """Return the last fully processed Telegram update_id (0 if none)."""
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = 'last_update_id'").fetchone()
+        return int(row['value']) if row else 0
+
+    def set_last_update_id(self, update_id):
+        """Persist update offset; never moves it backwards."""
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO meta (key, value) VALUES ('last_update_id', ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = excluded.value "
+                "WHERE CAST(meta.value AS INTEGER) < CAST(excluded.value AS INTEGER)",
+                (str(int(update_id)),)
+            )
+
+    def get_meta(self, key, default=None):
+        """Return a persisted setting, or default when unset."""
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row['value'] if row else default
+
+    def set_meta(self, key, value):
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO meta (key, value) VALUES (?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                (key, str(value))
+            )
+
+    def accept_update(self, update_id, job=None):
+        """Record update (and its job) atomically; False if it was seen before."""
+        now = time.time()
+        with self._lock:
+            try:
+                self._conn.execute('BEGIN IMMEDIATE')
+                cursor = self._conn.execute(
+                    'INSERT OR IGNORE INTO updates (update_id, received_at) VALUES (?, ?)',
+                    (int(update_id), now)
+                )
+                accepted = cursor.rowcount == 1
+                if accepted and job:
+                    self._insert_job(job, now)
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+        return accepted
+
+    def create_job(self, job_id, origin, prompt, chat_id=None, user_id=None, history=None, mode=None,
+                   summary=None):
+        """Queue a new job; False if a job with this id already exists.
+
+        mode and summary are the Mini App answer tier and, for an
+        expansion, the summary being expanded.
+        """
+        job = {
+            'job_id': job_id,
+            'origin': origin,
+            'chat_id': chat_id,
+            'user_id': user_id,
+            'prompt': prompt,
+            'history': history,
+            'mode': mode,
+            'summary': summary,
+        }
+        with self._lock:
+            return self._insert_job(job, time.time())
+
+    def _insert_job(self, job, now):
+        history = job.get('history')
+        cursor = self._conn.execute(
+            'INSERT OR IGNORE INTO jobs '
+            '(job_id, origin, chat_id, user_id, prompt, history, mode, summary, state, created_at, updated_at) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (
+                job['job_id'],
+                job['origin'],
+                job.get('chat_id'),
+                job.get('user_id'),
+                job['prompt'],
+                json.dumps(history, ensure_ascii=False) if history else None,
+                job.get('mode'),
+                job.get('summary'),
+                JOB_QUEUED,
+                now,
+                now,
+            )
+        )
+        return cursor.rowcount == 1
+
+    def get_job(self, job_id):
+        with self._lock:
+            row = self._conn.execute('SELECT * FROM jobs WHERE job_id = ?', (job_id,)).fetchone()
+        return self._row_to_job(row) if row else None
+
+    def mark_running(self, job_id):
+        self._set_state(job_id, JOB_RUNNING)
+
+    def mark_done(self, job_id, result=None):
+        self._set_state(job_id, JOB_DONE, result=result)
+
+    def mark_failed(self, job_id, error):
+        self._set_state(job_id, JOB_FAILED, error=str(error)[:500])
+
+    def _set_state(self, job_id, state, result=None, error=None):
+        with self._lock:
+            self._conn.execute(
+                'UPDATE jobs SET state = ?, result = ?, error = ?, updated_at = ? WHERE job_id = ?',
+                (state, result, error, time.time(), job_id)
+            )
+
+    def unfinished_jobs(self, origin=None):
+        """Return queued and running jobs, oldest first."""
+        query = 'SELECT * FROM jobs WHERE state IN (?, ?)'
+        params = list(UNFINISHED_STATES)
+        if origin:
+            query += ' AND origin = ?'
+            params.append(origin)
+        query += ' ORDER BY created_at'
+        with self._lock:
+            rows = self._conn.execute(query, params).fetchall()
+        return [self._row_to_job(row) for row in rows]
+
+    def prune(self, max_age_seconds):
+        """Delete finished jobs and seen update ids older than max_age_seconds."""
+        cutoff = time.time() - max_age_seconds
+        with self._lock:
+            self._conn.execute(
+                'DELETE FROM jobs WHERE state IN (?, ?) AND updated_at < ?',
+                (JOB_DONE, JOB_FAILED, cutoff)
+            )
+            self._conn.execute('DELETE FROM updates WHERE received_at < ?', (cutoff,))
+
+    @staticmethod
+    def _row_to_job(row):
+        job = dict(row)
+        job['history'] = json.loads(job['history']) if job['history'] else None
+        return job
@@ -0,0 +1,477 @@
+"""Local semantic cache for near-duplicate literature prompts.
+
+Prompts are embedded on CPU with the hashing trick over word stems and
+their character trigrams, indexed with random-hyperplane LSH and matched
+by cosine similarity. No network and no model files are needed.
+
+Similarity alone lets "<work> <character>" match "<work>", since the
+shared title dominates the vector. A match therefore also needs every
+content stem of each prompt to be covered by the other one, exactly or
+by a near spelling (typos, inflection). Known author surnames stay out
+of the vector and only have to agree when both prompts name an author,
+so "Гроза" matches "Гроза, Островский".
+
+Usage:
+    python semantic_cache.py eval [--journal pushkin_journal.db | --prompts prompts.txt |
+                                   --labeled cache_eval_prompts.tsv]
+                                  [--thresholds 0.8,0.85,0.9,0.95] [--show 15]
+"""
+import argparse
+import math
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parent
+EMBEDDING_DIM = 1024
+LSH_TABLES = 8
+LSH_BITS = 8
+STEM_LENGTH = 5
+TRIGRAM_WEIGHT = 0.3
+# Trigram Dice similarity from which two stems count as the same word.
+FUZZY_STEM_MIN = 0.6
+
+# Request wording that does not change which analysis the user wants.
+STOP_WORDS = {
+    'и', 'в', 'во', 'на', 'о', 'об', 'про', 'по', 'с', 'со', 'к', 'из', 'у', 'за', 'для', 'а', 'же',
+    'как', 'что', 'это', 'мне', 'пожалуйста', 'the', 'of', 'in', 'a', 'an', 'and',
+    'анализ', 'разбор', 'разбери', 'проанализируй', 'сделай', 'напиши', 'расскажи', 'дай',
+    'произведение', 'произведения', 'роман', 'романа', 'романе', 'поэма', 'поэмы', 'поэме',
+    'пьеса', 'пьесы', 'пьесе', 'рассказ', 'рассказа', 'повесть', 'повести', 'стихотворение',
+    'стихотворения', 'автор', 'автора', 'analysis', 'analyze',
+    # Authors' first names: "Лев Толстой" and "Толстой" ask for the same work.
+    'лев', 'льва', 'александр', 'александра', 'михаил', 'михаила', 'федор', 'федора',
+    'николай', 'николая', 'антон', 'антона', 'иван', 'ивана', 'сергей', 'сергея',
+    'борис', 'бориса', 'владимир', 'владимира', 'максим', 'максима', 'алексей', 'алексея',
+    'афанасий', 'афанасия',
+}
+
+# Surname stems of curriculum authors; a title alone already names the work.
+AUTHOR_STEMS = {
+    'пушки', 'лермо', 'толст', 'досто', 'гогол', 'чехов', 'турге', 'остро', 'гонча', 'грибо',
+    'булга', 'некра', 'есени', 'ахмат', 'цвета', 'маяко', 'шолох', 'солже', 'бунин',
+    'купри', 'горьк', 'пасте', 'плато', 'салты', 'щедри', 'карам', 'фонви', 'держа',
+    'жуков', 'тютче', 'фет', 'фета', 'блок', 'блока', 'леско', 'замят', 'набок',
+    'радищ', 'крыло', 'шексп', 'гете',
+}
+
+# Stems of request wording with the same meaning.
+STEM_SYNONYMS = {
+    'харак': 'образ',
+    'персо': 'герои',
+    'герой': 'герои',
+    'героя': 'герои',
+    'герое': 'герои',
+}
+
+# Stems that only say "analyse this", like "анализ", once the prompt names
+# a character and a work: "образ Татьяны в Евгении Онегине" asks for the
+# same answer as "анализ Татьяны Онегин". With one name they stay, since
+# "Образ Обломова" (the character) is not "Обломов" (the novel).
+WORDING_STEMS = {'образ'}
+
+# Curriculum titles and the name that identifies each on its own: a
+# prompt naming "Онегин" gets the stems of "Евгений Онегин". Titles made
+# of common words ("Война и мир") are not completed from a part.
+WORK_TITLES = (
+    ('Евгений Онегин', 'Онегин'),
+    ('Мастер и Маргарита', 'Маргарита'),
+    ('Анна Каренина', 'Каренина'),
+    ('Братья Карамазовы', 'Карамазовы'),
+    ('Тарас Бульба', 'Бульба'),
+    ('Старуха Изергиль', 'Изергиль'),
+    ('Борис Годунов', 'Годунов'),
+    ('Слово о полку Игореве', 'Игореве'),
+    ('Матренин двор', 'Матренин'),
+)
+
+# Letters Russian case endings are made of; stripped before hashing a stem.
+ENDING_LETTERS = 'аеиоуыэюяйхм'
+
+_TOKEN_RE = re.compile(r'[0-9a-zа-я]+')
+
+
+def _stems(text):
+    text = str(text).lower().replace('ё', 'е')
+    stems = []
+    for token in _TOKEN_RE.findall(text):
+        if token in STOP_WORDS or len(token) < 2:
+            continue
+        stem = token[:STEM_LENGTH]
+        stems.append(STEM_SYNONYMS.get(stem, stem))
+    named = [stem for stem in stems if stem not in WORDING_STEMS and stem not in AUTHOR_STEMS]
+    if len(named) >= 2:
+        return [stem for stem in stems if stem not in WORDING_STEMS]
+    return stems
+
+
+def prompt_terms(text):
+    """Return content stems of a prompt, with partly named work titles completed."""
+    stems = _stems(text)
+    for title, name in _TITLE_STEMS:
+        if any(_same_word(stem, name) for stem in stems):
+            stems.extend(title_stem for title_stem in title
+                         if not any(_same_word(stem, title_stem) for stem in stems))
+    return stems
+
+
+def _trigrams(stem):
+    padded = f'#{stem}#'
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def _same_word(left, right):
+    if left == right:
+        return True
+    # Same word in another case: "гроза" / "грозы", short ones "души" / "душах".
+    prefix = len(os.path.commonprefix((left, right)))
+    if prefix >= 4 or prefix >= 3 and min(len(left), len(right)) <= 4:
+        return True
+    left, right = _trigrams(left), _trigrams(right)
+    return 2 * len(left & right) / (len(left) + len(right)) >= FUZZY_STEM_MIN
+
+
+_TITLE_STEMS = [(_stems(title), _stems(name)[0]) for title, name in WORK_TITLES]
+
+
+def covers(terms, other_terms):
+    """True if every stem of terms has an equal or near-spelled stem in other_terms."""
+    return all(any(_same_word(term, other) for other in other_terms) for term in terms)
+
+
+def terms_match(terms, other_terms):
+    """True if two prompts' stems ask for the same thing.
+
+    Content stems must cover each other; author surnames only when both
+    prompts name one.
+    """
+    content = {term for term in terms if term not in AUTHOR_STEMS}
+    other_content = {term for term in other_terms if term not in AUTHOR_STEMS}
+    if not covers(content, other_content) or not covers(other_content, content):
+        return False
+    authors = set(terms) - content
+    other_authors = set(other_terms) - other_content
+    if authors and other_authors:
+        return covers(authors, other_authors) and covers(other_authors, authors)
+    return True
+
+
+def _bucket(feature):
+    value = zlib.crc32(feature.encode('utf-8'))
+    return value % EMBEDDING_DIM, 1.0 if (value >> 16) & 1 else -1.0
+
+
+def _root(stem):
+    """Stem without a trailing case ending: "душах" and "души" both give "душ"."""
+    root = stem.rstrip(ENDING_LETTERS)
+    return root if len(root) >= 3 else stem
+
+
+def embed(text):
+    """Embed prompt into a sparse L2-normalized {dimension: weight} vector."""
+    vector = {}
+    for stem in set(prompt_terms(text)) - AUTHOR_STEMS:
+        features = [(f'w:{_root(stem)}', 1.0)]
+        padded = f'#{stem}#'
+        features.extend((f't:{padded[i:i + 3]}', TRIGRAM_WEIGHT) for i in range(len(padded) - 2))
+        for feature, weight in features:
+            dim, sign = _bucket(feature)
+            vector[dim] = vector.get(dim, 0.0) + sign * weight
+
+    norm = math.sqrt(sum(value * value for value in vector.values()))
+    if not norm:
+        return {}
+    return {dim: value / norm for dim, value in vector.items() if value}
+
+
+def cosine(left, right):
+    """Cosine similarity of two normalized sparse vectors."""
+    if len(left) > len(right):
+        left, right = right, left
+    return sum(value * right.get(dim, 0.0) for dim, value in left.items())
+
+
+class CacheEntry:
+    __slots__ = ('entry_id', 'namespace', 'prompt', 'answer', 'vector', 'terms', 'keys', 'created_at', 'size',
+                 'hits', 'meta')
+
+    def __init__(self, entry_id, namespace, prompt, answer, vector, keys, meta):
+        self.entry_id = entry_id
+        self.namespace = namespace
+        self.prompt = prompt
+        self.answer = answer
+        self.vector = vector
+        self.terms = frozenset(prompt_terms(prompt))
+        self.keys = keys
+        self.created_at = time.time()
+        self.size = len(prompt.encode('utf-8')) + len(answer.encode('utf-8')) + 48 * len(vector)
+        self.hits = 0
+        self.meta = meta or {}
+
+
+class SemanticCache:
+    """LRU-bounded approximate nearest-neighbour cache of prompt answers."""
+
+    def __init__(self, threshold=0.9, max_entries=2000, max_bytes=64 * 1024 * 1024, ttl=7 * 24 * 3600, seed=20240611):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        rng = random.Random(seed)
+        self._planes = [
+            [[rng.gauss(0.0, 1.0) for _ in range(EMBEDDING_DIM)] for _ in range(LSH_BITS)]
+            for _ in range(LSH_TABLES)
+        ]
+        self._entries = OrderedDict()
+        self._buckets = {}
+        self._next_id = 0
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _lsh_keys(self, namespace, vector):
+        keys = []
+        for table, planes in enumerate(self._planes):
+            bits = 0
+            for plane in planes:
+                projection = sum(value * plane[dim] for dim, value in vector.items())
+                bits = (bits << 1) | (projection >= 0)
+            keys.append((namespace, table, bits))
+        return keys
+
+    def _closest(self, vector, keys, terms, allow_stale=False):
+        """Return (entry, similarity) of the best candidate; call with the lock held.
+
+        Candidates whose stems don't match the prompt's (terms_match) are
+        skipped.
+        """
+        now = time.time()
+        best = None
+        best_score = 0.0
+        seen = set()
+        for key in keys:
+            for entry_id in self._buckets.get(key, ()):
+                if entry_id in seen:
+                    continue
+                seen.add(entry_id)
+                entry = self._entries[entry_id]
+                if not allow_stale and now - entry.created_at > self.ttl:
+                    continue
+                score = cosine(vector, entry.vector)
+                if score <= best_score or not terms_match(terms, entry.terms):
+                    continue
+                best, best_score = entry, score
+        return best, best_score
+
+    def lookup(self, prompt, namespace='full', allow_stale=False):
+        """Return (answer, similarity, entry) for the closest cached prompt, or None.
+
+        allow_stale also returns entries past ttl (they stay until evicted),
+        e.g. when upstream is overloaded.
+        """
+        vector = embed(prompt)
+        if not vector:
+            return None
+        keys = self._lsh_keys(namespace, vector)
+
+        terms = set(prompt_terms(prompt))
+
+        with self._lock:
+            best, best_score = self._closest(vector, keys, terms, allow_stale)
+            if best is None or best_score < self.threshold:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            best.hits += 1
+            self._entries.move_to_end(best.entry_id)
+            return best.answer, best_score, best
+
+    def contains(self, prompt, namespace='full'):
+        """True if lookup() would hit; does not touch statistics or LRU order."""
+        vector = embed(prompt)
+        if not vector:
+            return False
+        keys = self._lsh_keys(namespace, vector)
+        terms = set(prompt_terms(prompt))
+        with self._lock:
+            best, best_score = self._closest(vector, keys, terms)
+        return best is not None and best_score >= self.threshold
+
+    def add(self, prompt, answer, namespace='full', meta=None):
+        """Store answer for prompt, evicting least recently used entries over the bounds."""
+        vector = embed(prompt)
+        if not vector or not answer:
+            return None
+        keys = self._lsh_keys(namespace, vector)
+
+        with self._lock:
+            entry = CacheEntry(self._next_id, namespace, prompt, answer, vector, keys, meta)
+            self._next_id += 1
+            self._entries[entry.entry_id] = entry
+            self._bytes += entry.size
+            for key in keys:
+                self._buckets.setdefault(key, []).append(entry.entry_id)
+
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                self._evict_oldest()
+            return entry
+
+    def _evict_oldest(self):
+        _, entry = self._entries.popitem(last=False)
+        self._bytes -= entry.size
+        self.evictions += 1
+        for key in entry.keys:
+            bucket = self._buckets.get(key)
+            if not bucket:
+                continue
+            bucket.remove(entry.entry_id)
+            if not bucket:
+                del self._buckets[key]
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+            }
+
+
+def load_prompts(args):
+    """Read recorded standalone prompts from the request journal or a text file."""
+    if args.prompts:
+        with open(args.prompts, 'r', encoding='utf-8') as prompts_file:
+            return [line.strip() for line in prompts_file if line.strip()]
+
+    conn = sqlite3.connect(args.journal)
+    try:
+        rows = conn.execute(
+            'SELECT prompt FROM jobs WHERE history IS NULL ORDER BY created_at'
+        ).fetchall()
+    finally:
+        conn.close()
+    return [row[0] for row in rows if row[0] and len(row[0]) >= 5]
+
+
+def load_labeled_prompts(path):
+    """Read "group<TAB>prompt" lines; prompts of one group ask for the same answer."""
+    labeled = []
+    with open(path, 'r', encoding='utf-8') as prompts_file:
+        for line in prompts_file:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                group, prompt = line.split('\t', 1)
+                labeled.append((group, prompt))
+    return labeled
+
+
+def evaluate_labeled(labeled, threshold):
+    """Replay labeled prompts in order; returns (hits, repeats, false hits, false matches).
+
+    repeats counts prompts whose group was asked before, i.e. the ones a
+    perfect cache would answer; a hit on another group is a false hit.
+    """
+    cache = SemanticCache(threshold=threshold)
+    seen = set()
+    hits = repeats = false_hits = 0
+    false_matches = []
+    for group, prompt in labeled:
+        repeats += group in seen
+        found = cache.lookup(prompt)
+        if found:
+            _, score, entry = found
+            if entry.answer == group:
+                hits += 1
+            else:
+                false_hits += 1
+                false_matches.append((score, prompt, entry.prompt))
+        else:
+            cache.add(prompt, group)
+        seen.add(group)
+    return hits, repeats, false_hits, false_matches
+
+
+def command_eval_labeled(args):
+    labeled = load_labeled_prompts(args.labeled)
+    print(f'[LOG] Replaying {len(labeled)} labeled prompts')
+    print(f"{'threshold':>10} {'hit rate':>9} {'false hits':>11}")
+    false_samples = {}
+    for threshold in [float(value) for value in args.thresholds.split(',')]:
+        hits, repeats, false_hits, false_matches = evaluate_labeled(labeled, threshold)
+        hit_rate = hits / repeats * 100 if repeats else 0.0
+        print(f'{threshold:>10.2f} {hit_rate:>8.1f}% {false_hits / len(labeled) * 100:>10.1f}%'
+              f'  ({hits}/{repeats} repeats, {false_hits} false)')
+        false_samples[threshold] = false_matches
+
+    lowest = min(false_samples)
+    if false_samples[lowest]:
+        print(f'\nFalse hits at {lowest:.2f}:')
+        for score, prompt, cached_prompt in sorted(false_samples[lowest], reverse=True)[:args.show]:
+            print(f'  {score:.3f}  {prompt!r} -> {cached_prompt!r}')
+
+
+def command_eval(args):
+    """Replay recorded prompts through the cache and report hit rate per threshold."""
+    if args.labeled:
+        command_eval_labeled(args)
+        return
+    prompts = load_prompts(args)
+    if not prompts:
+        print('[WARNING] No recorded prompts found.')
+        return
+    print(f'[LOG] Replaying {len(prompts)} prompts')
+    print(f"{'threshold':>10} {'hit rate':>9} {'hits':>6}")
+
+    samples = {}
+    for threshold in [float(value) for value in args.thresholds.split(',')]:
+        cache = SemanticCache(threshold=threshold, max_entries=args.max_entries)
+        matched = []
+        for prompt in prompts:
+            found = cache.lookup(prompt)
+            if found:
+                _, score, entry = found
+                if entry.prompt != prompt:
+                    matched.append((score, prompt, entry.prompt))
+            else:
+                cache.add(prompt, prompt)
+        print(f'{threshold:>10.2f} {cache.hits / len(prompts) * 100:>8.1f}% {cache.hits:>6}')
+        samples[threshold] = matched
+
+    lowest = min(samples)
+    print(f'\nParaphrase matches at {lowest:.2f} (check for false hits):')
+    for score, prompt, cached_prompt in sorted(samples[lowest])[:args.show]:
+        print(f'  {score:.3f}  {prompt!r} -> {cached_prompt!r}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline tools for the Pushkin AI semantic cache.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    eval_parser = subparsers.add_parser('eval', help='hit rate of recorded prompts per threshold')
+    eval_parser.add_argument('--journal', default=str(BASE_DIR / 'pushkin_journal.db'))
+    eval_parser.add_argument('--prompts', help='text file with one prompt per line')
+    eval_parser.add_argument('--labeled', help='"group<TAB>prompt" file; also reports false hits')
+    eval_parser.add_argument('--thresholds', default='0.75,0.8,0.85,0.9,0.95')
+    eval_parser.add_argument('--max-entries', type=int, default=2000)
+    eval_parser.add_argument('--show', type=int, default=15)
+    eval_parser.set_defaults(handler=command_eval)
+
+    args = parser.parse_args()
+    args.handler(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+"""Validation of Telegram Mini App initData.
+
+The Mini App client can send any user id; only the signed initData
+string Telegram hands to the page proves who the user is. See
+https://core.telegram.org/bots/webapps#validating-data-received-via-the-mini-app
+"""
+import hashlib
+import hmac
+import json
+import time
+from urllib.parse import parse_qsl
+
+
+def verify_init_data(init_data, bot_token, max_age=24 * 3600, now=None):
+    """Return the Telegram user dict from initData, or None if it is not signed by bot_token.
+
+    Data older than max_age seconds is rejected as well.
+    """
+    if not init_data or not bot_token:
+        return None
+    try:
+        fields = dict(parse_qsl(str(init_data), keep_blank_values=True, strict_parsing=True))
+    except ValueError:
+        return None
+    received_hash = fields.pop('hash', '')
+    data_check_string = '\n'.join(f'{key}={value}' for key, value in sorted(fields.items()))
+    secret_key = hmac.new(b'WebAppData', bot_token.encode('utf-8'), hashlib.sha256).digest()
+    expected_hash = hmac.new(secret_key, data_check_string.encode('utf-8'), hashlib.sha256).hexdigest()
+    if not hmac.compare_digest(expected_hash, received_hash):
+        return None
+
+    try:
+        auth_date = int(fields.get('auth_date', 0))
+        user = json.loads(fields.get('user', ''))
+    except ValueError:
+        return None
+    if max_age and (now or time.time()) - auth_date > max_age:
+        return None
+    if not isinstance(user, dict) or not isinstance(user.get('id'), int):
+        return None
+    return user
@@ -0,0 +1,95 @@
+import pytest
+
+from answer_jobs import AnswerJob, AnswerJobTable, job_events, resume_offset
+from generation_control import GenerationRegistry
+
+
+def test_finished_job_takes_no_claims():
+    registry = GenerationRegistry()
+    job = AnswerJob('job', 'Гроза', [])
+    job.finish('ответ')
+    assert job.claim('app:1') is None
+    assert job.claims() == []
+    assert registry.stats()['active'] == 0
+
+
+def test_job_cancelled_only_when_every_claim_is_superseded():
+    registry = GenerationRegistry()
+    job = AnswerJob('job', 'Гроза', [])
+    registry.start('app:1', job.claim('app:1'))
+    registry.start('app:2', job.claim('app:2'))
+    registry.start('app:1', AnswerJob('newer', 'Онегин', []).claim('app:1'))
+    assert not job.cancel_token.cancelled
+    registry.start('app:2', AnswerJob('newer', 'Онегин', []).claim('app:2'))
+    assert job.cancel_token.cancelled
+
+
+def test_table_expires_finished_jobs_after_ttl():
+    table = AnswerJobTable(max_jobs=10, ttl=60)
+    job, created = table.submit('a', 'Гроза', [])
+    assert created
+    assert table.submit('a', 'Гроза', []) == (job, False)
+    job.finish('ответ')
+    job.finished_at -= 61
+    assert table.get('a') is None
+    assert len(table) == 0
+
+
+def test_full_table_evicts_oldest_finished_job():
+    table = AnswerJobTable(max_jobs=2, ttl=900)
+    first, _ = table.submit('a', 'Гроза', [])
+    second, _ = table.submit('b', 'Онегин', [])
+    assert table.submit('c', 'Обломов', []) == (None, False)
+
+    second.finish('ответ')
+    first.finish('ответ')
+    second.finished_at -= 10
+    third, created = table.submit('c', 'Обломов', [])
+    assert created
+    assert table.get('b') is None
+    assert table.get('a') is first and table.get('c') is third
+
+
+def test_failed_job_is_replaced_on_resubmit():
+    table = AnswerJobTable()
+    job, _ = table.submit('a', 'Гроза', [])
+    job.fail('boom')
+    again, created = table.submit('a', 'Гроза', [])
+    assert created and again is not job
+
+
+@pytest.mark.parametrize('last_event_id, query, offset', [
+    (None, '', 0),
+    ('3', '', 3),
+    ('3', 'from=5', 5),
+    (None, 'x=1&from=2', 2),
+    ('junk', 'from=-1', 0),
+])
+def test_resume_offset(last_event_id, query, offset):
+    assert resume_offset(last_event_id, query) == offset
+
+
+def test_reconnect_replays_only_later_events():
+    job = AnswerJob('job', 'Гроза', [])
+    for text in ('Жанр', ': ', 'драма', '.'):
+        job.append(text)
+    job.finish('Жанр: драма.')
+
+    events = list(job_events(job, resume_offset('2', ''), heartbeat=0))
+    assert events == [
+        ('token', {'text': 'драма.'}, 4),
+        ('done', {'reply': 'Жанр: драма.'}, 4),
+    ]
+    # A client that saw everything only gets the final event.
+    assert list(job_events(job, 4, heartbeat=0)) == [('done', {'reply': 'Жанр: драма.'}, 4)]
+
+
+def test_running_job_sends_heartbeat_then_new_tokens():
+    job = AnswerJob('job', 'Гроза', [])
+    job.append('Жанр')
+    events = job_events(job, 1, heartbeat=0.01)
+    assert next(events) == (None, None, None)
+    job.append(': драма')
+    assert next(events) == ('token', {'text': ': драма'}, 2)
+    job.fail('Request cancelled')
+    assert next(events) == ('error', {'error': 'Request cancelled'}, None)
@@ -0,0 +1,61 @@
+import random
+
+from concurrency_limiter import MIN_BASELINE_SAMPLES, AdaptiveLimiter
+
+
+def run_calls(limiter, calls, concurrency=4):
+    """Release calls concurrency at a time; calls are release() keyword arguments."""
+    for start in range(0, len(calls), concurrency):
+        batch = calls[start:start + concurrency]
+        slots = [limiter.acquire() for _ in batch]
+        for slot, call in zip(slots, batch):
+            limiter.release(slot, **call)
+
+
+def mixed_length_calls(count, ttft_ms=400, ms_per_token=20, seed=1):
+    rng = random.Random(seed)
+    calls = []
+    for _ in range(count):
+        tokens = rng.choice((80, 300, 1200, 3000))
+        calls.append({'latency_ms': ttft_ms + tokens * ms_per_token, 'completion_tokens': tokens,
+                      'first_token_ms': ttft_ms * rng.uniform(0.9, 1.3), 'kind': 'full'})
+    return calls
+
+
+def test_streamed_mixed_lengths_keep_limit():
+    limiter = AdaptiveLimiter(initial_limit=8, decrease_cooldown=0)
+    run_calls(limiter, mixed_length_calls(200))
+    assert limiter.decreases == 0
+    assert limiter.limit >= 8
+
+
+def test_non_streamed_mixed_lengths_keep_limit():
+    limiter = AdaptiveLimiter(initial_limit=8, decrease_cooldown=0)
+    calls = mixed_length_calls(200)
+    for call in calls:
+        del call['first_token_ms']
+    run_calls(limiter, calls)
+    assert limiter.decreases == 0
+    assert 'full:per_token' in limiter.stats()['baseline_ms']
+
+
+def test_slow_first_token_shrinks_limit():
+    limiter = AdaptiveLimiter(initial_limit=8, decrease_cooldown=0)
+    run_calls(limiter, mixed_length_calls(MIN_BASELINE_SAMPLES * 2))
+    run_calls(limiter, mixed_length_calls(8, ttft_ms=2000))
+    assert limiter.decreases > 0
+    assert limiter.limit < 8
+
+
+def test_capped_calls_stay_out_of_baseline():
+    limiter = AdaptiveLimiter(initial_limit=8, decrease_cooldown=0)
+    run_calls(limiter, [{'latency_ms': 100, 'completion_tokens': 10, 'kind': 'full', 'capped': True}] * 20)
+    assert limiter.stats()['baseline_ms'].get('full:per_token') is None
+
+
+def test_cancelled_call_gives_no_signal():
+    limiter = AdaptiveLimiter(initial_limit=4)
+    slot = limiter.acquire()
+    limiter.release(slot, None, kind='full')
+    assert limiter.inflight == 0
+    assert limiter.decreases == 0
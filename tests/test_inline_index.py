@@ -0,0 +1,51 @@
+import pytest
+
+from inline_index import InlineIndex, build_index
+
+WORKS = [
+    {'title': 'Евгений Онегин', 'author': 'Александр Пушкин', 'text': 'Роман в стихах.', 'aliases': ['Онегин']},
+    {'title': 'Гроза', 'author': 'Александр Островский', 'text': 'Драма.'},
+    {'title': 'Мёртвые души', 'author': 'Николай Гоголь', 'text': 'Поэма.'},
+    {'title': 'Капитанская дочка', 'author': 'Александр Пушкин', 'text': 'Повесть.'},
+]
+
+
+@pytest.fixture
+def index(tmp_path):
+    path = tmp_path / 'inline_index.bin'
+    assert build_index(WORKS, path) == len(WORKS)
+    index = InlineIndex(path)
+    yield index
+    index.close()
+
+
+def titles(results):
+    return [work['title'] for work in results]
+
+
+def test_documents_round_trip(index):
+    assert len(index) == len(WORKS)
+    assert index.document(2) == {'id': 2, 'title': 'Мёртвые души', 'author': 'Николай Гоголь', 'text': 'Поэма.'}
+
+
+@pytest.mark.parametrize('query, title', [
+    ('гроз', 'Гроза'),
+    ('ОНЕГИН', 'Евгений Онегин'),
+    ('мертвые', 'Мёртвые души'),
+    ('капитанская дочк', 'Капитанская дочка'),
+    # Typos are ranked by trigram overlap.
+    ('евгений анегин', 'Евгений Онегин'),
+    ('мервые души', 'Мёртвые души'),
+])
+def test_search_finds_work(index, query, title):
+    assert titles(index.search(query))[0] == title
+
+
+def test_author_prefix_matches_all_works(index):
+    assert set(titles(index.search('пушкин'))) >= {'Евгений Онегин', 'Капитанская дочка'}
+
+
+def test_unrelated_query_and_limit(index):
+    assert index.search('квантовая физика') == []
+    assert index.search('') == []
+    assert len(index.search('александр', limit=2)) == 2
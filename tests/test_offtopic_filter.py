@@ -0,0 +1,82 @@
+import pytest
+
+from offtopic_filter import (
+    DEFAULT_DATA_PATH, DEFAULT_MODEL_PATH, LABEL_LITERATURE, LABEL_OFFTOPIC,
+    OfftopicClassifier, cross_validate, evaluate, load_dataset, looks_like_refusal,
+)
+
+# Production threshold (OFFTOPIC_THRESHOLD in main.py).
+THRESHOLD = 0.97
+
+SAMPLES = [
+    ('Анализ романа Евгений Онегин', LABEL_LITERATURE),
+    ('Образ Катерины в пьесе Гроза', LABEL_LITERATURE),
+    ('Тема стихотворения Лермонтова Парус', LABEL_LITERATURE),
+    ('Напиши код сортировки на python', LABEL_OFFTOPIC),
+    ('Какой курс доллара сегодня', LABEL_OFFTOPIC),
+    ('Рецепт борща со сметаной', LABEL_OFFTOPIC),
+]
+
+
+@pytest.fixture(scope='module')
+def bundled():
+    return OfftopicClassifier.load(DEFAULT_MODEL_PATH)
+
+
+def test_train_separates_classes():
+    classifier = OfftopicClassifier.train(SAMPLES)
+    assert classifier.predict_proba('Образ Онегина в романе') < 0.5
+    assert classifier.predict_proba('Код на python для доллара') > 0.5
+    assert classifier.predict_proba('') == 0.0
+
+
+def test_train_needs_both_labels():
+    with pytest.raises(ValueError):
+        OfftopicClassifier.train(SAMPLES[:3])
+
+
+def test_save_load_round_trip(tmp_path):
+    classifier = OfftopicClassifier.train(SAMPLES)
+    path = tmp_path / 'model.json'
+    classifier.save(path)
+    loaded = OfftopicClassifier.load(path)
+    for text, _ in SAMPLES:
+        assert loaded.predict_proba(text) == pytest.approx(classifier.predict_proba(text), abs=1e-3)
+
+
+def test_long_prompt_does_not_saturate():
+    classifier = OfftopicClassifier.train(SAMPLES)
+    assert classifier.predict_proba('Анализ романа Евгений Онегин ' * 50) < 0.5
+
+
+@pytest.mark.parametrize('prompt', [
+    'Образ Катерины в Грозе',
+    'Герои Войны и мира',
+    'Анализ стихотворения Лермонтова Парус',
+])
+def test_bundled_model_keeps_literature(bundled, prompt):
+    assert bundled.predict_proba(prompt) < THRESHOLD
+
+
+def test_bundled_model_has_no_false_rejects_on_dataset(bundled):
+    metrics, = evaluate(bundled, load_dataset(DEFAULT_DATA_PATH), [THRESHOLD])
+    assert metrics['false_rejects'] == 0
+    assert metrics['offtopic_caught'] >= 0.8
+
+
+def test_held_out_false_rejects_stay_rare():
+    samples = load_dataset(DEFAULT_DATA_PATH)
+    rows, held_out = cross_validate(samples, folds=5, thresholds=[0.5, THRESHOLD], alpha=0.5)
+    assert len(held_out) == len(samples)
+    loose, strict = rows
+    assert strict['false_reject_rate'] <= 0.02
+    # A higher threshold trades false rejects for false accepts.
+    assert strict['false_reject_rate'] <= loose['false_reject_rate']
+    assert strict['false_accept_rate'] >= loose['false_accept_rate']
+    assert strict['false_accept_rate'] == pytest.approx(1 - strict['offtopic_caught'])
+
+
+def test_looks_like_refusal():
+    assert looks_like_refusal('Извините, я могу помочь только по вопросам литературы.')
+    assert not looks_like_refusal('• Жанр: роман в стихах')
+    assert not looks_like_refusal(None)
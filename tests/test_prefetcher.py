@@ -0,0 +1,97 @@
+import pytest
+
+from prefetcher import Prefetcher, PrefetchCancelled, aspect_question
+from semantic_cache import SemanticCache
+
+ONEGIN = 'Евгений Онегин Пушкин'
+ONEGIN_HISTORY = [
+    {'role': 'user', 'content': ONEGIN},
+    {'role': 'assistant', 'content': 'Роман в стихах о ...'},
+]
+
+
+def make_prefetcher(generate=None, **kwargs):
+    cache = SemanticCache(threshold=0.75)
+    return Prefetcher(generate or (lambda prompt, mode, cancelled: ('', {})), cache, lambda: 0, **kwargs)
+
+
+def lookup(prefetcher, content, history=None, session=None):
+    """Mirror answer_prompt: a resolved follow-up is looked up under its question."""
+    followup = prefetcher.resolve_followup(content, history, session=session)
+    if not followup:
+        return None
+    return prefetcher.cache.lookup(*followup)
+
+
+def prefetch_characters(prefetcher, work=ONEGIN):
+    prefetcher.cache.add(aspect_question(work, 'characters'), f'герои: {work}',
+                         namespace=prefetcher.namespace('characters'), meta={'prefetch': True})
+
+
+@pytest.mark.parametrize('content', [
+    'Главные герои',
+    'А какие главные герои?',
+    'Персонажи',
+])
+def test_generic_followup_in_history_hits(content):
+    prefetcher = make_prefetcher()
+    prefetch_characters(prefetcher)
+    found = lookup(prefetcher, content, ONEGIN_HISTORY)
+    assert found is not None
+    assert found[0] == f'герои: {ONEGIN}'
+
+
+@pytest.mark.parametrize('content', [
+    'Расскажи про образ Татьяны',
+    'Сравни образ Онегина и Ленского',
+    'Главные герои Грозы Островского',
+])
+def test_specific_question_in_history_misses(content):
+    prefetcher = make_prefetcher()
+    prefetch_characters(prefetcher)
+    assert prefetcher.resolve_followup(content, ONEGIN_HISTORY) is None
+
+
+def test_followup_naming_session_work_hits():
+    prefetcher = make_prefetcher()
+    prefetch_characters(prefetcher)
+    prefetcher.note_work(ONEGIN, session='tg:1')
+    assert lookup(prefetcher, 'Главные герои Евгения Онегина', session='tg:1') is not None
+    # Upstream would only see "Главные герои", so it is not a follow-up.
+    assert prefetcher.resolve_followup('Главные герои', session='tg:1') is None
+
+
+def test_character_question_does_not_leak_between_sessions():
+    prefetcher = make_prefetcher()
+    prefetch_characters(prefetcher)
+    prefetcher.note_work(ONEGIN, session='tg:1')
+    prefetcher.note_work(ONEGIN, session='tg:2')
+    assert prefetcher.resolve_followup('Образ Татьяны в Евгении Онегине', session='tg:1') is None
+    assert prefetcher.resolve_followup('Образ Ленского в Евгении Онегине', session='tg:2') is None
+
+
+def test_cancelled_prefetch_counts_partial_tokens():
+    def generate(prompt, mode, cancelled):
+        raise PrefetchCancelled({'prompt_tokens': 40, 'completion_tokens': 12})
+
+    prefetcher = make_prefetcher(generate, tiers=((1, 1),), idle_seconds=0)
+    prefetcher.note_work(ONEGIN)
+    prefetcher.start()
+    try:
+        for _ in range(200):
+            if prefetcher.cancelled:
+                break
+            prefetcher._stop.wait(0.01)
+    finally:
+        prefetcher.stop()
+    assert prefetcher.cancelled >= 1
+    assert prefetcher.tokens == 52 * prefetcher.cancelled
+
+
+def test_queue_and_popularity_are_bounded():
+    prefetcher = make_prefetcher(tiers=((1, 4),), max_queue=10, max_works=20)
+    for number in range(100):
+        prefetcher.note_work(f'Произведение номер {number} автор{number}')
+    assert len(prefetcher._queue) <= 10
+    assert len(prefetcher._queued) == len(prefetcher._queue)
+    assert len(prefetcher._requests) <= 20
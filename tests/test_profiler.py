@@ -0,0 +1,42 @@
+import threading
+
+import profiler
+
+
+def _section(report, title):
+    lines = report.split('\n')
+    start = lines.index(title) + 1
+    end = lines.index('', start)
+    return '\n'.join(lines[start:end])
+
+
+def busy_loop(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+def test_blocked_threads_are_reported_apart_from_hot_paths():
+    stop = threading.Event()
+    waiters = [threading.Thread(target=stop.wait, name=f'waiter-{i}', daemon=True) for i in range(3)]
+    worker = threading.Thread(target=busy_loop, args=(stop,), name='worker', daemon=True)
+    for thread in waiters + [worker]:
+        thread.start()
+    try:
+        report = profiler.sample_stacks(0.3, interval=0.005)
+    finally:
+        stop.set()
+        worker.join()
+        for thread in waiters:
+            thread.join()
+
+    self_time = _section(report, 'Top functions (self):')
+    assert 'busy_loop' in self_time
+    assert 'threading.py:wait' not in self_time
+    assert 'waiter' not in _section(report, 'Samples per running thread:')
+    assert 'waiter-0' in _section(report, 'Samples per blocked thread:')
+
+    # The three waiters share one stack: a pile-up of three threads.
+    blocked = _section(report, 'Blocked stacks (peak threads waiting at once):')
+    header = next(line for line in blocked.split('\n') if 'waiter-0' in line)
+    assert 'peak 3 thread(s), 3 distinct' in header
+    assert 'threading.py:wait' in blocked
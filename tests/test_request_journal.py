@@ -0,0 +1,124 @@
+import sqlite3
+import time
+
+import pytest
+
+from request_journal import JOB_DONE, JOB_FAILED, JOB_QUEUED, JOB_RUNNING, RequestJournal
+
+
+@pytest.fixture
+def journal_path(tmp_path):
+    return tmp_path / 'journal.sqlite3'
+
+
+def telegram_job(job_id, prompt='Гроза Островский'):
+    return {'job_id': job_id, 'origin': 'telegram', 'chat_id': 10, 'user_id': 20, 'prompt': prompt}
+
+
+def test_update_is_accepted_once_with_its_job(journal_path):
+    journal = RequestJournal(journal_path)
+    assert journal.accept_update(101, telegram_job('tg:10:1'))
+    assert not journal.accept_update(101, telegram_job('tg:10:1', prompt='другой текст'))
+    job = journal.get_job('tg:10:1')
+    assert (job['state'], job['prompt'], job['chat_id']) == (JOB_QUEUED, 'Гроза Островский', 10)
+    journal.close()
+
+
+def test_interrupted_job_comes_back_after_reopen(journal_path):
+    journal = RequestJournal(journal_path)
+    journal.accept_update(1, telegram_job('tg:10:1'))
+    journal.accept_update(2, telegram_job('tg:10:2'))
+    journal.create_job('app:1', 'miniapp', 'Онегин', user_id=5, history=[{'role': 'user', 'content': 'привет'}])
+    journal.mark_running('tg:10:1')
+    journal.mark_done('tg:10:2', 'ответ')
+    journal.mark_running('app:1')
+    journal.close()
+
+    journal = RequestJournal(journal_path)
+    unfinished = journal.unfinished_jobs()
+    assert [job['job_id'] for job in unfinished] == ['tg:10:1', 'app:1']
+    assert unfinished[0]['state'] == JOB_RUNNING
+    assert unfinished[1]['history'] == [{'role': 'user', 'content': 'привет'}]
+    assert [job['job_id'] for job in journal.unfinished_jobs('miniapp')] == ['app:1']
+    done = journal.get_job('tg:10:2')
+    assert (done['state'], done['result']) == (JOB_DONE, 'ответ')
+    journal.close()
+
+
+def test_failed_job_is_finished(journal_path):
+    journal = RequestJournal(journal_path)
+    journal.create_job('app:1', 'miniapp', 'Онегин')
+    journal.mark_failed('app:1', RuntimeError('x' * 1000))
+    job = journal.get_job('app:1')
+    assert job['state'] == JOB_FAILED and len(job['error']) == 500
+    assert journal.unfinished_jobs() == []
+    assert not journal.create_job('app:1', 'miniapp', 'Онегин')
+    journal.close()
+
+
+def test_update_offset_survives_reopen_and_never_goes_back(journal_path):
+    journal = RequestJournal(journal_path)
+    assert journal.get_last_update_id() == 0
+    journal.set_last_update_id(500)
+    journal.set_last_update_id(400)
+    journal.close()
+
+    journal = RequestJournal(journal_path)
+    assert journal.get_last_update_id() == 500
+    journal.close()
+
+
+def test_meta_get_set(journal_path):
+    journal = RequestJournal(journal_path)
+    assert journal.get_meta('parallel:1') is None
+    assert journal.get_meta('parallel:1', 'default') == 'default'
+    journal.set_meta('parallel:1', 1)
+    journal.set_meta('parallel:1', 0)
+    assert journal.get_meta('parallel:1') == '0'
+    journal.close()
+
+
+def test_prune_keeps_unfinished_jobs(journal_path):
+    journal = RequestJournal(journal_path)
+    journal.accept_update(1, telegram_job('tg:10:1'))
+    journal.accept_update(2, telegram_job('tg:10:2'))
+    journal.mark_done('tg:10:2', 'ответ')
+    time.sleep(0.01)
+    journal.prune(0)
+    assert journal.get_job('tg:10:2') is None
+    assert journal.get_job('tg:10:1') is not None
+    # Seen update ids are pruned as well, so the offset alone guards against replays.
+    assert journal.accept_update(2)
+    journal.close()
+
+
+def test_miniapp_job_keeps_mode_and_summary(journal_path):
+    path = journal_path
+    journal = RequestJournal(path)
+    journal.create_job('app:1', 'miniapp', 'Гроза', mode='summary')
+    journal.create_job('app:2', 'miniapp', 'Гроза', mode='full', summary='• Жанр: драма')
+    journal.close()
+
+    journal = RequestJournal(path)
+    jobs = {job['job_id']: job for job in journal.unfinished_jobs('miniapp')}
+    assert (jobs['app:1']['mode'], jobs['app:1']['summary']) == ('summary', None)
+    assert (jobs['app:2']['mode'], jobs['app:2']['summary']) == ('full', '• Жанр: драма')
+    journal.close()
+
+
+def test_old_journal_gets_new_columns(journal_path):
+    path = journal_path
+    conn = sqlite3.connect(path)
+    conn.execute(
+        'CREATE TABLE jobs (job_id TEXT PRIMARY KEY, origin TEXT NOT NULL, chat_id INTEGER, user_id INTEGER, '
+        'prompt TEXT NOT NULL, history TEXT, state TEXT NOT NULL, result TEXT, error TEXT, '
+        'created_at REAL NOT NULL, updated_at REAL NOT NULL)'
+    )
+    conn.execute("INSERT INTO jobs VALUES ('app:old', 'miniapp', NULL, NULL, 'Гроза', NULL, 'running', NULL, NULL, 1, 1)")
+    conn.commit()
+    conn.close()
+
+    journal = RequestJournal(path)
+    job, = journal.unfinished_jobs()
+    assert job['mode'] is None and job['summary'] is None
+    journal.close()
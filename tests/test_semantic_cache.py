@@ -0,0 +1,61 @@
+from pathlib import Path
+
+import pytest
+
+from semantic_cache import SemanticCache, evaluate_labeled, load_labeled_prompts
+
+THRESHOLD = 0.75
+EVAL_PROMPTS = Path(__file__).resolve().parent.parent / 'cache_eval_prompts.tsv'
+
+
+def cache_with(prompt, namespace='full'):
+    cache = SemanticCache(threshold=THRESHOLD)
+    cache.add(prompt, f'answer: {prompt}', namespace=namespace)
+    return cache
+
+
+@pytest.mark.parametrize('cached, asked', [
+    ('Мастер и Маргарита Булгаков', 'Мастер и Маргарита Булгаков Воланд'),
+    ('Вишневый сад Чехов', 'Вишневый сад Чехов Лопахин'),
+    ('Герой нашего времени Лермонтов', 'Герой нашего времени Лермонтов композиция'),
+    # A specific cached question must not answer the generic one either.
+    ('Мастер и Маргарита Булгаков Воланд', 'Мастер и Маргарита Булгаков'),
+    ('Евгений Онегин', 'Образ Евгения Онегина в романе Пушкина Ленский'),
+    ('Творчество Пушкина', 'Творчество Лермонтова'),
+    ('Капитанская дочка Пушкин', 'Пиковая дама Пушкин'),
+    # With a single name "образ" asks about the character, not the work.
+    ('Обломов Гончаров', 'Образ Обломова'),
+    ('Евгений Онегин', 'Образ Онегина'),
+])
+def test_prompt_with_other_subject_misses(cached, asked):
+    assert cache_with(cached).lookup(asked) is None
+
+
+@pytest.mark.parametrize('cached, asked', [
+    ('Война и мир, Лев Толстой', 'анализ романа Война и мир Толстого'),
+    ('Война и мир, Лев Толстой', 'Война и мир'),
+    ('Евгений Онегин, Пушкин', 'Пушкин Евгений Онегин'),
+    ('Вишнёвый сад, Антон Чехов', 'Вишневый сад Чехова'),
+    ('Преступление и наказание Достоевский', 'Преступленье и наказание Достоевский'),
+    ('Образ Чичикова в Мертвых душах', 'Чичиков Мертвые души характеристика'),
+    # The request's own paraphrases, in both directions.
+    ('образ Татьяны в Евгении Онегине', 'анализ Татьяны Онегин'),
+    ('анализ Татьяны Онегин', 'образ Татьяны в Евгении Онегине'),
+    ('Характеристика Татьяны в Евгении Онегине', 'Татьяна Онегин образ'),
+])
+def test_paraphrase_hits(cached, asked):
+    found = cache_with(cached).lookup(asked)
+    assert found is not None
+    assert found[2].prompt == cached
+
+
+def test_namespaces_are_separate():
+    cache = cache_with('Гроза Островский', namespace='summary')
+    assert cache.lookup('Гроза Островский', namespace='full') is None
+    assert cache.lookup('Гроза Островский', namespace='summary') is not None
+
+
+def test_labeled_eval_set_has_no_false_hits():
+    hits, repeats, false_hits, false_matches = evaluate_labeled(load_labeled_prompts(EVAL_PROMPTS), THRESHOLD)
+    assert false_hits == 0, false_matches
+    assert hits / repeats >= 0.85
@@ -0,0 +1,46 @@
+import hashlib
+import hmac
+import json
+import time
+from urllib.parse import urlencode
+
+from telegram_auth import verify_init_data
+
+BOT_TOKEN = '123456:test-token'
+
+
+def sign(fields, token=BOT_TOKEN):
+    data_check_string = '\n'.join(f'{key}={value}' for key, value in sorted(fields.items()))
+    secret_key = hmac.new(b'WebAppData', token.encode('utf-8'), hashlib.sha256).digest()
+    signed = dict(fields, hash=hmac.new(secret_key, data_check_string.encode('utf-8'), hashlib.sha256).hexdigest())
+    return urlencode(signed)
+
+
+def init_data(user_id=42, auth_date=None, token=BOT_TOKEN):
+    return sign({
+        'query_id': 'AAE',
+        'user': json.dumps({'id': user_id, 'first_name': 'Тест'}, ensure_ascii=False),
+        'auth_date': str(int(auth_date or time.time())),
+    }, token)
+
+
+def test_signed_init_data_gives_user():
+    assert verify_init_data(init_data(), BOT_TOKEN)['id'] == 42
+
+
+def test_tampered_user_is_rejected():
+    signed = init_data()
+    forged = signed.replace('%22id%22%3A+42', '%22id%22%3A+43')
+    assert forged != signed
+    assert verify_init_data(forged, BOT_TOKEN) is None
+
+
+def test_other_bot_signature_is_rejected():
+    assert verify_init_data(init_data(token='999:other'), BOT_TOKEN) is None
+
+
+def test_stale_or_missing_data_is_rejected():
+    assert verify_init_data(init_data(auth_date=time.time() - 3 * 24 * 3600), BOT_TOKEN) is None
+    assert verify_init_data('', BOT_TOKEN) is None
+    assert verify_init_data('user=1', BOT_TOKEN) is None
+    assert verify_init_data(init_data(), None) is None
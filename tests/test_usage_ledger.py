@@ -0,0 +1,55 @@
+import calendar
+import json
+
+import pytest
+
+from usage_ledger import UsageLedger, percentile, summarize
+
+DAY = calendar.timegm((2026, 3, 14, 0, 0, 0))
+
+
+@pytest.mark.parametrize('q, expected', [(0, 1), (10, 1), (50, 5), (90, 9), (99, 10), (100, 10)])
+def test_percentile_nearest_rank(q, expected):
+    assert percentile(list(range(1, 11)), q) == expected
+
+
+def test_percentile_empty_and_single():
+    assert percentile([], 50) == 0
+    assert percentile([7], 90) == 7
+
+
+def test_record_roundtrip(tmp_path):
+    ledger = UsageLedger(tmp_path)
+    ledger.record(42, 'telegram', 'upstream', prompt_tokens=100, completion_tokens=250,
+                  latency_ms=1200, history_len=2, prompt_chars=30, ts=DAY + 60)
+    ledger.record(None, 'miniapp', 'cancelled', prompt_tokens=80, completion_tokens=40, ts=DAY + 120)
+    ledger.close()
+
+    records = ledger.read(DAY, DAY + 3600)
+    assert [(r.user_id, r.origin, r.cache_status) for r in records] == [
+        (42, 'telegram', 'upstream'), (0, 'miniapp', 'cancelled')]
+    summary = summarize(records)
+    assert summary['upstream_calls'] == 1
+    assert summary['prompt_tokens'] == 180
+    assert summary['by_status'] == {'upstream': 1, 'cancelled': 1}
+
+
+def test_rollup_current_finishes_previous_day(tmp_path):
+    ledger = UsageLedger(tmp_path)
+    ledger.record(1, 'telegram', 'upstream', prompt_tokens=10, ts=DAY + 23 * 3600 + 50 * 60)
+    ledger.rollup_current(now=DAY + 23 * 3600 + 55 * 60)
+    # Written after the last periodic rollup of the day.
+    ledger.record(1, 'telegram', 'upstream', prompt_tokens=5, ts=DAY + 23 * 3600 + 58 * 60)
+    ledger.rollup_current(now=DAY + 86400 + 5 * 60)
+    ledger.close()
+
+    rollup = json.loads((tmp_path / 'rollup-20260314.json').read_text(encoding='utf-8'))
+    assert rollup['hours']['23']['requests'] == 2
+    assert rollup['hours']['23']['prompt_tokens'] == 15
+
+
+def test_rollup_current_after_restart_covers_yesterday(tmp_path):
+    UsageLedger(tmp_path).record(1, 'telegram', 'upstream', prompt_tokens=3, ts=DAY + 3600)
+    restarted = UsageLedger(tmp_path)
+    restarted.rollup_current(now=DAY + 86400 + 60)
+    assert (tmp_path / 'rollup-20260314.json').exists()
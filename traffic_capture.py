@@ -0,0 +1,151 @@
+"""Opt-in capture of production traffic for replay (see traffic_replay.py).
+
+Records incoming Telegram updates, Mini App chat payloads and upstream
+latency profiles as gzip-compressed JSON lines. User and chat ids are
+replaced with salted hashes and names, usernames and contacts are
+dropped; prompt text is kept because replay needs it.
+
+Enable with TRAFFIC_CAPTURE_PATH=traffic.jsonl.gz and a fixed
+TRAFFIC_CAPTURE_SALT so hashed ids stay stable across restarts.
+
+Record kinds ('k'): 'update' (raw Telegram update), 'http' (Mini App
+POST path and payload) and 'upstream' (mode, streamed, latency_ms,
+first_token_ms, prompt_tokens, completion_tokens, error). Every record
+has a wall-clock timestamp 'ts'.
+"""
+import gzip
+import hashlib
+import hmac
+import json
+import os
+import re
+import threading
+import time
+
+TRACE_VERSION = 1
+FLUSH_EVERY_RECORDS = 50
+FLUSH_EVERY_SECONDS = 5
+
+# Personal fields of User and Chat objects that replay never needs.
+REDACTED_FIELDS = {
+    'first_name', 'last_name', 'username', 'title', 'bio', 'description',
+    'phone_number', 'vcard', 'active_usernames', 'photo', 'emoji_status_custom_emoji_id',
+}
+DROPPED_OBJECTS = {'contact', 'location', 'venue', 'photo', 'document', 'voice', 'video', 'audio', 'sticker'}
+
+_CALLBACK_JOB_RE = re.compile(r'^(more:tg:)(-?\d+)(:\d+)$')
+
+
+class TrafficRecorder:
+    """Thread-safe writer of an anonymized traffic trace."""
+
+    def __init__(self, path, salt=None):
+        self.path = str(path)
+        self._salt = (salt or os.urandom(16).hex()).encode('utf-8')
+        self._lock = threading.Lock()
+        self._file = gzip.open(self.path, 'at', encoding='utf-8')
+        self._pending = 0
+        self._flushed_at = time.time()
+        self._write({'k': 'header', 'version': TRACE_VERSION, 'pid': os.getpid()})
+
+    def hash_id(self, value):
+        """Map a Telegram id to a stable salted 48-bit id, keeping its sign."""
+        if value is None:
+            return None
+        value = int(value)
+        digest = hmac.new(self._salt, str(abs(value)).encode('ascii'), hashlib.sha256).digest()
+        hashed = int.from_bytes(digest[:6], 'big') or 1
+        return -hashed if value < 0 else hashed
+
+    def _anonymize(self, value):
+        if isinstance(value, list):
+            return [self._anonymize(item) for item in value]
+        if not isinstance(value, dict):
+            return value
+
+        result = {}
+        # User and Chat objects are the ones with names or a chat type.
+        is_identity = 'first_name' in value or 'type' in value and 'id' in value
+        for key, item in value.items():
+            if key in DROPPED_OBJECTS:
+                result[key] = None
+            elif is_identity and key in REDACTED_FIELDS:
+                continue
+            elif is_identity and key == 'id' or key in ('user_id', 'chat_id'):
+                result[key] = self.hash_id(item) if isinstance(item, int) else item
+            elif key in ('data', 'callback_data') and isinstance(item, str):
+                result[key] = self._anonymize_callback_data(item)
+            else:
+                result[key] = self._anonymize(item)
+        if is_identity and 'first_name' in value:
+            result['first_name'] = 'user'
+        return result
+
+    def _anonymize_callback_data(self, data):
+        # Expansion buttons embed the journal job id, which holds the chat id.
+        match = _CALLBACK_JOB_RE.match(data)
+        if not match:
+            return data
+        return f'{match.group(1)}{self.hash_id(int(match.group(2)))}{match.group(3)}'
+
+    def anonymize_update(self, update):
+        """Return a copy of a raw update with identities hashed or removed."""
+        return self._anonymize(update)
+
+    def record_update(self, update):
+        self._write({'k': 'update', 'update': self.anonymize_update(update)})
+
+    def record_http(self, path, payload):
+        payload = dict(payload)
+        if payload.get('user_id') is not None:
+            payload['user_id'] = self.hash_id(payload['user_id'])
+        self._write({'k': 'http', 'path': path, 'payload': payload})
+
+    def record_upstream(self, mode, streamed, latency_ms, first_token_ms=None,
+                        prompt_tokens=0, completion_tokens=0, error=None):
+        self._write({
+            'k': 'upstream',
+            'mode': mode,
+            'streamed': bool(streamed),
+            'latency_ms': round(latency_ms),
+            'first_token_ms': round(first_token_ms) if first_token_ms is not None else None,
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'error': str(error)[:200] if error else None,
+        })
+
+    def _write(self, record):
+        record['ts'] = round(time.time(), 3)
+        line = json.dumps(record, ensure_ascii=False, separators=(',', ':'))
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(line + '\n')
+            self._pending += 1
+            # Flushing ends a deflate block, so batch it to keep the file compact.
+            if self._pending >= FLUSH_EVERY_RECORDS or time.time() - self._flushed_at >= FLUSH_EVERY_SECONDS:
+                self._file.flush()
+                self._pending = 0
+                self._flushed_at = time.time()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def read_trace(path):
+    """Yield records of a trace file in order, skipping headers and a torn last line."""
+    with gzip.open(path, 'rt', encoding='utf-8') as trace_file:
+        try:
+            for line in trace_file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record.get('k') != 'header':
+                    yield record
+        except EOFError:
+            # The process was killed before the gzip member was closed.
+            return
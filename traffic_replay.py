@@ -0,0 +1,543 @@
+"""Time-scaled replay of captured traffic for performance regression tests.
+
+Starts local fake Telegram Bot API and OpenAI-compatible model servers,
+runs a bot build (a directory with main.py, e.g. a git worktree) against
+them and feeds a trace recorded with TRAFFIC_CAPTURE_PATH back at the
+original pace divided by --speed. The fake model answers with the
+captured upstream latency profiles, so only the bot's own work differs
+between builds.
+
+Usage:
+    python traffic_replay.py info TRACE
+    python traffic_replay.py run TRACE --build DIR [--build OTHER_DIR] [--speed 10]
+                                       [--model-speed N] [--output results.json]
+
+With two builds the report ends with throughput and latency deltas of
+the second build against the first.
+"""
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlsplit
+
+import requests
+
+from traffic_capture import read_trace
+from usage_ledger import percentile
+
+REPLAY_TOKEN = '123456:REPLAY'
+BOT_STARTUP_TIMEOUT = 60
+DEFAULT_PROFILE = {'latency_ms': 8000, 'first_token_ms': 1500, 'completion_tokens': 900}
+STREAM_CHUNK_CHARS = 12
+
+FAKE_ANSWER = (
+    "## Общая характеристика\n\n"
+    "**Жанр и тема.** Произведение раскрывает конфликт личности и общества, "
+    "а *авторская позиция* проявляется в композиции и системе образов.\n\n"
+    "### Главные герои\n\n"
+    "- **Герой** — сложный характер, противоречивый и ищущий смысл.\n"
+    "- **Героиня** — цельная натура, верная себе.\n\n"
+    "### Композиция и символы\n\n"
+    "Кольцевая композиция, ключевые сцены и `символика` подчеркивают идею. "
+)
+
+
+class Trace:
+    """Telegram updates, Mini App requests and upstream profiles of a trace."""
+
+    def __init__(self, path):
+        self.updates = []
+        self.http = []
+        self.profiles = []
+        for record in read_trace(path):
+            kind = record.get('k')
+            if kind == 'update':
+                self.updates.append(record)
+            elif kind == 'http':
+                self.http.append(record)
+            elif kind == 'upstream' and not record.get('error'):
+                self.profiles.append(record)
+        events = self.updates + self.http
+        self.started = min((record['ts'] for record in events), default=0)
+        self.span = max((record['ts'] for record in events), default=0) - self.started
+
+    def offset(self, record, speed):
+        return (record['ts'] - self.started) / speed
+
+    def profile_for(self, prompt):
+        """Pick a captured profile deterministically, so every build sees the same one per prompt."""
+        if not self.profiles:
+            return DEFAULT_PROFILE
+        return self.profiles[zlib.crc32(prompt.encode('utf-8')) % len(self.profiles)]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def update_key(update):
+    """Conversation key that bot API calls answering this update will carry."""
+    message = update.get('message') or update.get('edited_message')
+    if message:
+        return 'chat', message['chat']['id']
+    callback = update.get('callback_query')
+    if callback:
+        if callback.get('message'):
+            return 'chat', callback['message']['chat']['id']
+        return 'callback', callback['id']
+    inline = update.get('inline_query')
+    if inline:
+        return 'inline', inline['id']
+    return 'other', update['update_id']
+
+
+class QuietHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status_code, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakeTelegram:
+    """Bot API stub that hands out trace updates on schedule and logs every bot call."""
+
+    def __init__(self, updates):
+        # Update ids are renumbered so a fresh journal accepts them all.
+        self.updates = []
+        self.callback_keys = {}
+        for update_id, (offset, update) in enumerate(updates, start=1):
+            update = dict(update, update_id=update_id)
+            self.updates.append((offset, update))
+            if update.get('callback_query'):
+                self.callback_keys[update['callback_query']['id']] = update_key(update)
+        self.start_at = None
+        self.ready = threading.Event()
+        self.delivered = {}
+        self.calls = []
+        self.methods = Counter()
+        self._next_message_id = 1000
+        self._cond = threading.Condition()
+
+    def start(self, start_at):
+        with self._cond:
+            self.start_at = start_at
+            self._cond.notify_all()
+
+    def get_updates(self, offset, timeout):
+        self.ready.set()
+        deadline = time.monotonic() + min(timeout, 2)
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                pending = [(due, update) for due, update in self.updates if update['update_id'] >= offset]
+                if self.start_at is not None:
+                    ready = [update for due, update in pending if self.start_at + due <= now][:100]
+                    if ready:
+                        for update in ready:
+                            self.delivered.setdefault(update['update_id'], now)
+                        return ready
+                if now >= deadline:
+                    return []
+                wait = deadline - now
+                if self.start_at is not None and pending:
+                    wait = min(wait, max(self.start_at + pending[0][0] - now, 0.001))
+                self._cond.wait(wait)
+
+    def call(self, method, params):
+        now = time.monotonic()
+        key = None
+        if 'chat_id' in params:
+            key = 'chat', int(params['chat_id'])
+        elif 'inline_query_id' in params:
+            key = 'inline', params['inline_query_id']
+        elif 'callback_query_id' in params:
+            key = self.callback_keys.get(params['callback_query_id'], ('callback', params['callback_query_id']))
+        with self._cond:
+            self.methods[method] += 1
+            if key:
+                self.calls.append((now, key))
+            if method == 'getMe':
+                return {'id': 1, 'is_bot': True, 'first_name': 'Pushkin AI', 'username': 'pushkin_replay_bot'}
+            if method.startswith(('send', 'edit')) and key and key[0] == 'chat':
+                self._next_message_id += 1
+                return {
+                    'message_id': self._next_message_id,
+                    'date': int(time.time()),
+                    'chat': {'id': key[1], 'type': 'private'},
+                    'text': params.get('text', ''),
+                }
+            return True
+
+    def latencies(self):
+        """Return (first response ms, last response ms) lists and unanswered update count.
+
+        Bot calls are attributed per chat to the latest delivery before them;
+        updates of one chat delivered in the same batch are answered together.
+        """
+        with self._cond:
+            delivered = dict(self.delivered)
+            calls = defaultdict(list)
+            for at, key in self.calls:
+                calls[key].append(at)
+
+        batches = defaultdict(Counter)
+        for _, update in self.updates:
+            if update['update_id'] in delivered:
+                batches[update_key(update)][delivered[update['update_id']]] += 1
+
+        first, done, unanswered = [], [], 0
+        for key, counts in batches.items():
+            times = sorted(counts)
+            key_calls = calls.get(key, [])
+            for index, at in enumerate(times):
+                until = times[index + 1] if index + 1 < len(times) else float('inf')
+                start, end = bisect_left(key_calls, at), bisect_left(key_calls, until)
+                if start == end:
+                    unanswered += counts[at]
+                    continue
+                first.extend([(key_calls[start] - at) * 1000] * counts[at])
+                done.extend([(key_calls[end - 1] - at) * 1000] * counts[at])
+        return first, done, unanswered
+
+    def last_call_at(self):
+        with self._cond:
+            return self.calls[-1][0] if self.calls else None
+
+    def serve(self):
+        fake = self
+
+        class Handler(QuietHandler):
+            def _handle(self):
+                url = urlsplit(self.path)
+                method = url.path.rsplit('/', 1)[-1]
+                params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+                length = int(self.headers.get('Content-Length', '0'))
+                body = self.rfile.read(length) if length else b''
+                if body and self.headers.get('Content-Type', '').startswith('application/x-www-form-urlencoded'):
+                    params.update({key: values[-1] for key, values in parse_qs(body.decode('utf-8')).items()})
+
+                if method == 'getUpdates':
+                    result = fake.get_updates(int(params.get('offset', 0)), float(params.get('timeout', 20)))
+                else:
+                    result = fake.call(method, params)
+                self._send_json(200, {'ok': True, 'result': result})
+
+            do_GET = _handle
+            do_POST = _handle
+
+        return start_server(Handler)
+
+
+class FakeModel:
+    """OpenAI-compatible chat completions stub replaying captured latency profiles."""
+
+    def __init__(self, trace, speed):
+        self.trace = trace
+        self.speed = speed
+        self.calls = 0
+        self.active = 0
+        self.peak_active = 0
+        self.tokens = 0
+        self.last_done_at = None
+        self._lock = threading.Lock()
+
+    def serve(self):
+        fake = self
+
+        class Handler(QuietHandler):
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', '0'))
+                request = json.loads(self.rfile.read(length) or b'{}')
+                with fake._lock:
+                    fake.calls += 1
+                    fake.active += 1
+                    fake.peak_active = max(fake.peak_active, fake.active)
+                try:
+                    fake.answer(self, request)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+                finally:
+                    with fake._lock:
+                        fake.active -= 1
+                        fake.last_done_at = time.monotonic()
+
+        return start_server(Handler)
+
+    def answer(self, handler, request):
+        messages = request.get('messages') or [{}]
+        profile = self.trace.profile_for(str(messages[-1].get('content', '')))
+        tokens = max(1, min(int(profile.get('completion_tokens') or 1), int(request.get('max_tokens') or 4096)))
+        text = (FAKE_ANSWER * (tokens * 3 // len(FAKE_ANSWER) + 1))[:tokens * 3]
+        latency = profile['latency_ms'] / 1000 / self.speed
+        first_token = (profile.get('first_token_ms') or profile['latency_ms'] * 0.2) / 1000 / self.speed
+        usage = {'prompt_tokens': sum(len(str(m.get('content', ''))) // 3 for m in messages),
+                 'completion_tokens': tokens}
+        usage['total_tokens'] = usage['prompt_tokens'] + tokens
+        base = {'id': 'replay', 'created': int(time.time()), 'model': request.get('model', 'replay')}
+        with self._lock:
+            self.tokens += tokens
+
+        if not request.get('stream'):
+            time.sleep(latency)
+            handler._send_json(200, dict(base, object='chat.completion', usage=usage, choices=[{
+                'index': 0, 'finish_reason': 'stop', 'message': {'role': 'assistant', 'content': text},
+            }]))
+            return
+
+        handler.send_response(200)
+        handler.send_header('Content-Type', 'text/event-stream')
+        handler.end_headers()
+
+        def send(payload):
+            handler.wfile.write(f'data: {json.dumps(payload, ensure_ascii=False)}\n\n'.encode('utf-8'))
+            handler.wfile.flush()
+
+        time.sleep(first_token)
+        chunks = [text[i:i + STREAM_CHUNK_CHARS] for i in range(0, len(text), STREAM_CHUNK_CHARS)]
+        pause = max(latency - first_token, 0) / len(chunks)
+        for chunk in chunks:
+            send(dict(base, object='chat.completion.chunk', choices=[{
+                'index': 0, 'finish_reason': None, 'delta': {'content': chunk},
+            }]))
+            time.sleep(pause)
+        send(dict(base, object='chat.completion.chunk', choices=[{'index': 0, 'finish_reason': 'stop', 'delta': {}}]))
+        send(dict(base, object='chat.completion.chunk', choices=[], usage=usage))
+        handler.wfile.write(b'data: [DONE]\n\n')
+        handler.wfile.flush()
+
+
+def start_server(handler_class):
+    server = ThreadingHTTPServer(('127.0.0.1', free_port()), handler_class)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def replay_http(record, base_url, results):
+    """Send one Mini App request and wait for its answer."""
+    started = time.monotonic()
+    try:
+        response = requests.post(base_url + record['path'], json=record['payload'], timeout=600)
+        ok = response.status_code == 200
+        if record['path'] == '/api/jobs' and response.status_code == 202:
+            job_id = response.json()['job_id']
+            ok = False
+            with requests.get(f'{base_url}/api/jobs/{job_id}/events', stream=True, timeout=600) as events:
+                for line in events.iter_lines(decode_unicode=True):
+                    if line in ('event: done', 'event: error'):
+                        ok = line == 'event: done'
+                        break
+    except requests.RequestException:
+        ok = False
+    finished = time.monotonic()
+    results.append((ok, (finished - started) * 1000, finished))
+
+
+def run_build(build_dir, trace, speed, model_speed, settle, drain_timeout):
+    """Replay the trace against one build and return its measurements."""
+    build_dir = Path(build_dir).resolve()
+    main_path = build_dir / 'main.py'
+    source = main_path.read_text(encoding='utf-8')
+    if 'TELEGRAM_API_URL' not in source or 'MODEL_BASE_URL' not in source:
+        # Older builds would talk to the real Telegram and model APIs.
+        raise SystemExit(f'[ERROR] {build_dir} does not support TELEGRAM_API_URL/MODEL_BASE_URL; cannot replay it')
+
+    telegram = FakeTelegram([
+        (trace.offset(record, speed), record['update'])
+        for record in sorted(trace.updates, key=lambda item: item['ts'])
+    ])
+    model = FakeModel(trace, model_speed)
+    telegram_server = telegram.serve()
+    model_server = model.serve()
+    app_port = free_port()
+    workdir = Path(tempfile.mkdtemp(prefix='pushkin-replay-'))
+    env = dict(
+        os.environ,
+        TELEGRAM_TOKEN=REPLAY_TOKEN,
+        TELEGRAM_API_URL=f'http://127.0.0.1:{telegram_server.server_port}/bot{{0}}/{{1}}',
+        HUGGINGFACE_TOKEN='replay',
+        MODEL_BASE_URL=f'http://127.0.0.1:{model_server.server_port}/v1',
+        ADMIN_ID='0',
+        PORT=str(app_port),
+        MINI_APP_HOST='127.0.0.1',
+        MINI_APP_URL=f'http://127.0.0.1:{app_port}/',
+        MINI_APP_AUTO_TUNNEL='0',
+        REQUEST_JOURNAL_PATH=str(workdir / 'journal.db'),
+        USAGE_LEDGER_DIR=str(workdir / 'usage'),
+        OFFTOPIC_SHADOW_LOG=str(workdir / 'offtopic_shadow.jsonl'),
+        TRAFFIC_CAPTURE_PATH='',
+        PYTHONUNBUFFERED='1',
+    )
+    log_path = workdir / 'bot.log'
+    print(f'[LOG] Starting {build_dir} (log: {log_path})')
+    with open(log_path, 'wb') as log_file:
+        process = subprocess.Popen([sys.executable, str(main_path)], cwd=build_dir, env=env,
+                                   stdout=log_file, stderr=subprocess.STDOUT)
+    try:
+        if not telegram.ready.wait(BOT_STARTUP_TIMEOUT) or process.poll() is not None:
+            raise SystemExit(f'[ERROR] Bot did not start polling; see {log_path}')
+
+        started = time.monotonic()
+        telegram.start(started)
+        http_results = []
+        http_threads = []
+        base_url = f'http://127.0.0.1:{app_port}'
+        for record in sorted(trace.http, key=lambda item: item['ts']):
+            delay = started + trace.offset(record, speed) - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            thread = threading.Thread(target=replay_http, args=(record, base_url, http_results), daemon=True)
+            thread.start()
+            http_threads.append(thread)
+
+        deadline = time.monotonic() + trace.span / speed + drain_timeout
+        while time.monotonic() < deadline:
+            time.sleep(0.5)
+            if (len(telegram.delivered) < len(telegram.updates) or model.active
+                    or any(thread.is_alive() for thread in http_threads)):
+                continue
+            # The polling thread may still be busy with queued updates, so
+            # silence alone ends the run only after a longer wait.
+            quiet = time.monotonic() - max(telegram.last_call_at() or started, model.last_done_at or started)
+            if quiet >= settle and (not telegram.latencies()[2] or quiet >= settle * 5):
+                break
+    finally:
+        process.terminate()
+        try:
+            process.wait(10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        telegram_server.shutdown()
+        model_server.shutdown()
+
+    first, done, unanswered = telegram.latencies()
+    http_ok = [latency for ok, latency, _ in http_results if ok]
+    # The run lasts until the last answer, not until the settle period ends.
+    completed_at = max([telegram.last_call_at() or started] + [at for _, _, at in http_results])
+    duration = completed_at - started
+    completed = len(done) + len(http_ok)
+    if not unanswered and len(http_ok) == len(http_results):
+        shutil.rmtree(workdir, ignore_errors=True)
+    else:
+        print(f'[WARNING] Some requests were not answered; bot log kept at {log_path}')
+    return {
+        'build': str(build_dir),
+        'speed': speed,
+        'model_speed': model_speed,
+        'duration_s': round(duration, 3),
+        'throughput_rps': round(completed / duration, 3) if duration > 0 else 0,
+        'telegram_updates': len(telegram.updates),
+        'telegram_answered': len(done),
+        'telegram_unanswered': unanswered,
+        'telegram_first_ms': {q: round(percentile(first, q)) for q in (50, 90, 99)},
+        'telegram_done_ms': {q: round(percentile(done, q)) for q in (50, 90, 99)},
+        'miniapp_requests': len(http_results),
+        'miniapp_errors': len(http_results) - len(http_ok),
+        'miniapp_ms': {q: round(percentile(http_ok, q)) for q in (50, 90, 99)},
+        'model_calls': model.calls,
+        'model_peak_concurrency': model.peak_active,
+        'bot_api_calls': dict(telegram.methods),
+    }
+
+
+def print_result(result):
+    print(f"\n=== {result['build']} (x{result['speed']:g}, model x{result['model_speed']:g})")
+    print(f"  duration {result['duration_s']:.1f}s, throughput {result['throughput_rps']:.2f} req/s")
+    print(f"  telegram: {result['telegram_answered']}/{result['telegram_updates']} answered, "
+          f"first response p50/p90/p99 {'/'.join(str(v) for v in result['telegram_first_ms'].values())} ms, "
+          f"done {'/'.join(str(v) for v in result['telegram_done_ms'].values())} ms")
+    print(f"  mini app: {result['miniapp_requests'] - result['miniapp_errors']}/{result['miniapp_requests']} ok, "
+          f"p50/p90/p99 {'/'.join(str(v) for v in result['miniapp_ms'].values())} ms")
+    print(f"  model calls {result['model_calls']}, peak upstream concurrency {result['model_peak_concurrency']}")
+
+
+def print_comparison(base, other):
+    def delta(old, new):
+        return f'{(new - old) / old * 100:+.1f}%' if old else 'n/a'
+
+    rows = [('throughput req/s', base['throughput_rps'], other['throughput_rps'])]
+    for field in ('telegram_first_ms', 'telegram_done_ms', 'miniapp_ms'):
+        for q in (50, 90, 99):
+            rows.append((f'{field[:-3]} p{q} ms', base[field][q], other[field][q]))
+    print(f"\n{'metric':<26}{'base':>12}{'candidate':>12}{'delta':>10}")
+    for name, old, new in rows:
+        print(f'{name:<26}{old:>12}{new:>12}{delta(old, new):>10}')
+
+
+def command_info(args):
+    trace = Trace(args.trace)
+    kinds = Counter(
+        next((key for key in record['update'] if key != 'update_id'), 'unknown') for record in trace.updates
+    )
+    latencies = [profile['latency_ms'] for profile in trace.profiles]
+    print(f'Span: {trace.span:.0f}s')
+    print(f"Telegram updates: {len(trace.updates)} ({', '.join(f'{k}: {v}' for k, v in kinds.most_common())})")
+    print(f"Mini App requests: {len(trace.http)} ({', '.join(f'{k}: {v}' for k, v in Counter(r['path'] for r in trace.http).items())})")
+    print(f'Upstream profiles: {len(trace.profiles)}, latency p50/p90/p99: '
+          f'{percentile(latencies, 50)}/{percentile(latencies, 90)}/{percentile(latencies, 99)} ms')
+
+
+def command_run(args):
+    trace = Trace(args.trace)
+    if not trace.updates and not trace.http:
+        raise SystemExit('[ERROR] Trace has no requests to replay')
+    model_speed = args.model_speed or args.speed
+    results = []
+    for build in args.build:
+        result = run_build(build, trace, args.speed, model_speed, args.settle, args.drain_timeout)
+        print_result(result)
+        results.append(result)
+    for other in results[1:]:
+        print_comparison(results[0], other)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output_file:
+            json.dump(results, output_file, ensure_ascii=False, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay captured Pushkin AI traffic against local fakes.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    info_parser = subparsers.add_parser('info', help='summarize a trace')
+    info_parser.add_argument('trace')
+    info_parser.set_defaults(handler=command_info)
+
+    run_parser = subparsers.add_parser('run', help='replay a trace against one or two builds')
+    run_parser.add_argument('trace')
+    run_parser.add_argument('--build', action='append', required=True,
+                            help='directory with main.py; the first one is the baseline')
+    run_parser.add_argument('--speed', type=float, default=1.0, help='arrival speed-up, e.g. 1, 10 or 100')
+    run_parser.add_argument('--model-speed', type=float,
+                            help='upstream latency speed-up (default: same as --speed)')
+    run_parser.add_argument('--settle', type=float, default=3.0,
+                            help='seconds without bot activity that end the run')
+    run_parser.add_argument('--drain-timeout', type=float, default=120.0)
+    run_parser.add_argument('--output', help='write results as JSON')
+    run_parser.set_defaults(handler=command_run)
+
+    args = parser.parse_args()
+    args.handler(args)
+
+
+if __name__ == '__main__':
+    main()
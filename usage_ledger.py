@@ -0,0 +1,231 @@
+"""Append-only ledger of upstream token usage with hourly rollups.
+
+Each answered request is stored as one fixed-size binary record in a
+per-day file (usage-YYYYMMDD.bin). Rollups aggregate a day into hourly
+JSON (rollup-YYYYMMDD.json) so raw files can be deleted after
+USAGE_RAW_RETENTION_DAYS while totals stay available.
+"""
+import calendar
+import json
+import math
+import os
+import struct
+import threading
+import time
+from collections import Counter, defaultdict, namedtuple
+from pathlib import Path
+
+# Codes are tuple positions: only append new values.
+ORIGINS = ('telegram', 'miniapp', 'prefetch')
+CACHE_STATUSES = ('upstream', 'semantic', 'journal', 'refused', 'prefetched', 'degraded', 'shed', 'cancelled')
+UNKNOWN_CODE = 255
+
+# ts, user_id, origin, cache status, history length, prompt chars,
+# prompt tokens, completion tokens, latency ms
+RECORD_FORMAT = struct.Struct('<dqBBBHIII')
+
+UsageRecord = namedtuple(
+    'UsageRecord',
+    'ts user_id origin cache_status history_len prompt_chars prompt_tokens completion_tokens latency_ms'
+)
+
+
+def _encode(value, choices):
+    return choices.index(value) if value in choices else UNKNOWN_CODE
+
+
+def _decode(code, choices):
+    return choices[code] if code < len(choices) else 'unknown'
+
+
+def _day_key(ts):
+    return time.strftime('%Y%m%d', time.gmtime(ts))
+
+
+def percentile(values, q):
+    """Nearest-rank percentile of a list of numbers (q in 0..100)."""
+    if not values:
+        return 0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, math.ceil(q / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+class UsageLedger:
+    """Thread-safe writer and reader of per-day usage files."""
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._file = None
+        self._file_day = None
+        self._rolled_day = None
+
+    def _raw_path(self, day):
+        return self.directory / f'usage-{day}.bin'
+
+    def _rollup_path(self, day):
+        return self.directory / f'rollup-{day}.json'
+
+    def record(self, user_id, origin, cache_status, prompt_tokens=0, completion_tokens=0,
+               latency_ms=0, history_len=0, prompt_chars=0, ts=None):
+        """Append one usage record."""
+        ts = time.time() if ts is None else ts
+        data = RECORD_FORMAT.pack(
+            ts,
+            int(user_id or 0),
+            _encode(origin, ORIGINS),
+            _encode(cache_status, CACHE_STATUSES),
+            min(int(history_len), 255),
+            min(int(prompt_chars), 65535),
+            max(int(prompt_tokens), 0),
+            max(int(completion_tokens), 0),
+            max(int(latency_ms), 0),
+        )
+        day = _day_key(ts)
+        with self._lock:
+            if self._file_day != day:
+                if self._file:
+                    self._file.close()
+                self._file = open(self._raw_path(day), 'ab')
+                self._file_day = day
+            self._file.write(data)
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file:
+                self._file.close()
+                self._file = None
+                self._file_day = None
+
+    def _read_day(self, day):
+        path = self._raw_path(day)
+        if not path.exists():
+            return []
+        data = path.read_bytes()
+        usable = len(data) - len(data) % RECORD_FORMAT.size
+        records = []
+        for fields in RECORD_FORMAT.iter_unpack(data[:usable]):
+            records.append(UsageRecord(
+                fields[0],
+                fields[1],
+                _decode(fields[2], ORIGINS),
+                _decode(fields[3], CACHE_STATUSES),
+                *fields[4:]
+            ))
+        return records
+
+    def read(self, since, until=None):
+        """Return raw records with since <= ts < until."""
+        until = time.time() if until is None else until
+        records = []
+        day_ts = since - since % 86400
+        while day_ts <= until:
+            records.extend(
+                record for record in self._read_day(_day_key(day_ts))
+                if since <= record.ts < until
+            )
+            day_ts += 86400
+        return records
+
+    def rollup(self, day):
+        """Aggregate a day's raw records into hourly totals and save them as JSON."""
+        hours = defaultdict(lambda: Counter())
+        for record in self._read_day(day):
+            hour = time.strftime('%H', time.gmtime(record.ts))
+            bucket = hours[hour]
+            bucket['requests'] += 1
+            bucket[f'cache_{record.cache_status}'] += 1
+            bucket[f'origin_{record.origin}'] += 1
+            bucket['prompt_tokens'] += record.prompt_tokens
+            bucket['completion_tokens'] += record.completion_tokens
+            if record.cache_status == 'upstream':
+                bucket['upstream_latency_ms'] += record.latency_ms
+
+        if not hours:
+            return None
+        rollup = {'day': day, 'hours': {hour: dict(counter) for hour, counter in sorted(hours.items())}}
+        path = self._rollup_path(day)
+        tmp_path = path.with_suffix('.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as rollup_file:
+            json.dump(rollup, rollup_file, separators=(',', ':'))
+        os.replace(tmp_path, path)
+        return rollup
+
+    def rollup_current(self, now=None):
+        """Roll up today; once the day changes, first finish yesterday's rollup.
+
+        Records written between the last periodic rollup and midnight
+        would otherwise miss the rollups until compaction.
+        """
+        now = time.time() if now is None else now
+        today = _day_key(now)
+        if self._rolled_day != today:
+            self.rollup(_day_key(now - 86400))
+        self.rollup(today)
+        self._rolled_day = today
+
+    def compact(self, raw_retention_days):
+        """Roll up and delete raw files older than raw_retention_days."""
+        cutoff = _day_key(time.time() - raw_retention_days * 86400)
+        for path in self.directory.glob('usage-*.bin'):
+            day = path.stem.split('-', 1)[1]
+            if day >= cutoff:
+                continue
+            if self.rollup(day) is not None or not path.stat().st_size:
+                with self._lock:
+                    if self._file_day == day:
+                        continue
+                path.unlink()
+
+    def read_rollups(self, since):
+        """Yield (hour_ts, totals) from saved rollups for hours ending after since."""
+        for path in sorted(self.directory.glob('rollup-*.json')):
+            with open(path, 'r', encoding='utf-8') as rollup_file:
+                rollup = json.load(rollup_file)
+            day_ts = calendar.timegm(time.strptime(rollup['day'], '%Y%m%d'))
+            for hour, totals in rollup['hours'].items():
+                hour_ts = day_ts + int(hour) * 3600
+                if hour_ts >= since - 3600:
+                    yield hour_ts, totals
+
+
+def summarize(records, top=10):
+    """Build the numbers shown by /stats from raw records."""
+    upstream = [record for record in records if record.cache_status == 'upstream']
+    latencies = [record.latency_ms for record in upstream]
+    users = defaultdict(lambda: [0, 0])
+    per_hour = Counter()
+    by_history = defaultdict(list)
+    by_status = Counter()
+    by_origin = Counter()
+
+    for record in records:
+        tokens = record.prompt_tokens + record.completion_tokens
+        users[record.user_id][0] += 1
+        users[record.user_id][1] += tokens
+        per_hour[int(record.ts // 3600 * 3600)] += tokens
+        by_status[record.cache_status] += 1
+        by_origin[record.origin] += 1
+        if record.cache_status == 'upstream':
+            bucket = '0' if record.history_len == 0 else '1-4' if record.history_len < 5 else '5+'
+            by_history[bucket].append(record.prompt_tokens)
+
+    return {
+        'requests': len(records),
+        'upstream_calls': len(upstream),
+        'prompt_tokens': sum(record.prompt_tokens for record in records),
+        'completion_tokens': sum(record.completion_tokens for record in records),
+        'by_status': dict(by_status),
+        'by_origin': dict(by_origin),
+        'latency_ms': {q: percentile(latencies, q) for q in (50, 90, 99)},
+        'completion_tokens_p50': percentile([record.completion_tokens for record in upstream], 50),
+        'completion_tokens_p99': percentile([record.completion_tokens for record in upstream], 99),
+        'top_users': sorted(users.items(), key=lambda item: item[1][1], reverse=True)[:top],
+        'tokens_per_hour': sorted(per_hour.items()),
+        'prompt_tokens_by_history': {
+            bucket: sum(values) / len(values) for bucket, values in sorted(by_history.items())
+        },
+    }